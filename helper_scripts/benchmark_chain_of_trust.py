@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Benchmark ChainOfTrust link bookkeeping on large chains.
+
+This builds chains of several thousand ``LinkOfTrust``s the way
+``build_task_dependencies`` does, then looks up every link the way
+``download_cot_artifact`` does.  For comparison, it runs the same pattern
+against a plain list with linear scans, which is how ``ChainOfTrust`` used to
+keep its links.
+"""
+
+import argparse
+import logging
+import time
+import tracemalloc
+
+from scriptworker.constants import DEFAULT_CONFIG
+from scriptworker.context import Context
+from scriptworker.cot.verify import ChainOfTrust, LinkOfTrust
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+
+def get_task(task_id):
+    """Get a docker-worker task definition for a link."""
+    return {
+        'taskGroupId': 'decision_task_id',
+        'provisionerId': 'provisioner',
+        'workerType': 'workerType',
+        'schedulerId': 'scheduler',
+        'scopes': [],
+        'payload': {'image': 'image'},
+        'metadata': {'source': 'https://hg.mozilla.org/mozilla-central/file/{}'.format(task_id)},
+    }
+
+
+def get_chain():
+    """Get an empty ChainOfTrust for a signing task."""
+    context = Context()
+    context.config = dict(DEFAULT_CONFIG)
+    context.task = {
+        'taskGroupId': 'decision_task_id',
+        'provisionerId': 'scriptworker-prov-v1',
+        'workerType': 'signing-linux-v1',
+        'schedulerId': 'scheduler',
+        'scopes': [],
+        'payload': {},
+        'metadata': {},
+    }
+    return ChainOfTrust(context, 'signing', task_id='task_id')
+
+
+def get_links(chain, num_links):
+    """Create ``num_links`` LinkOfTrust objects."""
+    links = []
+    for num in range(num_links):
+        task_id = 'task{}'.format(num)
+        link = LinkOfTrust(chain.context, 'signing:build', task_id)
+        link.task = get_task(task_id)
+        links.append(link)
+    return links
+
+
+def linear(chain, links):
+    """Add and look up the links with linear scans of a list."""
+    chain_links = []
+    for link in links:
+        if link.task_id not in [x.task_id for x in chain_links]:
+            chain_links.append(link)
+    for link in links:
+        matches = [x for x in chain_links if x.task_id == link.task_id]
+        assert len(matches) == 1
+
+
+def indexed(chain, links):
+    """Add and look up the links through the ChainOfTrust indexes."""
+    chain.links = []
+    for link in links:
+        if not chain.has_link(link.task_id):
+            chain.add_link(link)
+    for link in links:
+        chain.get_link(link.task_id)
+
+
+def timed(func, *args):
+    """Return how long ``func(*args)`` takes, in seconds."""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('num_links', nargs='*', type=int, default=[1000, 2000, 5000])
+    args = parser.parse_args()
+    chain = get_chain()
+    for num_links in args.num_links:
+        tracemalloc.start()
+        links = get_links(chain, num_links)
+        link_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        linear_time = timed(linear, chain, links)
+        indexed_time = timed(indexed, chain, links)
+        log.info(
+            "{} links: linear {:.3f}s, indexed {:.3f}s ({:.0f}x); {:.0f} bytes per link".format(
+                num_links, linear_time, indexed_time, linear_time / indexed_time, link_memory / num_links
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
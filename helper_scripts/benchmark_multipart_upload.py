@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""Benchmark single PUT and multipart artifact uploads.
+
+This uploads a file to a local stand-in for the artifact storage endpoint,
+which caps each connection at ``--connection-rate`` MiB/s, the way a long
+distance connection to S3 tends to behave.  It times ``create_artifact``
+with a single PUT, then with ``artifact_multipart_upload_threshold`` set.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from scriptworker.artifacts import create_artifact
+from scriptworker.constants import DEFAULT_CONFIG
+from scriptworker.context import Context
+from scriptworker.utils import rm
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+MiB = 1024 * 1024
+
+
+class ThrottledStorage(object):
+    """A local storage endpoint that reads each request at ``rate`` bytes per second."""
+
+    def __init__(self, rate):
+        """Initialize ThrottledStorage."""
+        self.rate = rate
+        self.url = None
+        self.app = web.Application()
+        self.app.router.add_put('/{name:.*}', self.put)
+
+    async def put(self, request):
+        """Read the upload at the throttled rate."""
+        while True:
+            chunk = await request.content.read(64 * 1024)
+            if not chunk:
+                break
+            await asyncio.sleep(len(chunk) / self.rate)
+        return web.Response(headers={'ETag': request.match_info['name']})
+
+    async def start(self):
+        """Start listening on a free local port."""
+        self.handler = self.app.make_handler()
+        self.server = await asyncio.get_event_loop().create_server(self.handler, '127.0.0.1', 0)
+        self.url = "http://127.0.0.1:{}".format(self.server.sockets[0].getsockname()[1])
+
+    async def stop(self):
+        """Stop the server."""
+        self.server.close()
+        await self.server.wait_closed()
+        await self.handler.shutdown()
+
+
+class FakeQueue(object):
+    """Hand out upload urls on the local storage endpoint."""
+
+    def __init__(self, storage):
+        """Initialize FakeQueue."""
+        self.storage = storage
+
+    async def createArtifact(self, task_id, run_id, name, payload):
+        """Get the upload url(s) for an artifact."""
+        if payload['storageType'] == 'blob':
+            return {'storageType': 'blob', 'requests': [{
+                'url': "{}/{}/{}".format(self.storage.url, name, num),
+                'method': 'PUT',
+                'headers': {'Content-Length': str(part['size'])},
+            } for num, part in enumerate(payload['parts'])]}
+        return {'storageType': 's3', 'putUrl': "{}/{}".format(self.storage.url, name)}
+
+    async def completeArtifact(self, task_id, run_id, name, payload):
+        """Complete a blob artifact."""
+        pass
+
+
+def get_context(tmp, storage, threshold, part_size, max_parts):
+    """Get a Context that uploads to ``storage``."""
+    context = Context()
+    context.config = dict(DEFAULT_CONFIG)
+    context.config.update({
+        'artifact_dir': os.path.join(tmp, 'artifacts'),
+        'work_dir': os.path.join(tmp, 'work'),
+        'artifact_multipart_upload_threshold': threshold,
+        'artifact_upload_part_size': part_size,
+        'artifact_upload_max_concurrent_parts': max_parts,
+    })
+    context.claim_task = {
+        'status': {'taskId': 'taskId'}, 'runId': 0, 'task': {},
+        'credentials': {'clientId': 'clientId', 'accessToken': 'accessToken'},
+    }
+    context.temp_queue = FakeQueue(storage)
+    return context
+
+
+async def timed_upload(context, path):
+    """Return how long uploading ``path`` takes, in seconds."""
+    start = time.perf_counter()
+    await create_artifact(context, path, 'public/build/target.bin', 'application/octet-stream', None)
+    return time.perf_counter() - start
+
+
+async def run(args, tmp):
+    """Run the benchmark."""
+    path = os.path.join(tmp, 'target.bin')
+    with open(path, 'wb') as fh:
+        for _ in range(args.size):
+            fh.write(os.urandom(MiB))
+    storage = ThrottledStorage(args.connection_rate * MiB)
+    await storage.start()
+    connector = aiohttp.TCPConnector(limit=args.max_parts + 1)
+    session = aiohttp.ClientSession(connector=connector)
+    try:
+        results = []
+        for threshold in (None, 0):
+            context = get_context(tmp, storage, threshold, args.part_size * MiB, args.max_parts)
+            context.session = session
+            results.append(await timed_upload(context, path))
+        log.info("{} MiB at {} MiB/s per connection: single PUT {:.2f}s, {} MiB parts x{} {:.2f}s ({:.1f}x)".format(
+            args.size, args.connection_rate, results[0], args.part_size, args.max_parts, results[1],
+            results[0] / results[1]
+        ))
+    finally:
+        session.close()
+        await storage.stop()
+
+
+def main():
+    """Parse the args and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256, help='the file size, in MiB')
+    parser.add_argument('--part-size', type=int, default=32, help='the part size, in MiB')
+    parser.add_argument('--max-parts', type=int, default=4, help='the number of parts to upload at once')
+    parser.add_argument('--connection-rate', type=float, default=64, help='the MiB/s each connection gets')
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    try:
+        asyncio.get_event_loop().run_until_complete(run(args, tmp))
+    finally:
+        rm(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Benchmark the CPU cost of artifact uploads, with and without sendfile.
+
+This uploads a file with ``create_artifact`` to a local endpoint, which runs
+in its own process so its CPU time doesn't count, first with buffered writes
+and then with ``artifact_upload_sendfile``.  It reports the CPU seconds the
+uploading process spent per GiB uploaded.
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+from scriptworker.artifacts import create_artifact
+from scriptworker.constants import DEFAULT_CONFIG
+from scriptworker.context import Context
+from scriptworker.utils import rm
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logging.getLogger("scriptworker").setLevel(logging.WARNING)
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+
+async def discard(request):
+    """Read and drop the upload."""
+    while True:
+        chunk = await request.content.read(MiB)
+        if not chunk:
+            break
+    return web.Response()
+
+
+def serve(port_queue):
+    """Run the local endpoint, and put its port on ``port_queue``."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = web.Application()
+    app.router.add_put('/{name:.*}', discard)
+    server = loop.run_until_complete(loop.create_server(app.make_handler(access_log=None), '127.0.0.1', 0))
+    port_queue.put(server.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+
+class FakeQueue(object):
+    """Hand out upload urls on the local endpoint."""
+
+    def __init__(self, url):
+        """Initialize FakeQueue."""
+        self.url = url
+
+    async def createArtifact(self, task_id, run_id, name, payload):
+        """Get the upload url for an artifact."""
+        return {'storageType': 's3', 'putUrl': "{}/{}".format(self.url, name)}
+
+
+def get_context(tmp, session, url, use_sendfile):
+    """Get a Context that uploads to ``url``."""
+    context = Context()
+    context.session = session
+    context.config = dict(DEFAULT_CONFIG)
+    context.config.update({
+        'artifact_dir': os.path.join(tmp, 'artifacts'),
+        'work_dir': os.path.join(tmp, 'work'),
+        'artifact_upload_sendfile': use_sendfile,
+    })
+    context.claim_task = {
+        'status': {'taskId': 'taskId'}, 'runId': 0, 'task': {},
+        'credentials': {'clientId': 'clientId', 'accessToken': 'accessToken'},
+    }
+    context.temp_queue = FakeQueue(url)
+    return context
+
+
+def cpu_time():
+    """Return the user and system CPU time of this process, in seconds."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def timed_uploads(context, path, repeat):
+    """Upload ``path`` ``repeat`` times, and return the CPU and wall clock seconds it took."""
+    start_cpu, start = cpu_time(), time.perf_counter()
+    for _ in range(repeat):
+        await create_artifact(context, path, 'public/build/target.bin', 'application/octet-stream', None)
+    return cpu_time() - start_cpu, time.perf_counter() - start
+
+
+async def run(args, tmp, url):
+    """Run the benchmark."""
+    path = os.path.join(tmp, 'target.bin')
+    with open(path, 'wb') as fh:
+        for _ in range(args.size):
+            fh.write(os.urandom(MiB))
+    uploaded = args.size * MiB * args.repeat / GiB
+    async with aiohttp.ClientSession() as session:
+        for use_sendfile in (False, True):
+            context = get_context(tmp, session, url, use_sendfile)
+            cpu, wall = await timed_uploads(context, path, args.repeat)
+            log.info("{:9}: {:.3f} CPU seconds per GiB, {:.0f} MiB/s".format(
+                'sendfile' if use_sendfile else 'buffered', cpu / uploaded, uploaded * 1024 / wall
+            ))
+
+
+def main():
+    """Parse the args and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256, help='the file size, in MiB')
+    parser.add_argument('--repeat', type=int, default=8, help='the number of uploads to time')
+    args = parser.parse_args()
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(port_queue, ), daemon=True)
+    server.start()
+    tmp = tempfile.mkdtemp()
+    try:
+        url = "http://127.0.0.1:{}".format(port_queue.get(timeout=30))
+        asyncio.get_event_loop().run_until_complete(run(args, tmp, url))
+    finally:
+        server.terminate()
+        rm(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,24 +7,45 @@ in S3.
 import aiohttp
 import arrow
 import asyncio
+from collections import OrderedDict
 import gzip
+import hashlib
+import heapq
+import itertools
 import logging
 import mimetypes
 import os
+import shutil
+import tempfile
 
 from urllib.parse import unquote, urljoin
 
+from scriptworker.cache import get_artifact_cache
 from scriptworker.client import validate_artifact_url
-from scriptworker.exceptions import ScriptWorkerRetryException, ScriptWorkerTaskException
+from scriptworker.exceptions import DownloadError, ScriptWorkerRetryException, ScriptWorkerTaskException
 from scriptworker.task import get_task_id, get_run_id, get_decision_task_id
-from scriptworker.utils import download_file, filepaths_in_dir, raise_future_exceptions, retry_async
+from scriptworker.utils import download_file, filepaths_in_dir, gather_fail_fast, retry_async, rm, \
+    run_in_executor
 
 
 log = logging.getLogger(__name__)
 
 
+# Retry downloads on anything but a bad digest, which won't go away on retry.
+_DOWNLOAD_RETRY_EXCEPTIONS = (DownloadError, aiohttp.ClientError, asyncio.TimeoutError, OSError)
 _GZIP_SUPPORTED_CONTENT_TYPE = ('text/plain', 'application/json', 'text/html', 'application/xml')
 _EXTENSIONS_TO_FORCE_TO_PLAIN_TEXT = ('.asc', '.log')
+_CHUNK_SIZE = 1024 * 1024
+_UPLOAD_RETRY_EXCEPTIONS = (ScriptWorkerRetryException, aiohttp.ClientError, asyncio.TimeoutError)
+# XXX remove when we require a taskcluster client with Queue.completeArtifact
+_COMPLETE_ARTIFACT_ENTRY = {
+    'args': ['taskId', 'runId', 'name'],
+    'input': 'http://schemas.taskcluster.net/queue/v1/put-artifact-request.json#',
+    'method': 'put',
+    'name': 'completeArtifact',
+    'route': '/task/<taskId>/runs/<runId>/artifacts/<name>',
+    'stability': 'experimental',
+}
 
 
 def _force_mimetypes_to_plain_text():
@@ -43,10 +64,12 @@ _force_mimetypes_to_plain_text()
 
 
 # upload_artifacts {{{1
-async def upload_artifacts(context):
+async def upload_artifacts(context, fail_fast=True):
     """Compress and upload the files in ``artifact_dir``, preserving relative paths.
 
-    Compression only occurs with files known to be supported.
+    Compression only occurs with files known to be supported.  The uploads
+    go through an ``UploadScheduler``, largest first.  By default, the first
+    failed upload cancels the rest.
 
     This function expects the directory structure in ``artifact_dir`` to remain
     the same.  So if we want the files in ``public/...``, create an
@@ -54,42 +77,218 @@ async def upload_artifacts(context):
 
     Args:
         context (scriptworker.context.Context): the scriptworker context.
+        fail_fast (bool, optional): if False, finish every upload and log
+            every error before raising.  Defaults to True.
 
     Raises:
         Exception: any exceptions the tasks raise.
 
     """
-    file_list = {}
-    for target_path in filepaths_in_dir(context.config['artifact_dir']):
-        path = os.path.join(context.config['artifact_dir'], target_path)
-
-        content_type, content_encoding = compress_artifact_if_supported(path)
-        file_list[target_path] = {
-            'path': path,
-            'target_path': target_path,
-            'content_type': content_type,
-            'content_encoding': content_encoding,
-        }
+    scheduler = UploadScheduler(context)
+    artifacts = await scheduler.scan()
+    tasks = [
+        asyncio.ensure_future(scheduler.upload(path, target_path, size))
+        for target_path, path, size in artifacts
+    ]
+    reporter = asyncio.ensure_future(scheduler.report_queue_depths())
+    try:
+        await gather_fail_fast(tasks, fail_fast=fail_fast)
+    finally:
+        reporter.cancel()
+    log.info(scheduler.format_stats())
 
-    tasks = []
-    for upload_config in file_list.values():
-        tasks.append(
-            asyncio.ensure_future(
-                retry_create_artifact(
-                    context, upload_config['path'],
-                    target_path=upload_config['target_path'],
-                    content_type=upload_config['content_type'],
-                    content_encoding=upload_config['content_encoding'],
-                )
+
+# UploadScheduler {{{1
+class UploadScheduler(object):
+    """Upload artifacts through bounded scan, compress, createArtifact and PUT stages.
+
+    Each stage runs at most its ``upload_max_concurrent_*`` limit of
+    artifacts at a time.  When a stage is full, the largest waiting artifact
+    goes next, so the biggest uploads start as early as possible and the
+    last byte finishes as early as possible.
+
+    Attributes:
+        context (scriptworker.context.Context): the scriptworker context.
+        stages (OrderedDict): the ``compress``, ``createArtifact`` and
+            ``put`` stages, by name.
+
+    """
+
+    def __init__(self, context):
+        """Initialize UploadScheduler.
+
+        Args:
+            context (scriptworker.context.Context): the scriptworker context.
+
+        """
+        self.context = context
+        self.stages = OrderedDict()
+        for name, config_key in (('compress', 'upload_max_concurrent_compressions'),
+                                 ('createArtifact', 'upload_max_concurrent_create_artifacts'),
+                                 ('put', 'upload_max_concurrent_puts')):
+            self.stages[name] = _UploadStage(name, context.config[config_key])
+
+    async def scan(self):
+        """List the artifacts in ``artifact_dir``, largest first.
+
+        Returns:
+            list: a ``(target_path, path, size)`` tuple per artifact.
+
+        """
+        return await run_in_executor(self.context, scan_artifacts, self.context.config['artifact_dir'])
+
+    async def upload(self, path, target_path, size):
+        """Compress and upload an artifact.
+
+        Args:
+            path (str): the path of the artifact.
+            target_path (str): the artifact path relative to ``artifact_dir``.
+            size (int): the size of the artifact, in bytes.
+
+        """
+        async with self.stages['compress'].slot(size):
+            content_type, content_encoding = await run_in_executor(
+                self.context, compress_artifact_if_supported, path
             )
+        await retry_create_artifact(
+            self.context, path, target_path=target_path, content_type=content_type,
+            content_encoding=content_encoding, scheduler=self,
         )
-    await raise_future_exceptions(tasks)
+
+    async def report_queue_depths(self):
+        """Log the queue depths every ``upload_report_interval`` seconds, until cancelled."""
+        while True:
+            await asyncio.sleep(self.context.config['upload_report_interval'])
+            log.info(self.format_queue_depths())
+
+    def format_queue_depths(self):
+        """Format the current queue depth of each stage.
+
+        Returns:
+            str: the formatted queue depths.
+
+        """
+        return "Upload queues: {}".format(", ".join([
+            "{} {} active, {} queued".format(stage.name, stage.active, stage.queued)
+            for stage in self.stages.values()
+        ]))
+
+    def format_stats(self):
+        """Format the statistics of each stage for the log.
+
+        Returns:
+            str: the formatted statistics.
+
+        """
+        return "Upload stages: {}".format(", ".join([
+            "{} {} done, max queue depth {}".format(stage.name, stage.completed, stage.max_queued)
+            for stage in self.stages.values()
+        ]))
+
+
+class _UploadStage(object):
+    """A bounded stage that lets the largest waiting artifact in first."""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.completed = 0
+        self.max_queued = 0
+        self._counter = itertools.count()
+        self._queue = []
+
+    @property
+    def queued(self):
+        """int: the number of artifacts waiting for this stage."""
+        return len(self._queue)
+
+    async def acquire(self, size):
+        """Wait for a slot in this stage, ahead of any smaller artifacts."""
+        self._discard_done()
+        if self.active < self.limit and not self._queue:
+            self.active += 1
+            return
+        item = (-size, next(self._counter), asyncio.Future())
+        heapq.heappush(self._queue, item)
+        self.max_queued = max(self.max_queued, self.queued)
+        try:
+            await item[2]
+        except asyncio.CancelledError:
+            if item[2].cancelled():
+                # Don't leave the cancelled waiter in the way of the others.
+                if item in self._queue:
+                    self._queue.remove(item)
+                    heapq.heapify(self._queue)
+            else:
+                # We were cancelled after we got our slot.
+                self.release(succeeded=False)
+            raise
+
+    def _discard_done(self):
+        while self._queue and self._queue[0][2].done():
+            heapq.heappop(self._queue)
+
+    def release(self, succeeded=True):
+        """Hand the slot to the largest waiting artifact.
+
+        Args:
+            succeeded (bool, optional): whether the slot's holder succeeded,
+                and counts as completed.  Defaults to True.
+
+        """
+        self.active -= 1
+        if succeeded:
+            self.completed += 1
+        self._discard_done()
+        if self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            self.active += 1
+            future.set_result(None)
+
+    def slot(self, size):
+        """Get an async context manager that holds a slot in this stage."""
+        return _UploadStageSlot(self, size)
+
+
+class _UploadStageSlot(object):
+
+    def __init__(self, stage, size):
+        self.stage = stage
+        self.size = size
+
+    async def __aenter__(self):
+        await self.stage.acquire(self.size)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.stage.release(succeeded=exc_type is None)
+
+
+# scan_artifacts {{{1
+def scan_artifacts(artifact_dir):
+    """List the artifacts in ``artifact_dir``, largest first.
+
+    Args:
+        artifact_dir (str): the artifact directory.
+
+    Returns:
+        list: a ``(target_path, path, size)`` tuple per artifact.
+
+    """
+    artifacts = []
+    for target_path in filepaths_in_dir(artifact_dir):
+        path = os.path.join(artifact_dir, target_path)
+        artifacts.append((target_path, path, os.path.getsize(path)))
+    return sorted(artifacts, key=lambda artifact: (-artifact[2], artifact[0]))
 
 
 def compress_artifact_if_supported(artifact_path):
     """Compress artifacts with GZip if they're known to be supported.
 
-    This replaces the artifact given by a gzip binary.
+    This replaces the artifact given by a gzip binary.  The artifact is
+    compressed ``_CHUNK_SIZE`` bytes at a time into a temporary file
+    next to it, which then replaces it, so memory use doesn't grow with
+    the size of the artifact.
 
     Args:
         artifact_path (str): the path to compress
@@ -103,11 +302,19 @@ def compress_artifact_if_supported(artifact_path):
 
     if encoding is None and content_type in _GZIP_SUPPORTED_CONTENT_TYPE:
         log.info('"{}" can be gzip\'d. Compressing...'.format(artifact_path))
-        with open(artifact_path, 'rb') as f_in:
-            text_content = f_in.read()
-
-        with gzip.open(artifact_path, 'wb') as f_out:
-            f_out.write(text_content)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.{}.'.format(os.path.basename(artifact_path)), dir=os.path.dirname(artifact_path)
+        )
+        try:
+            with open(artifact_path, 'rb') as f_in, os.fdopen(fd, 'wb') as fh:
+                # Keep the artifact's name in the gzip header, rather than the temp file's.
+                with gzip.GzipFile(filename=artifact_path, mode='wb', fileobj=fh) as f_out:
+                    shutil.copyfileobj(f_in, f_out, _CHUNK_SIZE)
+            shutil.copymode(artifact_path, tmp_path)
+            os.replace(tmp_path, artifact_path)
+        except BaseException:
+            rm(tmp_path)
+            raise
 
         encoding = 'gzip'
         log.info('"{}" compressed'.format(artifact_path))
@@ -155,11 +362,13 @@ async def retry_create_artifact(*args, **kwargs):
 
 
 # create_artifact {{{1
-async def create_artifact(context, path, target_path, content_type, content_encoding, storage_type='s3', expires=None):
+async def create_artifact(context, path, target_path, content_type, content_encoding, storage_type='s3', expires=None,
+                          scheduler=None):
     """Create an artifact and upload it.
 
     This should support s3 and azure out of the box; we'll need some tweaking
-    if we want to support redirect/error artifacts.
+    if we want to support redirect/error artifacts.  s3 artifacts larger than
+    ``artifact_multipart_upload_threshold`` go to ``create_multipart_artifact``.
 
     Args:
         context (scriptworker.context.Context): the scriptworker context.
@@ -173,11 +382,21 @@ async def create_artifact(context, path, target_path, content_type, content_enco
             Defaults to 's3'
         expires (str, optional): datestring of when the artifact expires.
             Defaults to None.
+        scheduler (UploadScheduler, optional): the scheduler whose
+            ``createArtifact`` and ``put`` stages to wait for.  If None, use
+            a new one.  Defaults to None.
 
     Raises:
         ScriptWorkerRetryException: on failure.
 
     """
+    scheduler = scheduler or UploadScheduler(context)
+    size = os.path.getsize(path)
+    threshold = context.config['artifact_multipart_upload_threshold']
+    if storage_type == 's3' and threshold is not None and size > threshold:
+        return await create_multipart_artifact(
+            context, path, target_path, content_type, content_encoding, expires=expires, scheduler=scheduler
+        )
     payload = {
         "storageType": storage_type,
         "expires": expires or get_expiration_arrow(context).isoformat(),
@@ -186,13 +405,15 @@ async def create_artifact(context, path, target_path, content_type, content_enco
     args = [get_task_id(context.claim_task), get_run_id(context.claim_task),
             target_path, payload]
 
-    tc_response = await context.temp_queue.createArtifact(*args)
+    async with scheduler.stages['createArtifact'].slot(size):
+        tc_response = await context.temp_queue.createArtifact(*args)
     skip_auto_headers = [aiohttp.hdrs.CONTENT_TYPE]
-    log.info("uploading {path} to {url}...".format(path=path, url=tc_response['putUrl']))
-    with open(path, "rb") as fh:
+    async with scheduler.stages['put'].slot(size):
+        log.info("uploading {path} to {url}...".format(path=path, url=tc_response['putUrl']))
+        data = _FilePayload(path, use_sendfile=context.config['artifact_upload_sendfile'])
         with aiohttp.Timeout(context.config['artifact_upload_timeout']):
             async with context.session.put(
-                tc_response['putUrl'], data=fh, headers=_craft_artifact_put_headers(content_type, content_encoding),
+                tc_response['putUrl'], data=data, headers=_craft_artifact_put_headers(content_type, content_encoding),
                 skip_auto_headers=skip_auto_headers, compress=False
             ) as resp:
                 log.info("create_artifact {}: {}".format(path, resp.status))
@@ -204,6 +425,280 @@ async def create_artifact(context, path, target_path, content_type, content_enco
                     )
 
 
+# create_multipart_artifact {{{1
+async def create_multipart_artifact(context, path, target_path, content_type, content_encoding, expires=None,
+                                    scheduler=None):
+    """Create a blob artifact, and upload it in parts.
+
+    The artifact is split into ``artifact_upload_part_size`` parts, which
+    are uploaded up to ``artifact_upload_max_concurrent_parts`` at a time.
+    Each part gets its own ``artifact_upload_timeout``, and is retried on
+    its own.  Once every part is uploaded, we complete the artifact with the
+    parts' ETags.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+        path (str): the path of the file to upload.
+        target_path (str): the artifact name.
+        content_type (str): the content type of the artifact.
+        content_encoding (str): the content encoding of the file, e.g. 'gzip',
+            or None.
+        expires (str, optional): datestring of when the artifact expires.
+            Defaults to None.
+        scheduler (UploadScheduler, optional): the scheduler whose
+            ``createArtifact`` and ``put`` stages to wait for.  If None, use
+            a new one.  Defaults to None.
+
+    Raises:
+        ScriptWorkerRetryException: on failure.
+
+    """
+    scheduler = scheduler or UploadScheduler(context)
+    blob_info = await run_in_executor(
+        context, get_blob_artifact_info, path, context.config['artifact_upload_part_size'], content_encoding
+    )
+    payload = {
+        "storageType": "blob",
+        "expires": expires or get_expiration_arrow(context).isoformat(),
+        "contentType": content_type,
+        "contentEncoding": content_encoding or "identity",
+    }
+    payload.update(blob_info)
+    args = [get_task_id(context.claim_task), get_run_id(context.claim_task), target_path]
+    async with scheduler.stages['createArtifact'].slot(blob_info['transferLength']):
+        tc_response = await context.temp_queue.createArtifact(*(args + [payload]))
+    requests = tc_response['requests']
+    if len(requests) != len(blob_info['parts']):
+        raise ScriptWorkerRetryException("{}: expected {} upload requests; got {}!".format(
+            target_path, len(blob_info['parts']), len(requests)
+        ))
+    log.info("uploading {} to {} in {} parts...".format(path, target_path, len(requests)))
+    semaphore = asyncio.Semaphore(context.config['artifact_upload_max_concurrent_parts'])
+    async with scheduler.stages['put'].slot(blob_info['transferLength']):
+        tasks = []
+        try:
+            offset = 0
+            for part, request in zip(blob_info['parts'], requests):
+                tasks.append(asyncio.ensure_future(retry_async(
+                    put_artifact_part, retry_exceptions=_UPLOAD_RETRY_EXCEPTIONS,
+                    args=(context, path, offset, part['size'], request, semaphore),
+                )))
+                offset += part['size']
+            etags = await gather_fail_fast(tasks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+    complete_artifact = getattr(context.temp_queue, 'completeArtifact', None)
+    if complete_artifact is None:
+        await context.temp_queue._makeApiCall(_COMPLETE_ARTIFACT_ENTRY, *(args + [{'etags': etags}]))
+    else:
+        await complete_artifact(*(args + [{'etags': etags}]))
+    log.info("create_multipart_artifact {}: complete".format(path))
+
+
+async def put_artifact_part(context, path, offset, size, request, semaphore):
+    """Upload one part of a multipart artifact.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+        path (str): the path of the file to upload.
+        offset (int): the offset of the part in the file.
+        size (int): the size of the part, in bytes.
+        request (dict): the ``url``, ``method`` and ``headers`` the queue
+            gave us for this part.
+        semaphore (asyncio.Semaphore): limits the concurrent part uploads.
+
+    Returns:
+        str: the ETag of the part.
+
+    Raises:
+        ScriptWorkerRetryException: on a bad status, or a missing ETag.
+
+    """
+    headers = dict(request.get('headers', {}))
+    if aiohttp.hdrs.CONTENT_LENGTH.lower() not in [key.lower() for key in headers]:
+        headers[aiohttp.hdrs.CONTENT_LENGTH] = str(size)
+    async with semaphore:
+        with aiohttp.Timeout(context.config['artifact_upload_timeout']):
+            async with context.session.request(
+                request['method'], request['url'], data=_FilePayload(path, offset, size, use_sendfile=context.config['artifact_upload_sendfile']),
+                headers=headers,
+                skip_auto_headers=[aiohttp.hdrs.CONTENT_TYPE], compress=False
+            ) as resp:
+                log.debug("put_artifact_part {} bytes {}-{}: {}".format(path, offset, offset + size - 1, resp.status))
+                if resp.status not in (200, 204):
+                    raise ScriptWorkerRetryException("Bad status {}".format(resp.status))
+                etag = resp.headers.get(aiohttp.hdrs.ETAG)
+                if not etag:
+                    raise ScriptWorkerRetryException("No ETag for {} bytes {}-{}!".format(
+                        path, offset, offset + size - 1
+                    ))
+                return etag
+
+
+class _FilePayload(aiohttp.payload.Payload):
+    """Send ``size`` bytes of a file, from ``offset``, as a request body.
+
+    Where we can, we copy the file to the socket with ``os.sendfile``, so the
+    bytes never pass through python.  We fall back to buffered writes on tls
+    connections, which python encrypts in userspace; on compressed or chunked
+    requests; and when ``os.sendfile`` isn't available, or fails before
+    sending anything.
+
+    Attributes:
+        sent_with (str): 'sendfile' or 'buffered', once the body is written.
+
+    """
+
+    def __init__(self, path, offset=0, size=None, use_sendfile=True):
+        """Initialize _FilePayload.
+
+        Args:
+            path (str): the path of the file to send.
+            offset (int, optional): where to start in the file.  Defaults to 0.
+            size (int, optional): the number of bytes to send.  If None, send
+                the rest of the file.  Defaults to None.
+            use_sendfile (bool, optional): whether to try ``os.sendfile``.
+                Defaults to True.
+
+        """
+        super(_FilePayload, self).__init__(path)
+        self._path = path
+        self._offset = offset
+        self._size = os.path.getsize(path) - offset if size is None else size
+        self.use_sendfile = use_sendfile
+        self.sent_with = None
+
+    async def write(self, writer):
+        """Write the file to ``writer``.
+
+        Args:
+            writer (aiohttp.http_writer.PayloadWriter): the request body writer.
+
+        """
+        sent = 0
+        with open(self._path, "rb") as fh:
+            if self.use_sendfile and hasattr(os, 'sendfile') and not writer.chunked and \
+                    getattr(writer, '_compress', None) is None:
+                # Send the headers, so the socket is ours once the transport
+                # buffer is empty.
+                await writer.drain()
+                transport = getattr(writer, '_transport', None)
+                if _can_sendfile(transport):
+                    try:
+                        sent = await self._sendfile(writer.loop, transport, fh)
+                        self.sent_with = 'sendfile'
+                    except OSError as exc:
+                        if self.sent_with:
+                            raise
+                        log.debug("os.sendfile failed for {}: {}; falling back to buffered writes".format(
+                            self._path, exc
+                        ))
+                    writer.output_size += sent
+            if sent < self._size and self.sent_with is None:
+                self.sent_with = 'buffered'
+                fh.seek(self._offset)
+                remaining = self._size
+                while remaining:
+                    chunk = fh.read(min(_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await writer.write(chunk)
+
+    async def _sendfile(self, loop, transport, fh):
+        sock = transport.get_extra_info('socket').dup()
+        sock.setblocking(False)
+        out_fd = sock.fileno()
+        offset = self._offset
+        remaining = self._size
+        try:
+            while remaining:
+                try:
+                    sent = os.sendfile(out_fd, fh.fileno(), offset, remaining)
+                except (BlockingIOError, InterruptedError):
+                    await _wait_writable(loop, out_fd)
+                    continue
+                if not sent:
+                    # The file is shorter than we were told; the server
+                    # will reject the short body.
+                    break
+                self.sent_with = 'sendfile'
+                offset += sent
+                remaining -= sent
+        finally:
+            sock.close()
+        return offset - self._offset
+
+
+def _can_sendfile(transport):
+    return transport is not None and transport.get_extra_info('sslcontext') is None and \
+        transport.get_extra_info('socket') is not None and transport.get_write_buffer_size() == 0
+
+
+async def _wait_writable(loop, fd):
+    future = asyncio.Future(loop=loop)
+    loop.add_writer(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        loop.remove_writer(fd)
+
+
+# get_blob_artifact_info {{{1
+def get_blob_artifact_info(path, part_size, content_encoding=None):
+    """Get the sizes and sha256s of a blob artifact and its parts.
+
+    Args:
+        path (str): the path of the file to upload.
+        part_size (int): the size of each part, in bytes.  The last part may
+            be smaller.
+        content_encoding (str, optional): the content encoding of the file.
+            If 'gzip', the content sha256 and length are of the decompressed
+            file.  Defaults to None.
+
+    Returns:
+        dict: the ``contentSha256``, ``contentLength``, ``transferSha256``,
+            ``transferLength`` and ``parts`` of the blob artifact request.
+
+    """
+    transfer_hash = hashlib.sha256()
+    parts = []
+    with open(path, "rb") as fh:
+        while True:
+            part_hash = hashlib.sha256()
+            part_length = 0
+            while part_length < part_size:
+                chunk = fh.read(min(_CHUNK_SIZE, part_size - part_length))
+                if not chunk:
+                    break
+                part_hash.update(chunk)
+                transfer_hash.update(chunk)
+                part_length += len(chunk)
+            if not part_length:
+                break
+            parts.append({'sha256': part_hash.hexdigest(), 'size': part_length})
+    info = {
+        'transferSha256': transfer_hash.hexdigest(),
+        'transferLength': sum([part['size'] for part in parts]),
+        'parts': parts,
+    }
+    if content_encoding == 'gzip':
+        content_hash = hashlib.sha256()
+        content_length = 0
+        with gzip.open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(_CHUNK_SIZE), b''):
+                content_hash.update(chunk)
+                content_length += len(chunk)
+        info['contentSha256'] = content_hash.hexdigest()
+        info['contentLength'] = content_length
+    else:
+        info['contentSha256'] = info['transferSha256']
+        info['contentLength'] = info['transferLength']
+    return info
+
+
 def _craft_artifact_put_headers(content_type, encoding=None):
     log.debug('{} {}'.format(content_type, encoding))
     headers = {
@@ -266,12 +761,16 @@ def get_expiration_arrow(context):
 
 # download_artifacts {{{1
 async def download_artifacts(context, file_urls, parent_dir=None, session=None,
-                             download_func=download_file, valid_artifact_task_ids=None):
+                             download_func=download_file, valid_artifact_task_ids=None,
+                             expected_digests=None, fail_fast=True):
     """Download artifacts in parallel after validating their URLs.
 
     Valid ``taskId``s for download include the task's dependencies and the
     ``taskGroupId``, which by convention is the ``taskId`` of the decision task.
 
+    By default, the first failed download cancels the rest, and removes their
+    partial ``.part`` files.
+
     Args:
         context (scriptworker.context.Context): the scriptworker context.
         file_urls (list): the list of artifact urls to download.
@@ -284,6 +783,11 @@ async def download_artifacts(context, file_urls, parent_dir=None, session=None,
         valid_artifact_task_ids (list, optional): the list of task ids that are
             valid to download from.  If None, defaults to all task dependencies
             plus the decision taskId.  Defaults to None.
+        expected_digests (dict, optional): maps file urls to dicts of hash
+            algorithms to expected hexdigests.  These files are hashed as they
+            download, and a mismatch isn't retried.  Defaults to None.
+        fail_fast (bool, optional): if False, finish every download and log
+            every error before raising.  Defaults to True.
 
     Returns:
         list: the full paths to the files downloaded
@@ -291,13 +795,18 @@ async def download_artifacts(context, file_urls, parent_dir=None, session=None,
     Raises:
         scriptworker.exceptions.DownloadError: on download failure after
             max retries.
+        scriptworker.exceptions.CoTError: if a file doesn't match its
+            ``expected_digests``.
 
     """
     parent_dir = parent_dir or context.config['work_dir']
     session = session or context.session
+    expected_digests = expected_digests or {}
 
     tasks = []
     files = []
+    to_cache = []
+    cache = get_artifact_cache(context)
     valid_artifact_rules = context.config['valid_artifact_rules']
     # XXX when chain of trust is on everywhere, hardcode the chain of trust task list
     valid_artifact_task_ids = valid_artifact_task_ids or list(context.task['dependencies'] + [get_decision_task_id(context.task)])
@@ -305,19 +814,83 @@ async def download_artifacts(context, file_urls, parent_dir=None, session=None,
         rel_path = validate_artifact_url(valid_artifact_rules, valid_artifact_task_ids, file_url)
         abs_file_path = os.path.join(parent_dir, rel_path)
         files.append(abs_file_path)
+        sha256 = expected_digests.get(file_url, {}).get('sha256')
+        if cache is not None and sha256:
+            to_cache.append((abs_file_path, sha256))
         tasks.append(
             asyncio.ensure_future(
-                retry_async(
-                    download_func, args=(context, file_url, abs_file_path),
-                    kwargs={'session': session},
+                download_artifact(
+                    context, file_url, abs_file_path, session=session,
+                    download_func=download_func, expected_digests=expected_digests.get(file_url),
                 )
             )
         )
 
-    await raise_future_exceptions(tasks)
+    downloaded = await gather_fail_fast(
+        tasks, cleanup_paths=["{}.part".format(path) for path in files], fail_fast=fail_fast
+    )
+    if cache is not None:
+        log.info(cache.format_stats())
+        # We only look artifacts up by sha256, so only cache the ones we know
+        # the sha256 of, and only once all of the downloads are done.
+        to_cache = [artifact for artifact, was_downloaded in zip(to_cache, downloaded) if was_downloaded]
+        if to_cache:
+            cache.add_in_background(context, to_cache)
     return files
 
 
+# download_artifact {{{1
+async def download_artifact(context, url, abs_file_path, session=None, download_func=download_file,
+                            expected_digests=None):
+    """Download an artifact through the artifact cache, retrying on failure.
+
+    If ``artifact_cache_dir`` is set and we know the artifact's sha256, copy
+    the artifact from the cache if it's there, and check it against
+    ``expected_digests`` again.  ``download_artifacts`` adds the artifacts we
+    download to the cache.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+        url (str): the artifact url.
+        abs_file_path (str): the path to download to.
+        session (aiohttp.ClientSession, optional): the session to use to
+            download.  Defaults to None.
+        download_func (function, optional): the function to call to download
+            the file.  Defaults to ``download_file``.
+        expected_digests (dict, optional): hash algorithms to the expected
+            hexdigests of the artifact.  Defaults to None.
+
+    Returns:
+        bool: True if we downloaded the artifact; False if we copied it from
+            the cache.
+
+    Raises:
+        scriptworker.exceptions.DownloadError: on download failure after
+            max retries.
+        scriptworker.exceptions.CoTError: if the artifact doesn't match its
+            ``expected_digests``.
+
+    """
+    cache = get_artifact_cache(context)
+    sha256 = (expected_digests or {}).get('sha256')
+    if cache is not None:
+        if sha256 and await run_in_executor(
+            context, cache.materialize, sha256, abs_file_path, expected_digests=expected_digests
+        ):
+            cache.hits += 1
+            log.info("Copied {} from the artifact cache.".format(url))
+            return False
+        cache.misses += 1
+    kwargs = {'session': session}
+    if expected_digests:
+        kwargs['expected_digests'] = expected_digests
+    await retry_async(
+        download_func, args=(context, url, abs_file_path),
+        kwargs=kwargs, retry_exceptions=_DOWNLOAD_RETRY_EXCEPTIONS,
+    )
+    return True
+
+
 def get_upstream_artifacts_full_paths_per_task_id(context):
     """List the downloaded upstream artifacts.
 
@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+"""Scriptworker host-wide caches.
+
+Several tasks often download the same upstream artifacts, and ``cleanup``
+removes ``work_dir`` between tasks.  The ``ArtifactCache`` keeps copies of
+the artifacts we download with a known sha256 in ``artifact_cache_dir``,
+which every scriptworker on the host can share, and copies them back into
+``work_dir`` instead of downloading them again.
+
+The cache layout is::
+
+    artifact_cache_dir/
+        content/<sha256[:2]>/<sha256>   the artifacts, by sha256, read-only
+        tmp/                            files being added to the cache
+        lock                            held while updating size or evicting
+        size                            the total size of content/, in bytes
+
+We only look artifacts up by the sha256 the chain of trust expects.  An
+artifact url points at the latest run of the task, so a rerun can change
+what it serves.
+
+Task definitions don't change either, so the ``TaskDefinitionCache`` keeps
+the task definitions we fetch from the queue until the tasks expire, in
+memory and optionally in ``task_definition_cache_dir``.
+
+The ``CoTVerificationCache`` keeps the chain of trust bodies we've verified
+in ``cot_verification_cache_dir``, so we only verify each signed artifact
+once per gpg homedir revision.
+
+Attributes:
+    log (logging.Logger): the log object for this module.
+    FICLONE (int): the Linux ioctl to reflink a file.
+
+"""
+import arrow
+import asyncio
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import deepcopy
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from scriptworker.utils import get_hash, makedirs, rm, run_in_executor
+from scriptworker.version import __version_string__
+
+log = logging.getLogger(__name__)
+
+FICLONE = 0x40049409
+
+
+# ArtifactCache {{{1
+class ArtifactCache(object):
+    """A content-addressed artifact cache, shared between processes.
+
+    Attributes:
+        hits (int): the number of artifacts we copied from the cache.
+        max_size (int): evict the least recently used artifacts when the
+            cache is larger than this, in bytes.
+        misses (int): the number of artifacts we didn't find in the cache.
+        path (str): the cache directory.
+        pending_adds (set): the futures of the ``add_in_background`` calls
+            that haven't finished.
+
+    """
+
+    def __init__(self, path, max_size):
+        """Initialize ArtifactCache.
+
+        Args:
+            path (str): the cache directory.
+            max_size (int): the maximum cache size, in bytes.
+
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.pending_adds = set()
+
+    def get_content_path(self, sha256):
+        """Get the path of the artifact with this sha256 in the cache.
+
+        Args:
+            sha256 (str): the sha256 hexdigest of the artifact.
+
+        Returns:
+            str: the path.
+
+        """
+        return os.path.join(self.path, 'content', sha256[:2], sha256)
+
+    def materialize(self, sha256, dest, expected_digests=None):
+        """Copy the artifact with this sha256 from the cache to ``dest``.
+
+        Reflink if the filesystem supports it; otherwise copy.  ``dest``
+        never shares an inode with the cache entry, so the task can't modify
+        the cache through it.  This marks the artifact as recently used.
+
+        Args:
+            sha256 (str): the sha256 hexdigest of the artifact.
+            dest (str): the path to copy to.
+            expected_digests (dict, optional): hash algorithms to the expected
+                hexdigests of the artifact.  If set, we hash ``dest``, and
+                remove both ``dest`` and the cache entry if they don't match.
+                Defaults to None.
+
+        Returns:
+            bool: True if we copied the artifact; False if it isn't cached,
+                or doesn't match ``expected_digests``.
+
+        """
+        src = self.get_content_path(sha256)
+        makedirs(os.path.dirname(dest))
+        rm(dest)
+        try:
+            _copy_file(src, dest)
+        except FileNotFoundError:
+            return False
+        for alg, expected in sorted((expected_digests or {}).items()):
+            digest = get_hash(dest, hash_alg=alg)
+            if digest != expected:
+                log.warning("Artifact cache entry {} has {} {}, not {}; removing it.".format(
+                    src, alg, digest, expected
+                ))
+                rm(dest)
+                rm(src)
+                return False
+        try:
+            os.utime(src)
+        except FileNotFoundError:
+            # Evicted since we copied it; our copy is still good.
+            pass
+        return True
+
+    def add(self, path, sha256=None):
+        """Copy the artifact at ``path`` into the cache, then evict if we're too big.
+
+        The cache entry is a read-only reflink or copy of ``path``, so later
+        writes to ``path`` don't change it, and ``path`` keeps its mode.
+
+        Args:
+            path (str): the path of the downloaded artifact.
+            sha256 (str, optional): the sha256 hexdigest of the artifact.  If
+                None, hash the artifact.  Defaults to None.
+
+        Returns:
+            str: the sha256 hexdigest of the artifact.
+
+        """
+        sha256 = sha256 or get_hash(path, hash_alg='sha256')
+        content_path = self.get_content_path(sha256)
+        if os.path.exists(content_path):
+            os.utime(content_path)
+        else:
+            tmp_path = self._get_tmp_path()
+            try:
+                _copy_file(path, tmp_path)
+                os.chmod(tmp_path, 0o444)
+                size = os.path.getsize(tmp_path)
+                makedirs(os.path.dirname(content_path))
+                os.replace(tmp_path, content_path)
+            finally:
+                rm(tmp_path)
+            self._add_size(size)
+        return sha256
+
+    def add_in_background(self, context, artifacts):
+        """Copy downloaded artifacts into the cache, without waiting for the copies.
+
+        Copying an artifact into the cache is as expensive as writing it
+        again unless the filesystem supports reflinks, so
+        ``download_artifacts`` calls this after all of its downloads finish,
+        and the task doesn't wait for the copies.  An artifact that's gone by
+        the time we copy it, e.g. because ``cleanup`` removed ``work_dir``,
+        isn't added.
+
+        Args:
+            context (scriptworker.context.Context): the scriptworker context.
+            artifacts (list): the ``(path, sha256)`` tuples of the artifacts.
+
+        Returns:
+            asyncio.Future: the future that copies the artifacts in.
+
+        """
+        future = asyncio.ensure_future(self._add_all(context, artifacts))
+        self.pending_adds.add(future)
+        future.add_done_callback(self.pending_adds.discard)
+        return future
+
+    async def _add_all(self, context, artifacts):
+        for path, sha256 in artifacts:
+            try:
+                await run_in_executor(context, self.add, path, sha256=sha256)
+            except OSError as exc:
+                log.warning("Can't add {} to the artifact cache: {}".format(path, exc))
+
+    def _get_tmp_path(self):
+        tmp_dir = os.path.join(self.path, 'tmp')
+        makedirs(tmp_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        os.close(fd)
+        os.remove(tmp_path)
+        return tmp_path
+
+    @contextmanager
+    def _lock(self):
+        makedirs(self.path)
+        with open(os.path.join(self.path, 'lock'), 'a') as lock_fh:
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fh.fileno(), fcntl.LOCK_UN)
+
+    def _read_size(self):
+        try:
+            with open(os.path.join(self.path, 'size'), 'r') as fh:
+                return int(json.load(fh)['size'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _add_size(self, size):
+        """Add ``size`` bytes to the recorded cache size, and evict if it's over ``max_size``.
+
+        We only walk the cache when it's over ``max_size``, or we don't have a
+        recorded size yet.  The recorded size can drift, e.g. when two
+        processes add the same artifact at once, or a process dies between
+        adding an artifact and recording its size; the next walk corrects it.
+
+        Args:
+            size (int): the size of the artifact we added, in bytes.
+
+        Returns:
+            list: the sha256 hexdigests of the evicted artifacts.
+
+        """
+        with self._lock():
+            total = self._read_size()
+            if total is not None:
+                total += size
+                if total <= self.max_size:
+                    _write_json_atomically(os.path.join(self.path, 'size'), {'size': total})
+                    return []
+            return self._evict()
+
+    def evict(self):
+        """Remove the least recently used artifacts until the cache fits in ``max_size``.
+
+        This walks the whole cache and rewrites the recorded size, holding an
+        exclusive lock, so only one process evicts at a time.
+
+        Returns:
+            list: the sha256 hexdigests of the evicted artifacts.
+
+        """
+        with self._lock():
+            return self._evict()
+
+    def _evict(self):
+        evicted = []
+        entries = []
+        for root, _, filenames in os.walk(os.path.join(self.path, 'content')):
+            for filename in filenames:
+                try:
+                    stat = os.stat(os.path.join(root, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum([size for _, size, _ in entries])
+        for _, size, sha256 in sorted(entries):
+            if total <= self.max_size:
+                break
+            rm(self.get_content_path(sha256))
+            total -= size
+            evicted.append(sha256)
+        _write_json_atomically(os.path.join(self.path, 'size'), {'size': total})
+        if evicted:
+            log.info("Evicted {} artifact(s) from the artifact cache.".format(len(evicted)))
+        return evicted
+
+    def format_stats(self):
+        """Format the cache statistics for the log.
+
+        Returns:
+            str: the formatted cache statistics.
+
+        """
+        return "Artifact cache: hits={} misses={}".format(self.hits, self.misses)
+
+
+def _copy_file(src, dest):
+    """Reflink ``src`` to ``dest``; fall back to a copy."""
+    with open(src, 'rb') as src_fh, open(dest, 'wb') as dest_fh:
+        try:
+            fcntl.ioctl(dest_fh.fileno(), FICLONE, src_fh.fileno())
+        except OSError:
+            # e.g. across filesystems, or on filesystems without reflinks
+            shutil.copyfileobj(src_fh, dest_fh, 1024 * 1024)
+
+
+# get_artifact_cache {{{1
+def get_artifact_cache(context):
+    """Get the ``ArtifactCache`` for ``context``, creating it if needed.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        ArtifactCache: the artifact cache, or None if ``artifact_cache_dir``
+            isn't set.
+
+    """
+    if not context.config['artifact_cache_dir']:
+        return None
+    if context.artifact_cache is None:
+        context.artifact_cache = ArtifactCache(
+            context.config['artifact_cache_dir'], context.config['artifact_cache_max_size']
+        )
+    return context.artifact_cache
+
+
+# TaskDefinitionCache {{{1
+class TaskDefinitionCache(object):
+    """Cache task definitions until the tasks expire.
+
+    Task definitions live in memory, up to ``max_memory_entries`` of the
+    most recently used, and in ``task_definition_cache_dir`` if it's set, so
+    other scriptworkers on the host can use them.  Task definitions without
+    ``expires`` aren't cached.
+
+    Attributes:
+        context (scriptworker.context.Context): the scriptworker context.
+        hits (int): the number of task definitions we found in the cache.
+        max_memory_entries (int): the number of task definitions to keep in
+            memory.
+        misses (int): the number of task definitions we fetched from the queue.
+        path (str): the cache directory, or None to cache in memory only.
+
+    """
+
+    def __init__(self, context, max_memory_entries=1000):
+        """Initialize TaskDefinitionCache.
+
+        Args:
+            context (scriptworker.context.Context): the scriptworker context.
+            max_memory_entries (int, optional): the number of task definitions
+                to keep in memory.  Defaults to 1000.
+
+        """
+        self.context = context
+        self.path = context.config['task_definition_cache_dir']
+        self.max_memory_entries = max_memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+
+    def get_path(self, task_id):
+        """Get the path of the cached task definition for ``task_id``.
+
+        Args:
+            task_id (str): the taskId.
+
+        Returns:
+            str: the path.
+
+        """
+        return os.path.join(self.path, task_id[:2], "{}.json".format(task_id))
+
+    async def get(self, task_id):
+        """Get the task definition for ``task_id``, from the cache if possible.
+
+        Args:
+            task_id (str): the taskId.
+
+        Returns:
+            dict: a copy of the task definition.
+
+        Raises:
+            taskcluster.exceptions.TaskclusterFailure: on queue failure.
+
+        """
+        task_defn = self._memory.get(task_id)
+        if task_defn is None and self.path:
+            task_defn = await run_in_executor(self.context, self._read, task_id)
+        if task_defn is not None and not is_expired(task_defn):
+            self.hits += 1
+            self._remember(task_id, task_defn)
+            return deepcopy(task_defn)
+        self._memory.pop(task_id, None)
+        self.misses += 1
+        task_defn = await self.context.queue.task(task_id)
+        if task_defn.get('expires'):
+            self._remember(task_id, task_defn)
+            if self.path:
+                await run_in_executor(self.context, self._write, task_id, task_defn)
+        return deepcopy(task_defn)
+
+    def _remember(self, task_id, task_defn):
+        self._memory[task_id] = task_defn
+        self._memory.move_to_end(task_id)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _read(self, task_id):
+        path = self.get_path(task_id)
+        try:
+            with open(path, "r") as fh:
+                task_defn = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if is_expired(task_defn):
+            rm(path)
+            return None
+        return task_defn
+
+    def _write(self, task_id, task_defn):
+        _write_json_atomically(self.get_path(task_id), task_defn)
+
+    def format_stats(self):
+        """Format the cache statistics for the log.
+
+        Returns:
+            str: the formatted cache statistics.
+
+        """
+        return "Task definition cache: hits={} misses={}".format(self.hits, self.misses)
+
+
+def _write_json_atomically(path, contents):
+    """Write json to ``path`` so concurrent readers never see a partial file."""
+    makedirs(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "w") as fh:
+        json.dump(contents, fh, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+# is_expired {{{1
+def is_expired(task_defn):
+    """Check whether a task has expired, or doesn't say when it expires.
+
+    Args:
+        task_defn (dict): the task definition.
+
+    Returns:
+        bool: True if the task has expired or has no ``expires``.
+
+    """
+    if not task_defn.get('expires'):
+        return True
+    return arrow.get(task_defn['expires']) <= arrow.utcnow()
+
+
+# get_task_definition_cache {{{1
+def get_task_definition_cache(context):
+    """Get the ``TaskDefinitionCache`` for ``context``, creating it if needed.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        TaskDefinitionCache: the task definition cache.
+
+    """
+    if context.task_definition_cache is None:
+        context.task_definition_cache = TaskDefinitionCache(context)
+    return context.task_definition_cache
+
+
+# CoTVerificationCache {{{1
+class CoTVerificationCache(object):
+    """Cache verified chain of trust bodies in ``cot_verification_cache_dir``.
+
+    Entries are keyed by the sha256 of the signed artifact, the git revision
+    recorded in the gpg homedirs in use, the ``worker_impl`` gpg homedir,
+    whether we verified the signature, and the scriptworker version.
+    ``scriptworker.worker.async_main`` clears the cache when it swaps rebuilt
+    gpg homedirs in, after the running tasks drain.
+
+    Attributes:
+        hits (int): the number of verifications we skipped.
+        misses (int): the number of artifacts we had to verify.
+        path (str): the cache directory.
+
+    """
+
+    def __init__(self, path):
+        """Initialize CoTVerificationCache.
+
+        Args:
+            path (str): the cache directory.
+
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, signed_data, gpg_revision, worker_impl, verify_sig):
+        """Get the cache key for a signed chain of trust artifact.
+
+        Args:
+            signed_data (str): the ascii armored signed artifact.
+            gpg_revision (str): the git revision recorded in the gpg homedirs in use.
+            worker_impl (str): the worker implementation whose gpg homedir
+                verifies the artifact.
+            verify_sig (bool): whether we verify the signature.
+
+        Returns:
+            str: the cache key.
+
+        """
+        parts = [
+            hashlib.sha256(signed_data.encode('utf-8')).hexdigest(),
+            gpg_revision, worker_impl, verify_sig, __version_string__,
+        ]
+        return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        """Get the path of the cache entry for ``key``.
+
+        Args:
+            key (str): the cache key.
+
+        Returns:
+            str: the path.
+
+        """
+        return os.path.join(self.path, key[:2], "{}.json".format(key))
+
+    def get(self, key):
+        """Get the verified chain of trust body for ``key``.
+
+        Args:
+            key (str): the cache key.
+
+        Returns:
+            dict: the chain of trust body, or None on a cache miss.
+
+        """
+        try:
+            with open(self.get_path(key), "r") as fh:
+                cot = json.load(fh)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cot
+
+    def add(self, key, cot):
+        """Add a verified chain of trust body to the cache.
+
+        Args:
+            key (str): the cache key.
+            cot (dict): the verified chain of trust body.
+
+        """
+        _write_json_atomically(self.get_path(key), cot)
+
+    def format_stats(self):
+        """Format the cache statistics for the log.
+
+        Returns:
+            str: the formatted cache statistics.
+
+        """
+        return "Chain of trust verification cache: hits={} misses={}".format(self.hits, self.misses)
+
+
+# get_cot_verification_cache {{{1
+def get_cot_verification_cache(context):
+    """Get the ``CoTVerificationCache`` for ``context``, creating it if needed.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        CoTVerificationCache: the cache, or None if
+            ``cot_verification_cache_dir`` isn't set.
+
+    """
+    if not context.config['cot_verification_cache_dir']:
+        return None
+    if context.cot_verification_cache is None:
+        context.cot_verification_cache = CoTVerificationCache(context.config['cot_verification_cache_dir'])
+    return context.cot_verification_cache
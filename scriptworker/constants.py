@@ -42,8 +42,14 @@ DEFAULT_CONFIG = frozendict({
     # intervals are expressed in seconds
     "artifact_expiration_hours": 24,
     "task_max_timeout": 60 * 20,
+    # reclaim_margin is how long before takenUntil we reclaim the task.
+    # reclaim_interval is only used if we don't know takenUntil.
     "reclaim_interval": 300,
+    "reclaim_margin": 180,
+    # poll_interval is the max delay between claimWork calls; the delay starts
+    # at min_poll_interval and backs off while the queue has no tasks for us.
     "poll_interval": 5,
+    "min_poll_interval": 1.0,
     "sign_key_timeout": 60 * 2,
 
     "task_script": ("bash", "-c", "echo foo && sleep 19 && exit 1"),
@@ -58,6 +64,60 @@ DEFAULT_CONFIG = frozendict({
     "git_commit_signing_pubkey_dir": "...",
     "artifact_upload_timeout": 60 * 20,
     "aiohttp_max_connections": 15,
+    # upload_artifacts compresses, calls createArtifact for, and PUTs at most
+    # this many artifacts at a time, largest first.  Keep the last two under
+    # aiohttp_max_connections.
+    "upload_max_concurrent_compressions": 4,
+    "upload_max_concurrent_create_artifacts": 5,
+    "upload_max_concurrent_puts": 8,
+    # How often to log the upload queue depths, in seconds.
+    "upload_report_interval": 30,
+    # Upload artifacts larger than this many bytes in parts, with the queue's
+    # blob storage type.  Each part is retried on its own.  None disables
+    # multipart uploads.
+    "artifact_multipart_upload_threshold": None,
+    "artifact_upload_part_size": 100 * 1024 * 1024,
+    "artifact_upload_max_concurrent_parts": 4,
+    # Copy uploads from disk to plain tcp sockets with os.sendfile.  tls
+    # uploads, and platforms without os.sendfile, use buffered writes.
+    "artifact_upload_sendfile": True,
+    # The largest read size when downloading artifacts.
+    "download_max_chunk_size": 4 * 1024 * 1024,
+    # Download files of at least download_segment_threshold bytes in
+    # download_segments parallel byte ranges.  1 segment turns this off.
+    "download_segments": 1,
+    "download_segment_threshold": 64 * 1024 * 1024,
+    # If set, keep downloaded artifacts in this directory, which scriptworkers
+    # on the same host can share, and evict the least recently used ones
+    # when it's bigger than artifact_cache_max_size bytes.
+    "artifact_cache_dir": None,
+    "artifact_cache_max_size": 10 * 1024 * 1024 * 1024,
+    # If set, keep the task definitions we fetch for the chain of trust in
+    # this directory until the tasks expire.
+    "task_definition_cache_dir": None,
+    # If set, keep the chain of trust bodies we've verified in this directory,
+    # so we don't verify the same signed artifact again.
+    "cot_verification_cache_dir": None,
+    # The number of tasks to run in parallel.  Each task slot gets its own
+    # work_dir, artifact_dir, and task_log_dir subdirectory.
+    "max_concurrent_tasks": 1,
+    # Upload artifacts and report status of a task in the background, and
+    # claim the next task as soon as the task script exits.  This uses two
+    # sets of task directories per task slot.
+    "pipeline_tasks": False,
+    # Run the reclaimTask heartbeats and task status reports on their own
+    # thread and event loop, so blocking work can't delay them.
+    "control_plane_thread": True,
+    # Blocking work (hashing, compression, gpg, json and file i/o) runs in
+    # this thread pool, so it doesn't block the event loop.  0 threads runs
+    # the blocking work in the event loop.
+    "executor_max_threads": 4,
+    # Sample the event loop lag while each task runs, and write the stacks
+    # of calls that block the event loop for more than loop_lag_threshold
+    # seconds to task_log_dir/loop_lag.log.
+    "loop_lag_monitor": False,
+    "loop_lag_threshold": 0.25,
+    "loop_lag_sample_interval": 0.05,
 
     # chain of trust settings
     "sign_chain_of_trust": True,
@@ -65,6 +125,8 @@ DEFAULT_CONFIG = frozendict({
     "verify_cot_signature": False,
     "cot_job_type": "unknown",  # e.g., signing
     "cot_product": "firefox",
+    # The number of task definitions to fetch at once when building the chain.
+    "cot_max_concurrent_task_fetches": 10,
 
     # Specify a default gpg home other than ~/.gnupg
     "gpg_home": None,
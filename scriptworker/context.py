@@ -10,12 +10,16 @@ Attributes:
 
 """
 import arrow
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from frozendict import frozendict
 import json
 import logging
 import os
 
-from scriptworker.utils import makedirs
+from scriptworker.cache import get_artifact_cache, get_cot_verification_cache, get_task_definition_cache
+from scriptworker.cot.task_graph import get_task_graph_store
+from scriptworker.utils import RunningStats, makedirs
 from taskcluster.async import Queue
 
 log = logging.getLogger(__name__)
@@ -28,31 +32,77 @@ class Context(object):
     passing around config and easier overriding in tests.
 
     Attributes:
+        artifact_cache (scriptworker.cache.ArtifactCache): the artifact
+            cache, if ``artifact_cache_dir`` is set.
+        claim_work_poller (scriptworker.worker.ClaimWorkPoller): the claimWork
+            poller, with the claim statistics.
         config (dict): the running config.  In production this will be a
             FrozenDict.
+        cot_verification_cache (scriptworker.cache.CoTVerificationCache): the
+            cache of verified chain of trust bodies, if
+            ``cot_verification_cache_dir`` is set.
+        control_plane (scriptworker.control.ControlPlane): the control plane
+            that runs the reclaimTask and status report calls, if
+            ``control_plane_thread`` is on.
         credentials_timestamp (int): the unix timestamp when we last updated
             our credentials.
+        executors (dict): the executor pools for blocking work, by executor
+            type.  Task contexts share these with the worker context.
+        finish_future (asyncio.Future): in ``pipeline_tasks`` mode, the future
+            uploading the artifacts and reporting the status of the task in
+            this context, if any.
+        heartbeat_delay (scriptworker.utils.RunningStats): how late each
+            reclaimTask heartbeat woke up, in seconds.
+        heartbeat_slack (scriptworker.utils.RunningStats): the time left on
+            the claim, in seconds, each time we reclaim the current task.
+        loop_lag_monitor (scriptworker.monitor.LoopLagMonitor): the event
+            loop lag monitor for the current task, if ``loop_lag_monitor``
+            is on.
         proc (asyncio.subprocess.Process): when launching the script, this is
             the process object.
         queue (taskcluster.async.Queue): the taskcluster Queue object
             containing the scriptworker credentials.
         session (aiohttp.ClientSession): the default aiohttp session
+        slot_id (int): the task slot this context runs tasks in, or None for
+            the top level worker context.
         task (dict): the task definition for the current task.
+        task_contexts (list): the per-slot task contexts, if this is the top
+            level worker context.
+        task_definition_cache (scriptworker.cache.TaskDefinitionCache): the
+            cache of task definitions for the chain of trust.
+        task_future (asyncio.Future): the future running the current task in
+            this context, if any.
+        task_graph_store (scriptworker.cot.task_graph.TaskGraphStore): the
+            decision task graphs shared by the chains of trust.
         temp_queue (taskcluster.async.Queue): the taskcluster Queue object
             containing the task-specific temporary credentials.
 
     """
 
+    artifact_cache = None
+    claim_work_poller = None
     config = None
+    control_plane = None
+    cot_verification_cache = None
     credentials_timestamp = None
+    executors = None
+    finish_future = None
+    heartbeat_delay = None
+    heartbeat_slack = None
+    loop_lag_monitor = None
     proc = None
     queue = None
     session = None
+    slot_id = None
     task = None
+    task_contexts = None
+    task_definition_cache = None
+    task_future = None
+    task_graph_store = None
     temp_queue = None
     _credentials = None
-    _claim_task = None  # This assumes a single task per worker.
-    _temp_credentials = None  # This assumes a single task per worker.
+    _claim_task = None  # This assumes a single task per context.
+    _temp_credentials = None  # This assumes a single task per context.
     _reclaim_task = None
 
     @property
@@ -63,8 +113,9 @@ class Context(object):
         info.
 
         When setting ``claim_task``, we also set ``self.task`` and
-        ``self.temp_credentials``, zero out ``self.reclaim_task`` and ``self.proc``,
-        then write a task.json to disk.
+        ``self.temp_credentials``, zero out ``self.reclaim_task``, ``self.proc``,
+        ``self.heartbeat_delay``, and ``self.heartbeat_slack``, then write a
+        task.json to disk.
 
         """
         return self._claim_task
@@ -74,6 +125,8 @@ class Context(object):
         self._claim_task = claim_task
         self.reclaim_task = None
         self.proc = None
+        self.heartbeat_delay = RunningStats()
+        self.heartbeat_slack = RunningStats()
         if claim_task:
             self.task = claim_task['task']
             self.temp_credentials = claim_task['credentials']
@@ -114,6 +167,78 @@ class Context(object):
                 'credentials': credentials,
             }, session=self.session)
 
+    def create_task_context(self, slot_id):
+        """Create a per-task Context for task slot ``slot_id``.
+
+        The new context shares ``config``, ``session``, ``credentials``,
+        ``queue``, ``control_plane``, ``executors``, and the caches with this
+        context, but gets its own ``work_dir``, ``artifact_dir``, and
+        ``task_log_dir``, and tracks its own ``claim_task``, ``temp_queue``,
+        and ``proc``.
+
+        Args:
+            slot_id (int): the task slot number.
+
+        Returns:
+            Context: the task context.
+
+        """
+        task_context = Context()
+        task_context.slot_id = slot_id
+        task_context.config = get_slot_config(self.config, slot_id)
+        task_context.session = self.session
+        task_context._credentials = self._credentials
+        task_context.queue = self.queue
+        task_context.credentials_timestamp = self.credentials_timestamp
+        task_context.control_plane = self.control_plane
+        task_context.artifact_cache = get_artifact_cache(self)
+        task_context.task_definition_cache = get_task_definition_cache(self)
+        task_context.cot_verification_cache = get_cot_verification_cache(self)
+        task_context.task_graph_store = get_task_graph_store(self)
+        if self.executors is None:
+            self.executors = {}
+        task_context.executors = self.executors
+        return task_context
+
+    def get_executor(self):
+        """Get the thread pool for blocking work, creating it if needed.
+
+        The pool has ``executor_max_threads`` workers.  If
+        ``executor_max_threads`` is 0, there is no pool.
+
+        We don't use a process pool: hashlib and zlib release the GIL on large
+        buffers, and forking while the control plane and loop lag watchdog
+        threads run risks deadlocks in the children.
+
+        Returns:
+            concurrent.futures.Executor: the pool, or None if there is no pool.
+
+        """
+        if self.executors is None:
+            self.executors = {}
+        if "thread" not in self.executors:
+            if self.config['executor_max_threads']:
+                self.executors["thread"] = ThreadPoolExecutor(
+                    max_workers=self.config['executor_max_threads']
+                )
+            else:
+                self.executors["thread"] = None
+        return self.executors["thread"]
+
+    def shutdown_executors(self, wait=True):
+        """Shut down the executor pools.
+
+        Args:
+            wait (bool, optional): wait for pending work to finish.  Defaults
+                to True.
+
+        """
+        for executor in (self.executors or {}).values():
+            if executor is not None:
+                executor.shutdown(wait=wait)
+        if self.executors is not None:
+            self.executors.clear()
+
     @property
     def reclaim_task(self):
         """dict: The most recent reclaimTask definition.
@@ -163,3 +288,38 @@ class Context(object):
         makedirs(os.path.dirname(path))
         with open(path, "w") as fh:
             json.dump(contents, fh, indent=2, sort_keys=True)
+
+
+# get_slot_config {{{1
+def get_slot_config(config, slot_id):
+    """Get a copy of ``config`` with per-slot ``work_dir``, ``artifact_dir``, and ``task_log_dir``.
+
+    Each slot's directories live in a ``slot_id`` subdirectory of the configured
+    directories.  ``task_log_dir`` keeps its path relative to ``artifact_dir``,
+    so the log artifacts keep the same relative path in taskcluster.
+
+    Args:
+        config (dict): the running config.
+        slot_id (int): the task slot number.
+
+    Returns:
+        dict: the slot config.  This is a ``frozendict`` if ``config`` is one.
+
+    """
+    slot_name = str(slot_id)
+    artifact_dir = config['artifact_dir']
+    slot_artifact_dir = os.path.join(artifact_dir, slot_name)
+    task_log_dir = config['task_log_dir']
+    if task_log_dir.startswith(os.path.join(artifact_dir, '')):
+        slot_task_log_dir = os.path.join(slot_artifact_dir, os.path.relpath(task_log_dir, artifact_dir))
+    else:
+        slot_task_log_dir = os.path.join(task_log_dir, slot_name)
+    slot_config = dict(config)
+    slot_config.update({
+        'work_dir': os.path.join(config['work_dir'], slot_name),
+        'artifact_dir': slot_artifact_dir,
+        'task_log_dir': slot_task_log_dir,
+    })
+    if isinstance(config, frozendict):
+        slot_config = frozendict(slot_config)
+    return slot_config
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""Scriptworker control plane.
+
+The reclaimTask heartbeats and the task status reports need to go out on
+time, even while the main event loop is busy hashing, compressing, or
+removing files.  The ``ControlPlane`` runs these calls on their own event
+loop, in a separate thread, with their own aiohttp session.
+
+Attributes:
+    log (logging.Logger): the log object for the module.
+
+"""
+import aiohttp
+import asyncio
+import logging
+import threading
+import time
+
+from scriptworker.utils import RunningStats
+from taskcluster.async import Queue
+
+log = logging.getLogger(__name__)
+
+
+# ControlPlane {{{1
+class ControlPlane(object):
+    """Run taskcluster control-plane calls on a dedicated thread and event loop.
+
+    Attributes:
+        context (scriptworker.context.Context): the scriptworker context.
+        dispatch_delay (RunningStats): the time between submitting a
+            coroutine and the control plane loop starting it, in seconds.
+        loop (asyncio.AbstractEventLoop): the control plane event loop, while
+            running.
+        session (aiohttp.ClientSession): the control plane aiohttp session,
+            while running.
+        thread (threading.Thread): the control plane thread, while running.
+
+    """
+
+    def __init__(self, context):
+        """Initialize ControlPlane.
+
+        Args:
+            context (scriptworker.context.Context): the scriptworker context.
+
+        """
+        self.context = context
+        self.dispatch_delay = RunningStats()
+        self.loop = None
+        self.session = None
+        self.thread = None
+        self._ready = threading.Event()
+
+    def start(self):
+        """Start the control plane thread, and wait for its event loop to start."""
+        if self.thread is not None:
+            return
+        self._ready.clear()
+        self.thread = threading.Thread(target=self._run, name="control-plane", daemon=True)
+        self.thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        """Stop the control plane event loop, and wait for the thread to exit.
+
+        Any pending control plane coroutines are cancelled.
+
+        """
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+        log.info("Control plane stopped. {}".format(self.format_stats()))
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.session = aiohttp.ClientSession(loop=loop)
+        self.loop = loop
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            pending = asyncio.Task.all_tasks(loop=loop)
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, loop=loop, return_exceptions=True))
+            self.session.close()
+            loop.close()
+            self.session = None
+            self.loop = None
+
+    def is_current_thread(self):
+        """Check whether we're running in the control plane thread.
+
+        Returns:
+            bool: True if the current thread is the control plane thread.
+
+        """
+        return self.thread is not None and threading.current_thread() is self.thread
+
+    def create_queue(self, credentials):
+        """Create a taskcluster queue that uses the control plane session.
+
+        Only use this queue from the control plane thread.
+
+        Args:
+            credentials (dict): taskcluster credentials.
+
+        Returns:
+            taskcluster.async.Queue: the queue, or None if ``credentials`` is empty.
+
+        """
+        if credentials:
+            return Queue({
+                'credentials': credentials,
+            }, session=self.session)
+
+    async def _dispatch(self, coro, submitted):
+        self.dispatch_delay.add(time.time() - submitted)
+        return await coro
+
+    def submit(self, coro):
+        """Schedule ``coro`` on the control plane loop, without waiting for it.
+
+        Exceptions from ``coro`` are logged.
+
+        Args:
+            coro (coroutine): the coroutine to run.
+
+        Returns:
+            concurrent.futures.Future: the future for the result of ``coro``.
+
+        """
+        future = asyncio.run_coroutine_threadsafe(self._dispatch(coro, time.time()), self.loop)
+        future.add_done_callback(_log_future_exception)
+        return future
+
+    async def run(self, coro):
+        """Run ``coro`` on the control plane loop, and wait for its result.
+
+        Args:
+            coro (coroutine): the coroutine to run.
+
+        Returns:
+            the result of ``coro``.
+
+        Raises:
+            Exception: any exception ``coro`` raises.
+
+        """
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def format_stats(self):
+        """Format the control plane statistics for the log.
+
+        Returns:
+            str: the formatted control plane statistics.
+
+        """
+        return "Control plane dispatch delay: {}".format(self.dispatch_delay)
+
+
+def _log_future_exception(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error("Control plane exception: {}".format(future.exception()), exc_info=future.exception())
+
+
+# get_control_plane {{{1
+def get_control_plane(context):
+    """Get the running ``ControlPlane`` for ``context``, starting it if needed.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        ControlPlane: the control plane, or None if ``control_plane_thread``
+            is off.
+
+    """
+    if not context.config['control_plane_thread']:
+        return None
+    if context.control_plane is None:
+        context.control_plane = ControlPlane(context)
+    context.control_plane.start()
+    return context.control_plane
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""Chain of Trust decision task graphs.
+
+``public/task-graph.json`` files run to tens of megabytes, and every task
+spawned by a decision task verifies against the same file.  A ``TaskGraph``
+scans the file once for the offsets of each task's entry, without decoding
+the entries, keeps the json text, and decodes entries on demand.  The
+``TaskGraphStore`` shares ``TaskGraph``s between chains and concurrent
+tasks, by decision taskId and sha256.
+
+Attributes:
+    log (logging.Logger): the log object for this module.
+
+"""
+import asyncio
+from collections import OrderedDict
+from collections.abc import Mapping
+import json
+from json.decoder import WHITESPACE, scanstring
+import logging
+import re
+
+from scriptworker.utils import get_hash, run_in_executor
+
+log = logging.getLogger(__name__)
+
+_DECODER = json.JSONDecoder()
+_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_OTHER = r'[^"\[\]{}]*'
+# Skip strings, other values, and innermost bracketed groups, to the next
+# bracket that changes the nesting depth, and capture it.
+_NEXT_BRACKET = re.compile(
+    _OTHER + r'(?:(?:' + _STRING + r'|[\[{]' + _OTHER + r'(?:' + _STRING + _OTHER + r')*[\]}])' +
+    _OTHER + r')*([\[\]{}])'
+)
+
+
+# TaskGraph {{{1
+class TaskGraph(Mapping):
+    """A read-only, lazily decoded task graph, mapping taskIds to graph definitions.
+
+    Each lookup decodes a fresh copy of the entry, so callers can't modify
+    the shared graph.
+
+    Attributes:
+        fingerprint_index (dict): the task fingerprint index, for fuzzy
+            matching.  ``scriptworker.cot.verify`` builds this on first use.
+
+    """
+
+    def __init__(self, text):
+        """Initialize TaskGraph.
+
+        Args:
+            text (str): the task-graph.json contents.
+
+        Raises:
+            ValueError: if ``text`` isn't a json object.
+
+        """
+        self._text = text
+        self._offsets = index_json_object(text)
+        self.fingerprint_index = None
+
+    @classmethod
+    def from_path(cls, path):
+        """Read a task graph from a file.
+
+        Args:
+            path (str): the path to task-graph.json.
+
+        Returns:
+            TaskGraph: the task graph.
+
+        Raises:
+            OSError: if we can't read ``path``.
+            ValueError: if ``path`` isn't a json object.
+
+        """
+        with open(path, "r") as fh:
+            return cls(fh.read())
+
+    def __getitem__(self, task_id):
+        """Decode the graph definition of ``task_id``."""
+        start, end = self._offsets[task_id]
+        return json.loads(self._text[start:end])
+
+    def decode(self):
+        """Decode the whole graph in one pass.
+
+        This is cheaper than looking up every entry, e.g. to build the
+        fingerprint index.
+
+        Returns:
+            dict: a fresh copy of the task graph.
+
+        Raises:
+            ValueError: if an entry isn't valid json.
+
+        """
+        return json.loads(self._text)
+
+    def __contains__(self, task_id):
+        """Check whether ``task_id`` is in the graph, without decoding it."""
+        return task_id in self._offsets
+
+    def __iter__(self):
+        """Iterate over the taskIds in the graph."""
+        return iter(self._offsets)
+
+    def __len__(self):
+        """Get the number of tasks in the graph."""
+        return len(self._offsets)
+
+
+# index_json_object {{{1
+def index_json_object(text):
+    """Find where each value of a top level json object starts and ends.
+
+    This only checks the structure of the top level object.  Object and
+    array values are skipped by matching brackets outside of strings,
+    without decoding them, so ``json.loads`` of a value can still fail.
+
+    Args:
+        text (str): the json text.
+
+    Returns:
+        dict: maps each key to the ``(start, end)`` offsets of its value.
+
+    Raises:
+        ValueError: if ``text`` isn't a json object.
+
+    """
+    offsets = {}
+    idx = WHITESPACE.match(text, 0).end()
+    if text[idx:idx + 1] != '{':
+        raise ValueError("Expected a json object at offset {}".format(idx))
+    idx = WHITESPACE.match(text, idx + 1).end()
+    if text[idx:idx + 1] == '}':
+        idx = WHITESPACE.match(text, idx + 1).end()
+    else:
+        while True:
+            if text[idx:idx + 1] != '"':
+                raise ValueError("Expected a key at offset {}".format(idx))
+            key, idx = scanstring(text, idx + 1)
+            idx = WHITESPACE.match(text, idx).end()
+            if text[idx:idx + 1] != ':':
+                raise ValueError("Expected ':' at offset {}".format(idx))
+            start = WHITESPACE.match(text, idx + 1).end()
+            end = _find_value_end(text, start)
+            offsets[key] = (start, end)
+            idx = WHITESPACE.match(text, end).end()
+            delimiter = text[idx:idx + 1]
+            idx = WHITESPACE.match(text, idx + 1).end()
+            if delimiter == '}':
+                break
+            if delimiter != ',':
+                raise ValueError("Expected ',' or '}}' at offset {}".format(idx))
+    if idx != len(text):
+        raise ValueError("Extra data at offset {}".format(idx))
+    return offsets
+
+
+def _find_value_end(text, start):
+    if text[start:start + 1] not in ('{', '['):
+        # Scalars are short; decode them.
+        _, end = _DECODER.raw_decode(text, start)
+        return end
+    depth = 1
+    idx = start + 1
+    while True:
+        match = _NEXT_BRACKET.match(text, idx)
+        if match is None:
+            raise ValueError("Unterminated value at offset {}".format(start))
+        idx = match.end()
+        if match.group(1) in ('{', '['):
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return idx
+
+
+# TaskGraphStore {{{1
+class TaskGraphStore(object):
+    """Share ``TaskGraph``s by decision taskId and sha256.
+
+    Concurrent requests for the same graph wait for the same load.  The
+    ``max_entries`` most recently used graphs are kept.
+
+    Attributes:
+        context (scriptworker.context.Context): the scriptworker context.
+        hits (int): the number of requests for graphs we'd already loaded.
+        max_entries (int): the number of graphs to keep.
+        misses (int): the number of graphs we've loaded.
+
+    """
+
+    def __init__(self, context, max_entries=4):
+        """Initialize TaskGraphStore.
+
+        Args:
+            context (scriptworker.context.Context): the scriptworker context.
+            max_entries (int, optional): the number of graphs to keep.
+                Defaults to 4.
+
+        """
+        self.context = context
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._graphs = OrderedDict()
+
+    async def get(self, decision_task_id, path, sha256=None):
+        """Get the task graph at ``path``, loading it if we haven't already.
+
+        Args:
+            decision_task_id (str): the taskId of the decision task.
+            path (str): the path to the decision task's task-graph.json.
+            sha256 (str, optional): the sha256 hexdigest of ``path``, e.g. as
+                verified against the decision task's chain of trust artifact.
+                If None, hash ``path``.  Defaults to None.
+
+        Returns:
+            TaskGraph: the task graph.
+
+        Raises:
+            OSError: if we can't read ``path``.
+            ValueError: if ``path`` isn't a json object.
+
+        """
+        sha256 = sha256 or await run_in_executor(self.context, get_hash, path)
+        key = (decision_task_id, sha256)
+        if key in self._graphs:
+            self.hits += 1
+            self._graphs.move_to_end(key)
+        else:
+            self.misses += 1
+            log.debug("Loading the {} task graph from {}...".format(decision_task_id, path))
+            self._graphs[key] = asyncio.ensure_future(
+                run_in_executor(self.context, TaskGraph.from_path, path)
+            )
+            while len(self._graphs) > self.max_entries:
+                self._graphs.popitem(last=False)
+        future = self._graphs[key]
+        try:
+            return await asyncio.shield(future)
+        except (OSError, ValueError):
+            if self._graphs.get(key) is future:
+                del self._graphs[key]
+            raise
+
+    def format_stats(self):
+        """Format the store statistics for the log.
+
+        Returns:
+            str: the formatted store statistics.
+
+        """
+        return "Task graph store: hits={} misses={}".format(self.hits, self.misses)
+
+
+# get_task_graph_store {{{1
+def get_task_graph_store(context):
+    """Get the ``TaskGraphStore`` for ``context``, creating it if needed.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        TaskGraphStore: the task graph store.
+
+    """
+    if context.task_graph_store is None:
+        context.task_graph_store = TaskGraphStore(context)
+    return context.task_graph_store
@@ -8,8 +8,11 @@ Attributes:
 import aiohttp
 import argparse
 import asyncio
+from collections import OrderedDict
 from copy import deepcopy
 from frozendict import frozendict
+import hashlib
+import json
 import logging
 import os
 import pprint
@@ -18,14 +21,17 @@ import sys
 import tempfile
 from urllib.parse import unquote, urlparse
 from scriptworker.artifacts import download_artifacts, get_artifact_url, get_single_upstream_artifact_full_path
+from scriptworker.cache import get_cot_verification_cache, get_task_definition_cache, TaskDefinitionCache
 from scriptworker.config import read_worker_creds
 from scriptworker.constants import DEFAULT_CONFIG
 from scriptworker.context import Context
+from scriptworker.cot.task_graph import get_task_graph_store, TaskGraph
 from scriptworker.exceptions import CoTError, DownloadError, ScriptWorkerGPGException
-from scriptworker.gpg import get_body, GPG
+from scriptworker.gpg import get_body, get_gpg_homedir_revision, GPG
 from scriptworker.log import contextual_log_handler
 from scriptworker.task import get_decision_task_id, get_worker_type, get_task_id
-from scriptworker.utils import format_json, get_hash, load_json, makedirs, match_url_regex, raise_future_exceptions, rm
+from scriptworker.utils import format_json, gather_fail_fast, get_current_task, get_hash, load_json, \
+    match_url_regex, raise_future_exceptions, rm, run_in_executor
 from taskcluster.exceptions import TaskclusterFailure
 
 log = logging.getLogger(__name__)
@@ -38,8 +44,9 @@ class ChainOfTrust(object):
     Attributes:
         context (scriptworker.context.Context): the scriptworker context
         decision_task_id (str): the task_id of self.task's decision task
-        links (list): the list of ``LinkOfTrust``s
         name (str): the name of the task (e.g., signing)
+        task_definition_cache (scriptworker.cache.TaskDefinitionCache): the
+            cache to fetch the links' task definitions through
         task_id (str): the taskId of the task
         task_type (str): the task type of the task (e.g., decision, build)
         worker_impl (str): the taskcluster worker class (e.g., docker-worker) of the task
@@ -64,6 +71,40 @@ class ChainOfTrust(object):
         self.worker_impl = guess_worker_impl(self)  # this should be scriptworker
         self.decision_task_id = get_decision_task_id(self.task)
         self.links = []
+        self.task_definition_cache = get_task_definition_cache(context)
+
+    @property
+    def links(self):
+        """tuple: the ``LinkOfTrust``s, in the order they were added.
+
+        This is a read-only copy, so the indexes stay up to date: add links
+        with ``add_link``, or set ``links`` to a new list.
+
+        """
+        return tuple(self._links)
+
+    @links.setter
+    def links(self, links):
+        self._links = []
+        self._links_by_task_id = {}
+        self._links_by_task_type = {}
+        self._links_by_decision_task_id = {}
+        self._has_try_link = False
+        for link in links:
+            self.add_link(link)
+
+    def add_link(self, link):
+        """Add a ``LinkOfTrust`` to the chain, and index it.
+
+        Args:
+            link (LinkOfTrust): the link to add.
+
+        """
+        self._links.append(link)
+        self._links_by_task_id.setdefault(link.task_id, []).append(link)
+        self._links_by_task_type.setdefault(link.task_type, []).append(link)
+        self._links_by_decision_task_id.setdefault(link.decision_task_id, []).append(link)
+        self._has_try_link = self._has_try_link or bool(link.is_try)
 
     def dependent_task_ids(self):
         """Get all ``task_id``s for all ``LinkOfTrust`` tasks.
@@ -74,6 +115,42 @@ class ChainOfTrust(object):
         """
         return [x.task_id for x in self.links]
 
+    def has_link(self, task_id):
+        """Check whether the chain has a ``LinkOfTrust`` for ``task_id``.
+
+        Args:
+            task_id (str): the task id to find.
+
+        Returns:
+            bool: True if there's a link for ``task_id``.
+
+        """
+        return task_id in self._links_by_task_id
+
+    def get_links_by_task_type(self, task_type):
+        """Get the ``LinkOfTrust``s of a task type, in the order they were added.
+
+        Args:
+            task_type (str): the task type, e.g. decision.
+
+        Returns:
+            list: the matching links.
+
+        """
+        return list(self._links_by_task_type.get(task_type, []))
+
+    def get_links_by_decision_task_id(self, decision_task_id):
+        """Get the ``LinkOfTrust``s generated by a decision task, in the order they were added.
+
+        Args:
+            decision_task_id (str): the decision task's task id.
+
+        Returns:
+            list: the matching links.
+
+        """
+        return list(self._links_by_decision_task_id.get(decision_task_id, []))
+
     def is_try(self):
         """Determine if any task in the chain is a try task.
 
@@ -81,12 +158,7 @@ class ChainOfTrust(object):
             bool: True if a task is a try task.
 
         """
-        result = is_try(self.task)
-        for link in self.links:
-            if link.is_try:
-                result = True
-                break
-        return result
+        return self._has_try_link or is_try(self.task)
 
     def get_link(self, task_id):
         """Get a ``LinkOfTrust`` by task id.
@@ -101,7 +173,7 @@ class ChainOfTrust(object):
             CoTError: if no ``LinkOfTrust`` matches.
 
         """
-        links = [x for x in self.links if x.task_id == task_id]
+        links = self._links_by_task_id.get(task_id, [])
         if len(links) != 1:
             raise CoTError("No single Link matches task_id {}!\n{}".format(task_id, self.dependent_task_ids()))
         return links[0]
@@ -111,6 +183,8 @@ class ChainOfTrust(object):
 class LinkOfTrust(object):
     """Each LinkOfTrust represents a task in the Chain of Trust and its status.
 
+    Chains can have thousands of links, so this uses ``__slots__``.
+
     Attributes:
         context (scriptworker.context.Context): the scriptworker context
         decision_task_id (str): the task_id of self.task's decision task
@@ -118,15 +192,16 @@ class LinkOfTrust(object):
         name (str): the name of the task (e.g., signing.decision)
         task_id (str): the taskId of the task
         task_graph (dict): the task graph of the task, if this is a decision task
+        task_graph_index (dict): the fingerprint index of ``task_graph``
         task_type (str): the task type of the task (e.g., decision, build)
         worker_impl (str): the taskcluster worker class (e.g., docker-worker) of the task
 
     """
 
-    _task = None
-    _cot = None
-    _task_graph = None
-    status = None
+    __slots__ = (
+        'context', 'decision_task_id', 'is_try', 'name', 'status', 'task_id', 'task_type', 'worker_impl',
+        '_cot', '_task', '_task_graph', '_task_graph_index',
+    )
 
     def __init__(self, context, name, task_id):
         """Initialize ChainOfTrust.
@@ -141,6 +216,14 @@ class LinkOfTrust(object):
         self.task_type = guess_task_type(name)
         self.context = context
         self.task_id = task_id
+        self.decision_task_id = None
+        self.is_try = None
+        self.status = None
+        self.worker_impl = None
+        self._cot = None
+        self._task = None
+        self._task_graph = None
+        self._task_graph_index = None
 
     def _set(self, prop_name, value):
         prev = getattr(self, prop_name)
@@ -187,6 +270,20 @@ class LinkOfTrust(object):
     def task_graph(self, task_graph):
         self._set('_task_graph', task_graph)
 
+    @property
+    def task_graph_index(self):
+        """dict: the fingerprint index of ``task_graph``, built on first use."""
+        if self._task_graph_index is None and self._task_graph is not None:
+            if isinstance(self._task_graph, TaskGraph):
+                # Share the index with the other links using this task graph.
+                # Decode the whole graph in one pass, rather than entry by entry.
+                if self._task_graph.fingerprint_index is None:
+                    self._task_graph.fingerprint_index = build_task_graph_index(self._task_graph.decode())
+                self._task_graph_index = self._task_graph.fingerprint_index
+            else:
+                self._task_graph_index = build_task_graph_index(self._task_graph)
+        return self._task_graph_index
+
     @property
     def cot_dir(self):
         """str: the local path containing this link's artifacts."""
@@ -510,48 +607,130 @@ def _sort_dependencies_by_name_then_task_id(dependencies):
     return sorted(dependencies, key=lambda dep: '{}_{}'.format(dep[0], dep[1]))
 
 
+# _TaskDependencyFetcher {{{1
+class _TaskDependencyFetcher(object):
+    """Fetch the task definitions in a chain concurrently, once per taskId."""
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.dependencies = {}
+        self.futures = {}
+        self.semaphore = asyncio.Semaphore(chain.context.config['cot_max_concurrent_task_fetches'])
+
+    def find_dependencies(self, task, name, task_id):
+        """Memoize ``find_sorted_task_dependencies``."""
+        key = (name, task_id)
+        if key not in self.dependencies:
+            self.dependencies[key] = find_sorted_task_dependencies(task, name, task_id)
+        return self.dependencies[key]
+
+    def fetch(self, task_id):
+        """Get the future for the task definition of ``task_id``, starting the fetch if needed."""
+        if task_id not in self.futures:
+            self.futures[task_id] = asyncio.ensure_future(self._fetch(task_id))
+        return self.futures[task_id]
+
+    async def _fetch(self, task_id):
+        async with self.semaphore:
+            return await self.chain.task_definition_cache.get(task_id)
+
+    async def prefetch(self, task, name, task_id):
+        """Fetch the task dependencies breadth-first, a level at a time.
+
+        Fetch errors are left in the futures; they're only raised if
+        ``_add_task_dependencies`` needs that task.
+
+        """
+        level = [(task, name, task_id)]
+        while level:
+            next_level = []
+            for parent, parent_name, parent_id in level:
+                if parent_name.count(':') > 5:
+                    continue
+                for dep_name, dep_id in self.find_dependencies(parent, parent_name, parent_id):
+                    if self.chain.has_link(dep_id) or dep_id in self.futures:
+                        continue
+                    next_level.append((self.fetch(dep_id), dep_name, dep_id))
+            results = await asyncio.gather(*[future for future, _, _ in next_level], return_exceptions=True)
+            level = [
+                (result, dep_name, dep_id)
+                for result, (_, dep_name, dep_id) in zip(results, next_level)
+                if not isinstance(result, BaseException)
+            ]
+
+    def cancel(self):
+        """Cancel any fetches we didn't need."""
+        for future in self.futures.values():
+            future.cancel()
+
+
 # build_task_dependencies {{{1
-async def build_task_dependencies(chain, task, name, my_task_id):
-    """Recursively build the task dependencies of a task.
+async def build_task_dependencies(chain, task, name, my_task_id, link_callback=None):
+    """Build the task dependencies of a task.
+
+    The task definitions are fetched breadth-first, with up to
+    ``cot_max_concurrent_task_fetches`` fetches at a time.  Meanwhile, the
+    links are named and added depth-first, in ``find_sorted_task_dependencies``
+    order, so the first path to reach a task names it.
 
     Args:
         chain (ChainOfTrust): the chain of trust to add to.
         task (dict): the task definition to operate on.
         name (str): the name of the task to operate on.
         my_task_id (str): the taskId of the task to operate on.
+        link_callback (function, optional): if set, called with each
+            ``LinkOfTrust`` as it's added to the chain.  Defaults to None.
 
     Raises:
         CoTError: on failure.
 
     """
+    fetcher = _TaskDependencyFetcher(chain)
+    writes = []
+    prefetch = asyncio.ensure_future(fetcher.prefetch(task, name, my_task_id))
+    try:
+        await _add_task_dependencies(chain, fetcher, task, name, my_task_id, writes, link_callback)
+    finally:
+        prefetch.cancel()
+        fetcher.cancel()
+        await asyncio.gather(prefetch, *writes, return_exceptions=True)
+    await raise_future_exceptions(writes)
+
+
+async def _add_task_dependencies(chain, fetcher, task, name, my_task_id, writes, link_callback=None):
     log.info("build_task_dependencies {} {}".format(name, my_task_id))
     if name.count(':') > 5:
         raise CoTError("Too deep recursion!\n{}".format(name))
-    sorted_dependencies = find_sorted_task_dependencies(task, name, my_task_id)
-
-    for task_name, task_id in sorted_dependencies:
-        if task_id not in chain.dependent_task_ids():
-            link = LinkOfTrust(chain.context, task_name, task_id)
-            json_path = link.get_artifact_full_path('task.json')
-            try:
-                task_defn = await chain.context.queue.task(task_id)
-                link.task = task_defn
-                chain.links.append(link)
-                # write task json to disk
-                makedirs(os.path.dirname(json_path))
-                with open(json_path, 'w') as fh:
-                    fh.write(format_json(task_defn))
-                await build_task_dependencies(chain, task_defn, task_name, task_id)
-            except TaskclusterFailure as exc:
-                raise CoTError(str(exc))
+    for task_name, task_id in fetcher.find_dependencies(task, name, my_task_id):
+        if chain.has_link(task_id):
+            continue
+        link = LinkOfTrust(chain.context, task_name, task_id)
+        json_path = link.get_artifact_full_path('task.json')
+        try:
+            task_defn = await fetcher.fetch(task_id)
+        except TaskclusterFailure as exc:
+            raise CoTError(str(exc))
+        link.task = task_defn
+        chain.add_link(link)
+        if link_callback is not None:
+            link_callback(link)
+        # write task json to disk
+        writes.append(asyncio.ensure_future(run_in_executor(
+            chain.context, chain.context.write_json, json_path, task_defn,
+            "Writing task json to {path}..."
+        )))
+        await _add_task_dependencies(chain, fetcher, task_defn, task_name, task_id, writes, link_callback)
 
 
 # download_cot {{{1
-async def download_cot(chain):
+async def download_cot(chain, fail_fast=True):
     """Download the signed chain of trust artifacts.
 
     Args:
         chain (ChainOfTrust): the chain of trust to add to.
+        fail_fast (bool, optional): if False, finish every download and log
+            every error before raising, rather than cancelling the other
+            downloads on the first failure.  Defaults to True.
 
     Raises:
         DownloadError: on failure.
@@ -573,9 +752,9 @@ async def download_cot(chain):
                 )
             )
         )
-    paths = await raise_future_exceptions(async_tasks)
+    paths = await gather_fail_fast(async_tasks, fail_fast=fail_fast)
     for path in paths:
-        sha = get_hash(path[0])
+        sha = await run_in_executor(chain.context, get_hash, path[0])
         log.debug("{} downloaded; hash is {}".format(path[0], sha))
 
 
@@ -583,6 +762,9 @@ async def download_cot(chain):
 async def download_cot_artifact(chain, task_id, path):
     """Download an artifact and verify its SHA against the chain of trust.
 
+    The artifact is hashed with all of its chain of trust hash algorithms as
+    it downloads, so we don't read it back from disk.
+
     Args:
         chain (ChainOfTrust): the chain of trust object
         task_id (str): the task ID to download from
@@ -596,32 +778,74 @@ async def download_cot_artifact(chain, task_id, path):
 
     """
     link = chain.get_link(task_id)
-    log.debug("Verifying {} is in {} cot artifacts...".format(path, task_id))
-    if path not in link.cot['artifacts']:
-        raise CoTError("path {} not in {} {} chain of trust artifacts!".format(path, link.name, link.task_id))
+    full_path = link.get_artifact_full_path(path)
+    expected_digests = _get_expected_digests(chain, link, path)
     url = get_artifact_url(chain.context, task_id, path)
     log.info("Downloading Chain of Trust artifact:\n{}".format(url))
-    await download_artifacts(
-        chain.context, [url], parent_dir=link.cot_dir, valid_artifact_task_ids=[task_id]
-    )
-    full_path = link.get_artifact_full_path(path)
-    for alg, expected_sha in link.cot['artifacts'][path].items():
+    try:
+        await download_artifacts(
+            chain.context, [url], parent_dir=link.cot_dir, valid_artifact_task_ids=[task_id],
+            expected_digests={url: expected_digests},
+        )
+    except CoTError as exc:
+        raise CoTError("{}: {}".format(link.name, exc.args[0]))
+    for alg, expected_sha in sorted(expected_digests.items()):
+        log.debug("{} matches the expected {} {}".format(full_path, alg, expected_sha))
+    return full_path
+
+
+def _get_expected_digests(chain, link, path):
+    log.debug("Verifying {} is in {} cot artifacts...".format(path, link.task_id))
+    if path not in link.cot['artifacts']:
+        raise CoTError("path {} not in {} {} chain of trust artifacts!".format(path, link.name, link.task_id))
+    expected_digests = link.cot['artifacts'][path]
+    for alg in expected_digests:
         if alg not in chain.context.config['valid_hash_algorithms']:
-            raise CoTError("BAD HASH ALGORITHM: {}: {} {}!".format(link.name, alg, full_path))
-        real_sha = get_hash(full_path, hash_alg=alg)
-        if expected_sha != real_sha:
-            raise CoTError("BAD HASH: {}: Expected {} {}; got {}!".format(link.name, alg, expected_sha, real_sha))
+            raise CoTError("BAD HASH ALGORITHM: {}: {} {}!".format(
+                link.name, alg, link.get_artifact_full_path(path)
+            ))
+    return expected_digests
+
+
+# verify_cot_artifact_digests {{{1
+async def verify_cot_artifact_digests(chain, link, path):
+    """Verify an artifact we downloaded before we knew its digests.
+
+    Args:
+        chain (ChainOfTrust): the chain of trust object
+        link (LinkOfTrust): the link the artifact belongs to.  ``link.cot``
+            must be verified.
+        path (str): the relative path to the artifact
+
+    Returns:
+        str: the full path of the artifact
+
+    Raises:
+        CoTError: if the artifact isn't in the link's chain of trust
+            artifacts, or doesn't match its digests.
+
+    """
+    full_path = link.get_artifact_full_path(path)
+    for alg, expected_sha in sorted(_get_expected_digests(chain, link, path).items()):
+        sha = await run_in_executor(chain.context, get_hash, full_path, alg)
+        if sha != expected_sha:
+            raise CoTError("BAD HASH: {}: {} {} doesn't match the expected {}!".format(
+                link.name, full_path, alg, expected_sha
+            ))
         log.debug("{} matches the expected {} {}".format(full_path, alg, expected_sha))
     return full_path
 
 
 # download_cot_artifacts {{{1
-async def download_cot_artifacts(chain, artifact_dict):
+async def download_cot_artifacts(chain, artifact_dict, fail_fast=True):
     """Call ``download_cot_artifact`` in parallel for each key/value in ``artifact_dict``.
 
     Args:
         chain (ChainOfTrust): the chain of trust object
         artifact_dict (dict): maps task_id to list of paths of artifacts to download
+        fail_fast (bool, optional): if False, finish every download and log
+            every error before raising, rather than cancelling the other
+            downloads on the first failure.  Defaults to True.
 
     Returns:
         list: list of full paths to artifacts
@@ -641,7 +865,7 @@ async def download_cot_artifacts(chain, artifact_dict):
                     )
                 )
             )
-    full_paths = await raise_future_exceptions(tasks)
+    full_paths = await gather_fail_fast(tasks, fail_fast=fail_fast)
     return full_paths
 
 
@@ -663,11 +887,9 @@ async def download_firefox_cot_artifacts(chain):
 
     """
     artifact_dict = {}
-    for link in chain.links:
-        task_type = link.task_type
-        if task_type == 'decision':
-            artifact_dict.setdefault(link.task_id, [])
-            artifact_dict[link.task_id].append('public/task-graph.json')
+    for link in chain.get_links_by_task_type('decision'):
+        artifact_dict.setdefault(link.task_id, [])
+        artifact_dict[link.task_id].append('public/task-graph.json')
     if 'upstreamArtifacts' in chain.task['payload']:
         for upstream_dict in chain.task['payload']['upstreamArtifacts']:
             artifact_dict.setdefault(upstream_dict['taskId'], [])
@@ -677,10 +899,15 @@ async def download_firefox_cot_artifacts(chain):
 
 
 # verify_cot_signatures {{{1
-def verify_cot_signatures(chain):
+async def verify_cot_signatures(chain):
     """Verify the signatures of the chain of trust artifacts populated in ``download_cot``.
 
-    Populate each link.cot with the chain of trust json body.
+    Populate each link.cot with the chain of trust json body.  The links are
+    verified concurrently in the thread executor, with one ``GPG`` instance
+    per ``worker_impl`` gpg home.  If ``cot_verification_cache_dir`` is set,
+    artifacts we've already verified with this gpg homedir revision don't
+    touch gpg at all.  The cache is keyed on the git revision recorded in the
+    gpg homedirs in use, and isn't used if they didn't record one.
 
     Args:
         chain (ChainOfTrust): the chain of trust to add to.
@@ -689,38 +916,126 @@ def verify_cot_signatures(chain):
         CoTError: on failure.
 
     """
+    verifier = _CoTSignatureVerifier(chain)
+    tasks = []
     for link in chain.links:
-        path = link.get_artifact_full_path('public/chainOfTrust.json.asc')
-        gpg_home = os.path.join(chain.context.config['base_gpg_home_dir'], link.worker_impl)
-        gpg = GPG(chain.context, gpg_home=gpg_home)
+        tasks.append(asyncio.ensure_future(verifier.verify(link)))
+    await raise_future_exceptions(tasks)
+    verifier.log_stats()
+
+
+class _CoTSignatureVerifier(object):
+    """Verify chain of trust signatures, sharing GPG instances and the verification cache."""
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.cache = get_cot_verification_cache(chain.context)
+        self.gpgs = {}
+        self.gpg_revision = None
+
+    async def get_gpg(self, gpg_home):
+        """Get the ``GPG`` instance for ``gpg_home``, creating it once."""
+        if gpg_home not in self.gpgs:
+            self.gpgs[gpg_home] = asyncio.ensure_future(
+                run_in_executor(self.chain.context, GPG, self.chain.context, gpg_home=gpg_home)
+            )
+        return await asyncio.shield(self.gpgs[gpg_home])
+
+    async def get_gpg_revision(self):
+        """Get the git revision of the gpg homedirs in use, reading it once."""
+        if self.gpg_revision is None:
+            self.gpg_revision = asyncio.ensure_future(
+                run_in_executor(
+                    self.chain.context, get_gpg_homedir_revision, self.chain.context.config['base_gpg_home_dir']
+                )
+            )
+        return await asyncio.shield(self.gpg_revision)
+
+    async def verify(self, link):
+        """Verify the signature of ``link``'s chain of trust artifact, and populate link.cot."""
+        context = self.chain.context
+        unsigned_path = link.get_artifact_full_path('chainOfTrust.json')
+        contents = await run_in_executor(context, _read_signed_cot, link)
+        cache_key = None
+        # Without a recorded revision, we can't tell which homedirs a cached
+        # verification was made against.
+        gpg_revision = await self.get_gpg_revision() if self.cache is not None else None
+        if gpg_revision is not None:
+            cache_key = self.cache.get_key(
+                contents, gpg_revision, link.worker_impl, context.config['verify_cot_signature']
+            )
+            cot = await run_in_executor(context, self.cache.get, cache_key)
+            if cot is not None:
+                log.debug("Found the {} {} chain of trust in the verification cache".format(link.name, link.task_id))
+                link.cot = cot
+                await run_in_executor(context, _write_unsigned_cot, link)
+                log.debug("Good.  Wrote json contents to {}".format(unsigned_path))
+                return
+        gpg_home = os.path.join(context.config['base_gpg_home_dir'], link.worker_impl)
+        gpg = await self.get_gpg(gpg_home)
         log.debug("Verifying the {} {} chain of trust signature against {}".format(
             link.name, link.task_id, gpg_home
         ))
-        try:
-            with open(path, "r") as fh:
-                contents = fh.read()
-        except OSError as exc:
-            raise CoTError("Can't read {}: {}!".format(path, str(exc)))
-        try:
-            # TODO remove verify_sig pref and kwarg when git repo pubkey
-            # verification works reliably!
-            body = get_body(
-                gpg, contents,
-                verify_sig=chain.context.config['verify_cot_signature']
-            )
-        except ScriptWorkerGPGException as exc:
-            raise CoTError("GPG Error verifying chain of trust for {}: {}!".format(path, str(exc)))
-        link.cot = load_json(
-            body, exception=CoTError,
-            message="{} {}: Invalid cot json body! %(exc)s".format(link.name, link.task_id)
+        await run_in_executor(context, verify_link_cot_signature, self.chain, link, gpg)
+        log.debug("Good.  Wrote json contents to {}".format(unsigned_path))
+        if cache_key is not None:
+            await run_in_executor(context, self.cache.add, cache_key, link.cot)
+
+    def log_stats(self):
+        """Log the verification cache statistics, if we have a cache."""
+        if self.cache is not None:
+            log.info(self.cache.format_stats())
+
+
+def verify_link_cot_signature(chain, link, gpg):
+    """Verify the signature of a link's chain of trust artifact, and populate link.cot.
+
+    Args:
+        chain (ChainOfTrust): the chain of trust.
+        link (LinkOfTrust): the link to verify.
+        gpg (gnupg.GPG): the GPG instance for the link's ``worker_impl``.
+
+    Raises:
+        CoTError: on failure.
+
+    """
+    path = link.get_artifact_full_path('public/chainOfTrust.json.asc')
+    contents = _read_signed_cot(link)
+    try:
+        # TODO remove verify_sig pref and kwarg when git repo pubkey
+        # verification works reliably!
+        body = get_body(
+            gpg, contents,
+            verify_sig=chain.context.config['verify_cot_signature']
         )
-        unsigned_path = link.get_artifact_full_path('chainOfTrust.json')
-        log.debug("Good.  Writing json contents to {}".format(unsigned_path))
-        with open(unsigned_path, "w") as fh:
-            fh.write(format_json(link.cot))
+    except ScriptWorkerGPGException as exc:
+        raise CoTError("GPG Error verifying chain of trust for {}: {}!".format(path, str(exc)))
+    link.cot = load_json(
+        body, exception=CoTError,
+        message="{} {}: Invalid cot json body! %(exc)s".format(link.name, link.task_id)
+    )
+    _write_unsigned_cot(link)
+
+
+def _read_signed_cot(link):
+    path = link.get_artifact_full_path('public/chainOfTrust.json.asc')
+    try:
+        with open(path, "r") as fh:
+            return fh.read()
+    except OSError as exc:
+        raise CoTError("Can't read {}: {}!".format(path, str(exc)))
+
+
+def _write_unsigned_cot(link):
+    unsigned_path = link.get_artifact_full_path('chainOfTrust.json')
+    with open(unsigned_path, "w") as fh:
+        fh.write(format_json(link.cot))
 
 
 # verify_task_in_task_graph {{{1
+_TASK_GRAPH_IGNORE_KEYS = ("created", "deadline", "expires", "dependencies", "schedulerId")
+
+
 def verify_task_in_task_graph(task_link, graph_defn, level=logging.CRITICAL):
     """Verify a given task_link's task against a given graph task definition.
 
@@ -737,9 +1052,30 @@ def verify_task_in_task_graph(task_link, graph_defn, level=logging.CRITICAL):
         CoTError: on failure
 
     """
-    ignore_keys = ("created", "deadline", "expires", "dependencies", "schedulerId")
     errors = []
-    runtime_defn = deepcopy(task_link.task)
+    bad_deps, differences = _compare_task_to_graph_defn(task_link, graph_defn)
+    if bad_deps:
+        errors.append("{} {} dependencies don't line up!\n{}".format(
+            task_link.name, task_link.task_id, bad_deps
+        ))
+    for key, graph_value, runtime_value in differences:
+        errors.append("{} {} {} differs!\n graph: {}\n task: {}".format(
+            task_link.name, task_link.task_id, key,
+            pprint.pformat(graph_value), pprint.pformat(runtime_value)
+        ))
+    raise_on_errors(errors, level=level)
+
+
+def _compare_task_to_graph_defn(task_link, graph_defn):
+    """Compare a task to a graph task definition, without formatting any errors.
+
+    Returns:
+        tuple: the set of unexpected dependencies, and a list of
+            ``(key, graph_value, runtime_value)`` tuples for the values that
+            differ.
+
+    """
+    runtime_defn = task_link.task
     # dependencies
     # Allow for a subset of dependencies in a retriggered task.  The current use case
     # is release promotion: we may hit the expiration deadline for a task (e.g. pushapk),
@@ -747,25 +1083,22 @@ def verify_task_in_task_graph(task_link, graph_defn, level=logging.CRITICAL):
     # the pushapk task, we can clone the task, update timestamps, and remove the
     # breakpoint dependency.
     bad_deps = set(runtime_defn['dependencies']) - set(graph_defn['task']['dependencies'])
-    if bad_deps and runtime_defn['dependencies'] != [task_link.decision_task_id]:
-        errors.append("{} {} dependencies don't line up!\n{}".format(
-            task_link.name, task_link.task_id, bad_deps
-        ))
-    # payload - eliminate the 'expires' key from artifacts because the datestring
-    # will change
-    runtime_defn['payload'] = _take_expires_out_from_artifacts_in_payload(runtime_defn['payload'])
-    graph_defn['task']['payload'] = _take_expires_out_from_artifacts_in_payload(graph_defn['task']['payload'])
-
+    if runtime_defn['dependencies'] == [task_link.decision_task_id]:
+        bad_deps = set()
+    differences = []
     # test all non-ignored key/value pairs in the task defn
-    for key, value in graph_defn['task'].items():
-        if key in ignore_keys:
+    for key, graph_value in graph_defn['task'].items():
+        if key in _TASK_GRAPH_IGNORE_KEYS:
             continue
-        if value != runtime_defn[key]:
-            errors.append("{} {} {} differs!\n graph: {}\n task: {}".format(
-                task_link.name, task_link.task_id, key,
-                pprint.pformat(value), pprint.pformat(runtime_defn[key])
-            ))
-    raise_on_errors(errors, level=level)
+        runtime_value = runtime_defn[key]
+        if key == 'payload' and graph_value != runtime_value:
+            # eliminate the 'expires' key from artifacts because the datestring
+            # will change
+            graph_value = _take_expires_out_from_artifacts_in_payload(graph_value)
+            runtime_value = _take_expires_out_from_artifacts_in_payload(runtime_value)
+        if graph_value != runtime_value:
+            differences.append((key, graph_value, runtime_value))
+    return bad_deps, differences
 
 
 def _take_expires_out_from_artifacts_in_payload(payload):
@@ -786,6 +1119,72 @@ def _take_expires_out_from_artifacts_in_payload(payload):
     return returned_payload
 
 
+# task graph fingerprint index {{{1
+def get_task_fingerprint(task_defn, keys):
+    """Hash the canonical form of the parts of a task definition we compare.
+
+    Args:
+        task_defn (dict): the task definition.
+        keys (tuple): the keys to hash.  These are the keys of the graph
+            definition, without ``_TASK_GRAPH_IGNORE_KEYS``.
+
+    Returns:
+        str: the sha256 hexdigest.
+
+    Raises:
+        KeyError: if ``task_defn`` is missing one of ``keys``.
+
+    """
+    canonical = {}
+    for key in keys:
+        canonical[key] = task_defn[key]
+    if 'payload' in canonical:
+        canonical['payload'] = _take_expires_out_from_artifacts_in_payload(canonical['payload'])
+    return hashlib.sha256(
+        json.dumps(canonical, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    ).hexdigest()
+
+
+def build_task_graph_index(task_graph):
+    """Index a task graph by task fingerprint, for fuzzy matching.
+
+    Args:
+        task_graph (dict): the task-graph.json contents.
+
+    Returns:
+        dict: maps each tuple of compared keys to a dict of fingerprints to
+            the list of matching taskIds in the graph.
+
+    """
+    index = {}
+    for task_id, graph_defn in task_graph.items():
+        keys = tuple(sorted(set(graph_defn['task'].keys()) - set(_TASK_GRAPH_IGNORE_KEYS)))
+        fingerprint = get_task_fingerprint(graph_defn['task'], keys)
+        index.setdefault(keys, {}).setdefault(fingerprint, []).append(task_id)
+    return index
+
+
+def find_task_graph_candidates(index, task_defn):
+    """Find the taskIds in a task graph index that may match a task definition.
+
+    Args:
+        index (dict): the index from ``build_task_graph_index``.
+        task_defn (dict): the runtime task definition.
+
+    Returns:
+        list: the candidate taskIds.
+
+    """
+    candidates = []
+    for keys, fingerprints in index.items():
+        try:
+            fingerprint = get_task_fingerprint(task_defn, keys)
+        except KeyError:
+            continue
+        candidates.extend(fingerprints.get(fingerprint, []))
+    return candidates
+
+
 # verify_link_in_task_graph {{{1
 def verify_link_in_task_graph(chain, decision_link, task_link):
     """Compare the runtime task definition against the decision task graph.
@@ -795,6 +1194,11 @@ def verify_link_in_task_graph(chain, decision_link, task_link):
     any definition in the task graph.  This is to support retriggers, where
     the task definition stays the same, but the datestrings and taskIds change.
 
+    Fuzzy matching looks up the task's fingerprint in
+    ``decision_link.task_graph_index`` first.  The fingerprints compare the
+    json, so if none of the candidates match, we warn, and compare against
+    the rest of the definitions before giving up.
+
     Args:
         chain (ChainOfTrust): the chain we're operating on.
         decision_link (LinkOfTrust): the decision task link
@@ -808,24 +1212,40 @@ def verify_link_in_task_graph(chain, decision_link, task_link):
         task_link.name, task_link.task_id, decision_link.name, decision_link.task_id
     ))
     if task_link.task_id in decision_link.task_graph:
-        graph_defn = deepcopy(decision_link.task_graph[task_link.task_id])
+        graph_defn = decision_link.task_graph[task_link.task_id]
         verify_task_in_task_graph(task_link, graph_defn)
         log.info("Found {} in the graph; it's a match".format(task_link.task_id))
         return
     # Fall back to fuzzy matching to support retriggers: the taskId and
     # datestrings will change but the task definition shouldn't.
-    for task_id, graph_defn in decision_link.task_graph.items():
-        log.debug("Fuzzy matching against {} ...".format(task_id))
-        try:
-            verify_task_in_task_graph(task_link, graph_defn, level=logging.DEBUG)
+    candidates = find_task_graph_candidates(decision_link.task_graph_index, task_link.task)
+    if _find_fuzzy_match(decision_link, task_link, candidates):
+        return
+    # The fingerprints compare the json, so they can miss a match, e.g. if
+    # ``_compare_task_to_graph_defn`` ignores a difference.  Make the misses
+    # visible, since each one costs a scan of the graph.
+    log.warning("{} {} doesn't match its fingerprint candidates in the {} {} task graph; "
+                "comparing it against the rest of the graph...".format(
+                    task_link.name, task_link.task_id, decision_link.name, decision_link.task_id
+                ))
+    candidates = set(candidates)
+    if _find_fuzzy_match(
+        decision_link, task_link,
+        [task_id for task_id in decision_link.task_graph.keys() if task_id not in candidates]
+    ):
+        return
+    raise_on_errors(["Can't find task {} {} in {} {} task-graph.json!".format(
+        task_link.name, task_link.task_id, decision_link.name, decision_link.task_id
+    )])
+
+
+def _find_fuzzy_match(decision_link, task_link, task_ids):
+    for task_id in task_ids:
+        bad_deps, differences = _compare_task_to_graph_defn(task_link, decision_link.task_graph[task_id])
+        if not bad_deps and not differences:
             log.info("Found a {} fuzzy match with {} ...".format(task_link.task_id, task_id))
-            return
-        except CoTError:
-            pass
-    else:
-        raise_on_errors(["Can't find task {} {} in {} {} task-graph.json!".format(
-            task_link.name, task_link.task_id, decision_link.name, decision_link.task_id
-        )])
+            return True
+    return False
 
 
 # verify_firefox_decision_command {{{1
@@ -924,17 +1344,26 @@ async def verify_decision_task(chain, link):
     if not os.path.exists(path):
         errors.append("{} {}: {} doesn't exist!".format(link.name, link.task_id, path))
         raise_on_errors(errors)
-    link.task_graph = load_json(
-        path, is_path=True, exception=CoTError, message="Can't load {}! %(exc)s".format(path)
-    )
-    for target_link in [chain] + chain.links:
+    # The chain of trust has already verified the digests of task-graph.json.
+    sha256 = link.cot['artifacts'].get('public/task-graph.json', {}).get('sha256')
+    try:
+        link.task_graph = await get_task_graph_store(chain.context).get(link.task_id, path, sha256=sha256)
+    except (OSError, ValueError) as exc:
+        raise CoTError("Can't load {}! {}".format(path, exc))
+    target_links = chain.get_links_by_decision_task_id(link.task_id)
+    if chain.decision_task_id == link.task_id:
+        target_links.insert(0, chain)
+    for target_link in target_links:
         # Verify the target's task is in the decision task's task graph, unless
         # it's this task or another decision task.
         # https://github.com/mozilla-releng/scriptworker/issues/77
-        if target_link.decision_task_id == link.task_id and \
-                target_link.task_id != link.task_id and \
+        if target_link.task_id != link.task_id and \
                 target_link.task_type != 'decision':
-            verify_link_in_task_graph(chain, link, target_link)
+            try:
+                verify_link_in_task_graph(chain, link, target_link)
+            except ValueError as exc:
+                # The task graph entries are only decoded as we look them up.
+                raise CoTError("Can't decode {}! {}".format(path, exc))
     verify_firefox_decision_command(link)
     raise_on_errors(errors)
 
@@ -1083,17 +1512,20 @@ async def verify_task_types(chain):
     valid_task_types = get_valid_task_types()
     task_count = {}
     # check the chain object (current task) as well
-    for obj in [chain] + chain.links:
-        task_type = obj.task_type
-        log.info("Verifying {} {} as a {} task...".format(obj.name, obj.task_id, task_type))
-        task_count.setdefault(task_type, 0)
-        task_count[task_type] += 1
+    for obj in [chain] + list(chain.links):
+        task_count.setdefault(obj.task_type, 0)
+        task_count[obj.task_type] += 1
         # Run tests synchronously for now.  We can parallelize if efficiency
         # is more important than a single simple logfile.
-        await valid_task_types[task_type](chain, obj)
+        await _verify_task_type(chain, obj, valid_task_types)
     return task_count
 
 
+async def _verify_task_type(chain, obj, valid_task_types):
+    log.info("Verifying {} {} as a {} task...".format(obj.name, obj.task_id, obj.task_type))
+    await valid_task_types[obj.task_type](chain, obj)
+
+
 # verify_docker_worker_task {{{1
 async def verify_docker_worker_task(chain, link):
     """Docker-worker specific checks.
@@ -1154,14 +1586,17 @@ async def verify_worker_impls(chain):
 
     """
     valid_worker_impls = get_valid_worker_impls()
-    for obj in [chain] + chain.links:
-        worker_impl = obj.worker_impl
-        log.info("Verifying {} {} as a {} task...".format(obj.name, obj.task_id, worker_impl))
+    for obj in [chain] + list(chain.links):
         # Run tests synchronously for now.  We can parallelize if efficiency
         # is more important than a single simple logfile.
-        await valid_worker_impls[worker_impl](chain, obj)
-        if isinstance(obj, ChainOfTrust) and obj.worker_impl != "scriptworker":
-            raise CoTError("ChainOfTrust object is not a scriptworker impl!")
+        await _verify_worker_impl(chain, obj, valid_worker_impls)
+
+
+async def _verify_worker_impl(chain, obj, valid_worker_impls):
+    log.info("Verifying {} {} as a {} task...".format(obj.name, obj.task_id, obj.worker_impl))
+    await valid_worker_impls[obj.worker_impl](chain, obj)
+    if isinstance(obj, ChainOfTrust) and obj.worker_impl != "scriptworker":
+        raise CoTError("ChainOfTrust object is not a scriptworker impl!")
 
 
 # get_firefox_source_url {{{1
@@ -1225,7 +1660,7 @@ async def trace_back_to_firefox_tree(chain):
 
     # a repo_path of None means we have no restricted privs.
     # a string repo_path may mean we have higher privs
-    for obj in [chain] + chain.links:
+    for obj in [chain] + list(chain.links):
         source_url = get_firefox_source_url(obj)
         repo_path = match_url_regex(chain.context.config['valid_vcs_rules'], source_url, callback)
         repos[obj] = repo_path
@@ -1263,6 +1698,159 @@ async def trace_back_to_firefox_tree(chain):
     raise_on_errors(errors)
 
 
+# _ChainOfTrustPipeline {{{1
+class _ChainOfTrustPipeline(object):
+    """Verify each link of a chain as soon as its inputs are ready.
+
+    ``build_task_dependencies`` calls ``start`` as it adds each link.  Each
+    link then downloads and verifies its signed chain of trust artifact, and
+    downloads the artifacts the rest of verification needs, concurrently with
+    the other links and with the rest of the chain building.  Decision links
+    start downloading ``public/task-graph.json`` straight away, and verify its
+    digests once the chain of trust signature checks out.
+
+    ``verify`` runs the task type and worker implementation checks in chain
+    order, each as soon as that link and its chain of trust inputs are ready.
+    If any link fails, ``verify`` raises straight away, and ``close`` cancels
+    the other links' downloads.
+    The audit log records of each link's downloads and signature verification
+    are held back until ``verify`` reaches that link, so the audit log order
+    is deterministic.
+
+    """
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.futures = {}
+        # Resolves to the first link future that fails.
+        self.failure = asyncio.Future()
+        self.signature_verifier = _CoTSignatureVerifier(chain)
+        self.upstream_artifacts = OrderedDict()
+        for upstream_dict in chain.task['payload'].get('upstreamArtifacts', []):
+            self.upstream_artifacts.setdefault(upstream_dict['taskId'], []).extend(upstream_dict['paths'])
+        self.audit_log_buffer = _AuditLogBuffer(log)
+        log.addFilter(self.audit_log_buffer)
+
+    def start(self, link):
+        """Start verifying ``link``."""
+        future = self._ensure_future(link, self._process_link(link))
+        future.add_done_callback(self._check_failure)
+        self.futures[link.task_id] = future
+
+    def _check_failure(self, future):
+        if not self.failure.done() and not future.cancelled() and future.exception() is not None:
+            self.failure.set_result(future)
+
+    def _ensure_future(self, link, coro):
+        future = asyncio.ensure_future(coro)
+        self.audit_log_buffer.add_task(future, link.task_id)
+        return future
+
+    def _download(self, link, path):
+        context = self.chain.context
+        return self._ensure_future(link, download_artifacts(
+            context, [get_artifact_url(context, link.task_id, path)], parent_dir=link.cot_dir,
+            valid_artifact_task_ids=[link.task_id]
+        ))
+
+    async def _process_link(self, link):
+        downloads = [self._download(link, 'public/chainOfTrust.json.asc')]
+        if link.task_type == 'decision':
+            downloads.append(self._download(link, 'public/task-graph.json'))
+        try:
+            await downloads[0]
+            await self.signature_verifier.verify(link)
+            for path in self.upstream_artifacts.get(link.task_id, []):
+                downloads.append(self._ensure_future(link, download_cot_artifact(self.chain, link.task_id, path)))
+            if link.task_type == 'decision':
+                await downloads[1]
+                await verify_cot_artifact_digests(self.chain, link, 'public/task-graph.json')
+            await gather_fail_fast(downloads)
+        finally:
+            for future in downloads:
+                future.cancel()
+            await asyncio.gather(*downloads, return_exceptions=True)
+
+    async def _wait_for_inputs(self, link):
+        task_ids = [link.task_id]
+        inputs = link.task.get('extra', {}).get('chainOfTrust', {}).get('inputs', {})
+        task_ids.extend([task_id for task_id in sorted(inputs.values()) if task_id in self.futures])
+        futures = [self.futures[task_id] for task_id in task_ids]
+        while not self.failure.done() and not all([future.done() for future in futures]):
+            await asyncio.wait(futures + [self.failure], return_when=asyncio.FIRST_COMPLETED)
+        if self.failure.done():
+            raise self.failure.result().exception()
+        for future in futures:
+            future.result()
+
+    async def verify(self):
+        """Verify the task types and worker implementations, in chain order.
+
+        Raises:
+            CoTError: on failure.
+
+        """
+        chain = self.chain
+        for task_id in self.upstream_artifacts:
+            # Make sure we have a link for each upstream artifact task.
+            chain.get_link(task_id)
+        valid_task_types = get_valid_task_types()
+        valid_worker_impls = get_valid_worker_impls()
+        task_count = {}
+        for obj in [chain] + list(chain.links):
+            if obj is not chain:
+                await self._wait_for_inputs(obj)
+                self.audit_log_buffer.release(obj.task_id)
+            task_count.setdefault(obj.task_type, 0)
+            task_count[obj.task_type] += 1
+            await _verify_task_type(chain, obj, valid_task_types)
+            await _verify_worker_impl(chain, obj, valid_worker_impls)
+        check_num_tasks(chain, task_count)
+        self.signature_verifier.log_stats()
+
+    async def close(self):
+        """Cancel any unfinished links, and release the held back audit log records."""
+        for future in self.futures.values():
+            future.cancel()
+        await asyncio.gather(*self.futures.values(), return_exceptions=True)
+        log.removeFilter(self.audit_log_buffer)
+        for link in self.chain.links:
+            self.audit_log_buffer.release(link.task_id)
+
+
+# _AuditLogBuffer {{{1
+class _AuditLogBuffer(logging.Filter):
+    """Hold back the log records of registered asyncio tasks until they're released."""
+
+    def __init__(self, log_obj):
+        super(_AuditLogBuffer, self).__init__()
+        self.log_obj = log_obj
+        self.records = {}
+        self.released = set()
+        self.task_keys = {}
+
+    def add_task(self, task, key):
+        """Hold back the records ``task`` logs, under ``key``."""
+        self.task_keys[task] = key
+
+    def filter(self, record):
+        """Hold back the record if it's from a registered task that hasn't been released."""
+        if getattr(record, 'audit_log_released', False):
+            return True
+        key = self.task_keys.get(get_current_task())
+        if key is None or key in self.released:
+            return True
+        self.records.setdefault(key, []).append(record)
+        return False
+
+    def release(self, key):
+        """Log the records held back under ``key``, and stop holding back its records."""
+        self.released.add(key)
+        for record in self.records.pop(key, []):
+            record.audit_log_released = True
+            self.log_obj.handle(record)
+
+
 # AuditLogFormatter {{{1
 class AuditLogFormatter(logging.Formatter):
     """Format the chain of trust log."""
@@ -1291,23 +1879,26 @@ async def verify_chain_of_trust(chain):
         formatter=AuditLogFormatter(
             fmt=chain.context.config['log_fmt'],
             datefmt=chain.context.config['log_datefmt'],
-        )
+        ),
+        # Other task slots may be verifying their chains of trust, too.
+        current_task_only=True,
     ):
         try:
-            # build LinkOfTrust objects
-            await build_task_dependencies(chain, chain.task, chain.name, chain.task_id)
-            # download the signed chain of trust artifacts
-            await download_cot(chain)
-            # verify the signatures and populate the ``link.cot``s
-            verify_cot_signatures(chain)
-            # download all other artifacts needed to verify chain of trust
-            await download_firefox_cot_artifacts(chain)
-            # verify the task types, e.g. decision
-            task_count = await verify_task_types(chain)
-            check_num_tasks(chain, task_count)
-            # verify the worker_impls, e.g. docker-worker
-            await verify_worker_impls(chain)
+            pipeline = _ChainOfTrustPipeline(chain)
+            try:
+                # build LinkOfTrust objects.  As each one is added, download
+                # and verify its signed chain of trust artifact, then download
+                # the other artifacts needed to verify chain of trust
+                await build_task_dependencies(
+                    chain, chain.task, chain.name, chain.task_id, link_callback=pipeline.start
+                )
+                # verify the task types, e.g. decision, and the worker_impls,
+                # e.g. docker-worker, as each link is ready
+                await pipeline.verify()
+            finally:
+                await pipeline.close()
             await trace_back_to_firefox_tree(chain)
+            log.info(chain.task_definition_cache.format_stats())
         except (DownloadError, KeyError, AttributeError) as exc:
             log.critical("Chain of Trust verification error!", exc_info=True)
             if isinstance(exc, CoTError):
@@ -1343,6 +1934,8 @@ or in the CREDS_FILES http://bit.ly/2fVMu0A""")
                         choices=['signing', 'balrog', 'beetmover', 'pushapk'], required=True)
     parser.add_argument('--cleanup', help='clean up the temp dir afterwards',
                         dest='cleanup', action='store_true', default=False)
+    parser.add_argument('--task-definition-cache-dir', help='cache task definitions in this dir between runs',
+                        dest='task_definition_cache_dir', default=None)
     opts = parser.parse_args(args)
     tmp = tempfile.mkdtemp()
     log = logging.getLogger('scriptworker')
@@ -1355,15 +1948,17 @@ or in the CREDS_FILES http://bit.ly/2fVMu0A""")
             context = Context()
             context.session = session
             context.credentials = read_worker_creds()
-            context.task = loop.run_until_complete(context.queue.task(opts.task_id))
             context.config = dict(deepcopy(DEFAULT_CONFIG))
             context.config.update({
                 'work_dir': os.path.join(tmp, 'work'),
                 'artifact_dir': os.path.join(tmp, 'artifacts'),
                 'task_log_dir': os.path.join(tmp, 'artifacts', 'public', 'logs'),
                 'base_gpg_home_dir': os.path.join(tmp, 'gpg'),
+                'task_definition_cache_dir': opts.task_definition_cache_dir,
                 'verify_cot_signature': False,
             })
+            context.task_definition_cache = TaskDefinitionCache(context)
+            context.task = loop.run_until_complete(context.task_definition_cache.get(opts.task_id))
             cot = ChainOfTrust(context, opts.task_type, task_id=opts.task_id)
             loop.run_until_complete(verify_chain_of_trust(cot))
             log.info(pprint.pformat(cot.dependent_task_ids()))
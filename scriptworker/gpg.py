@@ -45,6 +45,9 @@ GPG_CONFIG_MAPPING = {
     'gpg_use_agent': 'use_agent',
 }
 
+# the file in the base gpg homedir that records the git revision it was built from
+GPG_HOMEDIR_REVISION_FILENAME = ".git_revision"
+
 
 # helper functions {{{1
 def gpg_default_args(gpg_home):
@@ -514,16 +517,24 @@ def verify_signature(gpg, signed_data, **kwargs):
     """
     log.info("Verifying signature (gnupghome {})".format(guess_gpg_home(gpg)))
     verified = gpg.verify(signed_data, **kwargs)
+    _check_signature_trust(verified)
+    return verified
+
+
+def _check_signature_trust(verified):
+    """Raise ScriptWorkerGPGException unless ``verified`` has a fully trusted signature."""
     if verified.trust_level is not None and verified.trust_level >= verified.TRUST_FULLY:
         log.info("Fully trusted signature from {}, {}".format(verified.username, verified.key_id))
     else:
         raise ScriptWorkerGPGException("Signature could not be verified!")
-    return verified
 
 
 def get_body(gpg, signed_data, gpg_home=None, verify_sig=True, **kwargs):
     """Verify the signature, then return the unsigned data from ``signed_data``.
 
+    ``gpg --decrypt`` verifies the signature while it extracts the data, so
+    this only runs gpg once.
+
     Args:
         gpg (gnupg.GPG): the GPG instance.
         signed_data (str): The ascii armored signed data.
@@ -542,10 +553,11 @@ def get_body(gpg, signed_data, gpg_home=None, verify_sig=True, **kwargs):
         ScriptWorkerGPGException: on signature verification failure.
 
     """
+    body = gpg.decrypt(signed_data, **kwargs)
     # XXX remove verify_sig kwarg when pubkeys are in git repo
     if verify_sig:
-        verify_signature(gpg, signed_data)
-    body = gpg.decrypt(signed_data, **kwargs)
+        log.info("Verifying signature (gnupghome {})".format(guess_gpg_home(gpg)))
+        _check_signature_trust(body)
     return str(body)
 
 
@@ -1334,6 +1346,41 @@ def write_last_good_git_revision(context, revision):
         fh.write(revision)
 
 
+# gpg homedir revision functions {{{1
+def get_gpg_homedir_revision(basedir):
+    """Return the git revision the gpg homedirs in ``basedir`` were built from.
+
+    Unlike the ``last_good_git_revision_file``, this moves with the homedirs
+    when scriptworker swaps the rebuilt homedirs in.
+
+    Args:
+        basedir (str): the base directory of the gpg homedirs.
+
+    Returns:
+        str: the git revision, if the homedirs recorded it
+        None: if they didn't
+
+    """
+    path = os.path.join(basedir, GPG_HOMEDIR_REVISION_FILENAME)
+    result = None
+    if os.path.exists(path):
+        with open(path, "r") as fh:
+            result = fh.read().rstrip()
+    return result
+
+
+def write_gpg_homedir_revision(basedir, revision):
+    """Record ``revision`` as the git revision the gpg homedirs in ``basedir`` were built from.
+
+    Args:
+        basedir (str): the base directory of the gpg homedirs.
+        revision (str): the git revision
+
+    """
+    with open(os.path.join(basedir, GPG_HOMEDIR_REVISION_FILENAME), "w") as fh:
+        fh.write(revision)
+
+
 # build gpg homedirs from repo {{{1
 def build_gpg_homedirs_from_repo(
     context, tag, basedir=None, verify_function=verify_signed_tag,
@@ -1416,6 +1463,7 @@ def _update_git_and_rebuild_homedirs(context, basedir=None):
         log.info("Found new git revision {}!".format(new_revision))
         log.info("Updating gpg homedirs...")
         build_gpg_homedirs_from_repo(context, tag, basedir=basedir)
+        write_gpg_homedir_revision(basedir, new_revision)
         log.info("Writing last_good_git_revision...")
         write_last_good_git_revision(context, new_revision)
         return new_revision
@@ -11,7 +11,7 @@ import os
 
 from contextlib import contextmanager
 
-from scriptworker.utils import makedirs, to_unicode
+from scriptworker.utils import get_task_owner, makedirs, task_owner, to_unicode
 
 log = logging.getLogger(__name__)
 
@@ -113,9 +113,26 @@ def get_log_filehandle(context):
         yield filehandle
 
 
+class TaskOwnerFilter(logging.Filter):
+    """Only pass the records logged by the asyncio tasks with a given owner.
+
+    See ``scriptworker.utils.task_owner``.
+
+    """
+
+    def __init__(self, owner):
+        """Initialize TaskOwnerFilter."""
+        super(TaskOwnerFilter, self).__init__()
+        self.owner = owner
+
+    def filter(self, record):
+        """Pass the record if the current task has our owner."""
+        return get_task_owner() is self.owner
+
+
 @contextmanager
 def contextual_log_handler(context, path, log_obj=None, level=logging.DEBUG,
-                           formatter=None):
+                           formatter=None, current_task_only=False):
     """Add a short-lived log with a contextmanager for cleanup.
 
     Args:
@@ -126,6 +143,9 @@ def contextual_log_handler(context, path, log_obj=None, level=logging.DEBUG,
         level (int, optional): the logging level.  Defaults to logging.DEBUG.
         formatter (logging.Formatter, optional): the logging formatter. If None,
             defaults to ``logging.Formatter(fmt=fmt)``. Default is None.
+        current_task_only (bool, optional): only log the records of the
+            current asyncio task, the tasks it starts, and their executor
+            calls, e.g. when other tasks share ``log_obj``.  Defaults to False.
 
     Yields:
         None: but cleans up the handler afterwards.
@@ -141,6 +161,17 @@ def contextual_log_handler(context, path, log_obj=None, level=logging.DEBUG,
     contextual_handler = logging.FileHandler(path, encoding='utf-8')
     contextual_handler.setLevel(level)
     contextual_handler.setFormatter(formatter)
+    owner = None
+    if current_task_only:
+        owner = object()
+        contextual_handler.addFilter(TaskOwnerFilter(owner))
     log_obj.addHandler(contextual_handler)
-    yield
-    log_obj.removeHandler(contextual_handler)
+    try:
+        if owner is None:
+            yield
+        else:
+            with task_owner(owner):
+                yield
+    finally:
+        log_obj.removeHandler(contextual_handler)
+        contextual_handler.close()
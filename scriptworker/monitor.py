@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""Scriptworker event loop lag monitoring.
+
+While a task runs, anything that blocks the event loop delays everything
+else: heartbeats, log piping, downloads, and the other task slots.  The
+``LoopLagMonitor`` measures how late the event loop wakes up, and records
+the stack of the event loop thread whenever it's blocked for longer than
+``loop_lag_threshold`` seconds.
+
+Attributes:
+    log (logging.Logger): the log object for this module.
+
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from scriptworker.utils import RunningStats, makedirs
+
+log = logging.getLogger(__name__)
+
+
+# LoopLagMonitor {{{1
+class LoopLagMonitor(object):
+    """Sample the event loop lag, and record the stacks of blocking calls.
+
+    A coroutine on the event loop wakes up every ``loop_lag_sample_interval``
+    seconds, and records how late it woke up.  A watchdog thread checks on
+    it; if the event loop is blocked for more than ``loop_lag_threshold``
+    seconds, the watchdog records the event loop thread's current stack.
+
+    Attributes:
+        context (scriptworker.context.Context): the scriptworker context.
+        interval (float): the sample interval, in seconds.
+        lag (RunningStats): how late each sample woke up, in seconds.
+        stalls (list): a dict per stall over ``threshold``, with the
+            ``start`` timestamp, the ``duration`` in seconds, and the
+            ``stack`` of the event loop thread, if we caught it.
+        threshold (float): the stall threshold, in seconds.
+
+    """
+
+    def __init__(self, context):
+        """Initialize LoopLagMonitor.
+
+        Args:
+            context (scriptworker.context.Context): the scriptworker context.
+
+        """
+        self.context = context
+        self.interval = context.config['loop_lag_sample_interval']
+        self.threshold = context.config['loop_lag_threshold']
+        self.lag = RunningStats()
+        self.stalls = []
+        self._current_stall = None
+        self._future = None
+        self._last_tick = None
+        self._lock = threading.Lock()
+        self._loop_thread_id = None
+        self._stop_event = None
+        self._thread = None
+
+    def start(self):
+        """Start monitoring.  Call this from the event loop thread."""
+        if self._thread is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        # Each watchdog gets its own event, so a watchdog that hasn't noticed
+        # a stop yet can't be revived by the next start.
+        self._stop_event = threading.Event()
+        self._future = asyncio.ensure_future(self._sample())
+        self._thread = threading.Thread(
+            target=self._watch, args=(self._stop_event, ), name="loop-lag-monitor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop monitoring.
+
+        This signals the watchdog thread to exit, without waiting for it, so
+        it doesn't block the event loop.
+
+        """
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._future.cancel()
+        self._thread = None
+        self._future = None
+
+    async def _sample(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._tick(now, max(now - expected, 0))
+
+    def _tick(self, now, lag):
+        self.lag.add(lag)
+        with self._lock:
+            self._last_tick = now
+            if self._current_stall is not None:
+                self._current_stall['duration'] = lag
+                self._current_stall = None
+            elif lag > self.threshold:
+                # The stall ended before the watchdog caught it.
+                self.stalls.append({'start': time.time() - lag, 'duration': lag, 'stack': None})
+
+    def _watch(self, stop_event):
+        while not stop_event.wait(self.threshold / 2):
+            with self._lock:
+                if stop_event.is_set() or self._current_stall is not None:
+                    continue
+                stalled = time.monotonic() - self._last_tick - self.interval
+                if stalled > self.threshold:
+                    frame = sys._current_frames().get(self._loop_thread_id)
+                    self._current_stall = {
+                        'start': time.time() - stalled,
+                        'duration': stalled,
+                        'stack': ''.join(traceback.format_stack(frame)) if frame else None,
+                    }
+                    self.stalls.append(self._current_stall)
+
+    def get_stack_summary(self):
+        """Group the stalls by stack, worst total duration first.
+
+        Returns:
+            list: a ``(stack, count, total_duration, max_duration)`` tuple per stack.
+
+        """
+        summary = {}
+        for stall in self.stalls:
+            count, total, max_duration = summary.get(stall['stack'], (0, 0, 0))
+            summary[stall['stack']] = (count + 1, total + stall['duration'], max(max_duration, stall['duration']))
+        return sorted(
+            [(stack, ) + values for stack, values in summary.items()],
+            key=lambda item: item[2], reverse=True,
+        )
+
+    def format_report(self):
+        """Format the loop lag report.
+
+        Returns:
+            str: the report.
+
+        """
+        lines = [
+            "Event loop lag (seconds): {}".format(self.lag),
+            "Stalls over {:.3f} seconds: {}, {:.3f} seconds total".format(
+                self.threshold, len(self.stalls), sum([s['duration'] for s in self.stalls])
+            ),
+        ]
+        for stack, count, total, max_duration in self.get_stack_summary():
+            lines.append("")
+            lines.append("{:.3f} seconds total over {} stall(s), max {:.3f} seconds:".format(
+                total, count, max_duration
+            ))
+            lines.append((stack or "(stack not captured)\n").rstrip())
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path=None):
+        """Write the loop lag report.
+
+        Args:
+            path (str, optional): the path to write to.  If None, write
+                ``loop_lag.log`` into ``task_log_dir``.  Defaults to None.
+
+        Returns:
+            str: the path of the report.
+
+        """
+        path = path or get_loop_lag_log_filename(self.context)
+        makedirs(os.path.dirname(path))
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write(self.format_report())
+        return path
+
+
+# get_loop_lag_log_filename {{{1
+def get_loop_lag_log_filename(context):
+    """Get the loop lag report path, next to ``live_backing.log``.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        str: the loop lag report path.
+
+    """
+    return os.path.join(context.config['task_log_dir'], 'loop_lag.log')
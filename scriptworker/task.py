@@ -6,6 +6,7 @@ Attributes:
 
 """
 import aiohttp
+import arrow
 import asyncio
 from asyncio.subprocess import PIPE
 from copy import deepcopy
@@ -13,6 +14,7 @@ import logging
 import os
 import pprint
 import signal
+import time
 
 import taskcluster
 import taskcluster.exceptions
@@ -93,6 +95,29 @@ def get_worker_type(task):
     return task['workerType']
 
 
+# get_task_script_cmd {{{1
+def get_task_script_cmd(context):
+    """Get the ``task_script`` commandline for the task slot in ``context``.
+
+    ``%(work_dir)s``, ``%(artifact_dir)s``, and ``%(task_log_dir)s`` in the
+    ``task_script`` args are replaced with the task slot's directories, so
+    scripts running in parallel task slots don't clobber each other.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        list: the commandline to run.
+
+    """
+    cmd = []
+    for arg in context.config['task_script']:
+        for key in ('work_dir', 'artifact_dir', 'task_log_dir'):
+            arg = arg.replace('%({})s'.format(key), context.config[key])
+        cmd.append(arg)
+    return cmd
+
+
 # run_task {{{1
 async def run_task(context):
     """Run the task, sending stdout+stderr to files.
@@ -114,7 +139,7 @@ async def run_task(context):
         'close_fds': True,
         'preexec_fn': lambda: os.setsid(),
     }
-    context.proc = await asyncio.create_subprocess_exec(*context.config['task_script'], **kwargs)
+    context.proc = await asyncio.create_subprocess_exec(*get_task_script_cmd(context), **kwargs)
     loop.call_later(context.config['task_max_timeout'], max_timeout, context, context.proc, context.config['task_max_timeout'])
 
     tasks = []
@@ -131,6 +156,81 @@ async def run_task(context):
     return exitcode
 
 
+# get_taken_until {{{1
+def get_taken_until(context):
+    """Get the time our claim on the current task expires.
+
+    This is the ``takenUntil`` of the most recent reclaimTask response, or
+    the claimWork response if we haven't reclaimed yet.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        float: the ``takenUntil`` timestamp, or None if unknown.
+
+    """
+    for response in (context.reclaim_task, context.claim_task):
+        if response and response.get('takenUntil'):
+            return arrow.get(response['takenUntil']).float_timestamp
+
+
+# get_claim_time_remaining {{{1
+def get_claim_time_remaining(context):
+    """Get the time left before our claim on the current task expires.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        float: the seconds left on the claim, or None if unknown.
+
+    """
+    taken_until = get_taken_until(context)
+    if taken_until is not None:
+        return taken_until - time.time()
+
+
+# get_reclaim_sleep_time {{{1
+def get_reclaim_sleep_time(context):
+    """Get the time to sleep before the next reclaimTask heartbeat.
+
+    We aim to reclaim ``reclaim_margin`` seconds before ``takenUntil``.  If
+    we don't know ``takenUntil``, fall back to ``reclaim_interval``.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        float: the time to sleep, in seconds.
+
+    """
+    remaining = get_claim_time_remaining(context)
+    if remaining is None:
+        return context.config['reclaim_interval']
+    return max(remaining - context.config['reclaim_margin'], 0)
+
+
+# get_temp_queue {{{1
+def get_temp_queue(context):
+    """Get the taskcluster queue with the task's temp credentials.
+
+    In the control plane thread, the queue has to use the control plane
+    session, so we create one from ``context.temp_credentials``.  Otherwise
+    this is ``context.temp_queue``.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        taskcluster.async.Queue: the queue.
+
+    """
+    if context.control_plane is not None and context.control_plane.is_current_thread():
+        return context.control_plane.create_queue(context.temp_credentials)
+    return context.temp_queue
+
+
 # reclaim_task {{{1
 async def reclaim_task(context, task):
     """Try to reclaim a task from the queue.
@@ -140,6 +240,12 @@ async def reclaim_task(context, task):
     task may complete before we run, in which case we'll get a 409 the next
     time we reclaim.
 
+    Each heartbeat is scheduled ``reclaim_margin`` seconds before the
+    ``takenUntil`` of the current claim.  The time left on the claim when
+    each heartbeat actually runs is recorded in ``context.heartbeat_slack``,
+    and how late each heartbeat woke up is recorded in
+    ``context.heartbeat_delay``.
+
     Args:
         context (scriptworker.context.Context): the scriptworker context
 
@@ -149,13 +255,21 @@ async def reclaim_task(context, task):
 
     """
     while True:
-        log.debug("waiting %s seconds before reclaiming..." % context.config['reclaim_interval'])
-        await asyncio.sleep(context.config['reclaim_interval'])
+        sleep_time = get_reclaim_sleep_time(context)
+        log.debug("waiting %s seconds before reclaiming..." % sleep_time)
+        wake_time = time.time() + sleep_time
+        await asyncio.sleep(sleep_time)
         if task != context.task:
             return
+        context.heartbeat_delay.add(max(time.time() - wake_time, 0))
+        slack = get_claim_time_remaining(context)
+        if slack is not None:
+            context.heartbeat_slack.add(slack)
+            if slack < context.config['reclaim_margin'] / 2:
+                log.warning("Reclaiming task with only {:.1f} seconds left on the claim!".format(slack))
         log.debug("Reclaiming task...")
         try:
-            context.reclaim_task = await context.temp_queue.reclaimTask(
+            context.reclaim_task = await get_temp_queue(context).reclaimTask(
                 get_task_id(context.claim_task),
                 get_run_id(context.claim_task),
             )
@@ -187,18 +301,21 @@ async def complete_task(context, result):
 
     """
     args = [get_task_id(context.claim_task), get_run_id(context.claim_task)]
+    log.info("Heartbeat slack (seconds left on the claim at reclaim time): {}".format(context.heartbeat_slack))
+    log.info("Heartbeat scheduling delay (seconds): {}".format(context.heartbeat_delay))
+    temp_queue = get_temp_queue(context)
     try:
         if result == 0:
             log.info("Reporting task complete...")
-            response = await context.temp_queue.reportCompleted(*args)
+            response = await temp_queue.reportCompleted(*args)
         elif result in list(range(2, 7)):
             reason = REVERSED_STATUSES[result]
             log.info("Reporting task exception {}...".format(reason))
             payload = {"reason": reason}
-            response = await context.temp_queue.reportException(*args, payload)
+            response = await temp_queue.reportException(*args, payload)
         else:
             log.info("Reporting task failed...")
-            response = await context.temp_queue.reportFailed(*args)
+            response = await temp_queue.reportFailed(*args)
         log.debug("Task status response:\n{}".format(pprint.pformat(response)))
     except taskcluster.exceptions.TaskclusterRestFailure as exc:
         if exc.status_code == 409:
@@ -258,11 +375,13 @@ def max_timeout(context, proc, timeout):
 
 
 # claim_work {{{1
-async def claim_work(context):
-    """Find and claim the next pending task in the queue, if any.
+async def claim_work(context, num_tasks=1):
+    """Find and claim the next pending task(s) in the queue, if any.
 
     Args:
         context (scriptworker.context.Context): the scriptworker context.
+        num_tasks (int, optional): the maximum number of tasks to claim.
+            Defaults to 1.
 
     Returns:
         dict: a dict containing a list of the task definitions of the tasks claimed.
@@ -271,9 +390,7 @@ async def claim_work(context):
     payload = {
         'workerGroup': context.config['worker_group'],
         'workerId': context.config['worker_id'],
-        # Hardcode one task at a time.  Make this a pref if we allow for
-        # parallel tasks in multiple `work_dir`s.
-        'tasks': 1,
+        'tasks': num_tasks,
     }
     try:
         return await context.queue.claimWork(
@@ -267,12 +267,13 @@ def rw_context():
         context.config['gpg_lockfile'] = os.path.join(tmp, 'gpg_lockfile')
         context.config['cot_job_type'] = "signing"
         for key, value in context.config.items():
-            if key.endswith("_dir"):
+            if key.endswith("_dir") and value is not None:
                 context.config[key] = os.path.join(tmp, key)
                 makedirs(context.config[key])
             if key.endswith("key_path") or key in ("gpg_home", ):
                 context.config[key] = os.path.join(tmp, key)
         yield context
+        context.shutdown_executors()
 
 
 async def noop_async(*args, **kwargs):
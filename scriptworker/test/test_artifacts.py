@@ -1,21 +1,32 @@
+import aiohttp
+from aiohttp import web
 import arrow
+import asyncio
+import errno
+import functools
 import gzip
+import hashlib
 import json
 import operator
 import os
 import mimetypes
 import mock
 import pytest
+import stat
 import tempfile
+import time
+import tracemalloc
 
 from scriptworker.artifacts import get_expiration_arrow, guess_content_type_and_encoding, upload_artifacts, \
     create_artifact, get_artifact_url, download_artifacts, compress_artifact_if_supported, \
     _force_mimetypes_to_plain_text, _craft_artifact_put_headers, get_upstream_artifacts_full_paths_per_task_id, \
-    get_and_check_single_upstream_artifact_full_path, get_single_upstream_artifact_full_path
-from scriptworker.exceptions import ScriptWorkerRetryException, ScriptWorkerTaskException
+    get_and_check_single_upstream_artifact_full_path, get_single_upstream_artifact_full_path, scan_artifacts, \
+    UploadScheduler, _UploadStage, get_blob_artifact_info, _FilePayload
+from scriptworker.utils import retry_async
+from scriptworker.exceptions import CoTError, ScriptWorkerRetryException, ScriptWorkerTaskException
 
 
-from . import touch, rw_context, event_loop, fake_session, fake_session_500, successful_queue
+from . import touch, rw_context, event_loop, fake_session, fake_session_500, successful_queue, tmpdir
 
 
 @pytest.yield_fixture(scope='function')
@@ -89,6 +100,103 @@ def test_upload_artifacts(context, event_loop):
 
     assert sorted(args) == sorted(paths)
 
+
+def test_upload_artifacts_largest_first(context, event_loop):
+    context.config['upload_max_concurrent_compressions'] = 1
+    context.config['upload_max_concurrent_puts'] = 1
+    order = []
+    sizes = {'small.bin': 10, 'big.bin': 1000, 'medium.bin': 100, 'tiny.bin': 1}
+    for name, size in sizes.items():
+        with open(os.path.join(context.config['artifact_dir'], name), 'wb') as fh:
+            fh.write(b'x' * size)
+
+    schedulers = set()
+
+    async def fake_create(_, path, scheduler=None, **kwargs):
+        schedulers.add(scheduler)
+        async with scheduler.stages['put'].slot(os.path.getsize(path)):
+            await asyncio.sleep(.01)
+            order.append(os.path.basename(path))
+
+    with mock.patch('scriptworker.artifacts.create_artifact', new=fake_create):
+        event_loop.run_until_complete(upload_artifacts(context))
+    assert order == ['big.bin', 'medium.bin', 'small.bin', 'tiny.bin']
+    scheduler = schedulers.pop()
+    assert isinstance(scheduler, UploadScheduler)
+    assert scheduler.stages['compress'].completed == scheduler.stages['put'].completed == 4
+    assert scheduler.stages['compress'].max_queued == 3
+    assert "compress 0 active, 0 queued" in scheduler.format_queue_depths()
+    assert "compress 4 done, max queue depth 3" in scheduler.format_stats()
+
+
+def test_upload_stage(event_loop):
+    stage = _UploadStage('put', 1)
+    order = []
+
+    async def upload(name, size):
+        async with stage.slot(size):
+            order.append(name)
+            await asyncio.sleep(.01)
+
+    async def run():
+        first = asyncio.ensure_future(upload('first', 1))
+        await asyncio.sleep(0)
+        tasks = [asyncio.ensure_future(upload(name, size)) for name, size in (
+            ('small', 1), ('cancelled', 1000), ('large', 100), ('medium', 10)
+        )]
+        await asyncio.sleep(0)
+        assert (stage.active, stage.queued) == (1, 4)
+        tasks[1].cancel()
+        await asyncio.wait([first] + tasks)
+
+    event_loop.run_until_complete(run())
+    assert order == ['first', 'large', 'medium', 'small']
+    assert (stage.active, stage.queued, stage.completed, stage.max_queued) == (0, 0, 4, 4)
+
+
+def test_upload_stage_cancelled_waiter(event_loop):
+    stage = _UploadStage('put', 2)
+
+    async def run():
+        await stage.acquire(1)
+        await stage.acquire(1)
+        waiter = asyncio.ensure_future(stage.acquire(1))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.wait([waiter])
+        assert stage.queued == 0
+        stage.release()
+        # The cancelled waiter doesn't keep us off the free slot.
+        await asyncio.wait_for(stage.acquire(1), timeout=1)
+
+    event_loop.run_until_complete(run())
+    assert (stage.active, stage.queued, stage.completed) == (2, 0, 1)
+
+
+def test_upload_stage_failure(event_loop):
+    stage = _UploadStage('put', 1)
+
+    async def upload(fail):
+        async with stage.slot(1):
+            if fail:
+                raise OSError("failed")
+
+    event_loop.run_until_complete(upload(False))
+    with pytest.raises(OSError):
+        event_loop.run_until_complete(upload(True))
+    # Only the upload that succeeded counts as done.
+    assert (stage.active, stage.completed) == (0, 1)
+
+
+def test_scan_artifacts(context):
+    os.makedirs(os.path.join(context.config['artifact_dir'], 'public'))
+    for name, size in (('one', 1), ('public/two', 2), ('three', 2)):
+        with open(os.path.join(context.config['artifact_dir'], name), 'wb') as fh:
+            fh.write(b'x' * size)
+    assert [(target_path, size) for target_path, _, size in scan_artifacts(context.config['artifact_dir'])] == [
+        ('public/two', 2), ('three', 2), ('one', 1),
+    ]
+
 @pytest.mark.parametrize('filename, original_content, expected_content_type, expected_encoding', (
     ('file.txt', 'Foo bar', 'text/plain', 'gzip'),
     ('file.log',  '12:00:00 Foo bar', 'text/plain', 'gzip'),
@@ -115,6 +223,27 @@ def test_compress_artifact_if_supported(filename, original_content, expected_con
             assert f.read() == original_content
 
 
+def test_compress_artifact_if_supported_streams(tmpdir):
+    """Compression memory use doesn't grow with the artifact size."""
+    path = os.path.join(tmpdir, 'big.log')
+    line = b'0123456789abcdef' * 4 + b'\n'
+    with open(path, 'wb') as fh:
+        for _ in range(16 * 1024 * 1024 // len(line)):
+            fh.write(line)
+    os.chmod(path, 0o640)
+    tracemalloc.start()
+    try:
+        assert compress_artifact_if_supported(path) == ('text/plain', 'gzip')
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 4 * 1024 * 1024
+    assert os.listdir(tmpdir) == ['big.log']
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    with gzip.open(path, 'rb') as fh:
+        assert fh.readline() == line
+
+
 def _get_number_of_children_in_directory(directory):
     return len([name for name in os.listdir(directory)])
 
@@ -155,6 +284,190 @@ def test_create_artifact_retry(context, fake_session_500, successful_queue,
     context.session.close()
 
 
+# create_multipart_artifact {{{1
+class FakeBlobStorage(object):
+    """A local stand-in for the blob storage endpoint, which fails the parts in ``fail_parts`` once."""
+
+    def __init__(self, fail_parts=()):
+        self.attempts = {}
+        self.fail_parts = set(fail_parts)
+        self.parts = {}
+        self.url = None
+        self._app = web.Application()
+        self._app.router.add_put('/parts/{part}', self.put)
+        self._handler = None
+        self._server = None
+
+    async def put(self, request):
+        part = int(request.match_info['part'])
+        self.attempts[part] = self.attempts.get(part, 0) + 1
+        body = await request.read()
+        if part in self.fail_parts:
+            self.fail_parts.discard(part)
+            return web.Response(status=500)
+        self.parts[part] = body
+        return web.Response(headers={'ETag': hashlib.md5(body).hexdigest()})
+
+    async def start(self):
+        self._handler = self._app.make_handler()
+        self._server = await asyncio.get_event_loop().create_server(self._handler, '127.0.0.1', 0)
+        self.url = "http://127.0.0.1:{}".format(self._server.sockets[0].getsockname()[1])
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self._handler.shutdown()
+
+
+class FakeBlobQueue(object):
+
+    def __init__(self, storage, complete=True):
+        self.calls = []
+        self.storage = storage
+        if not complete:
+            # Older taskcluster clients don't have completeArtifact.
+            self.completeArtifact = None
+
+    async def createArtifact(self, task_id, run_id, name, payload):
+        self.calls.append(('createArtifact', payload))
+        return {'storageType': 'blob', 'requests': [{
+            'url': "{}/parts/{}".format(self.storage.url, num),
+            'method': 'PUT',
+            'headers': {'Content-Length': str(part['size'])},
+        } for num, part in enumerate(payload['parts'])]}
+
+    async def completeArtifact(self, task_id, run_id, name, payload):
+        self.calls.append(('completeArtifact', payload))
+
+    async def _makeApiCall(self, entry, *args):
+        self.calls.append((entry['name'], args[-1]))
+
+
+@pytest.mark.parametrize("complete", (True, False))
+def test_create_multipart_artifact(context, event_loop, complete):
+    context.config['artifact_multipart_upload_threshold'] = 100
+    context.config['artifact_upload_part_size'] = 1000
+    path = os.path.join(context.config['artifact_dir'], "installer.bin")
+    content = os.urandom(9500)
+    with open(path, "wb") as fh:
+        fh.write(content)
+    storage = FakeBlobStorage(fail_parts=[3])
+    context.temp_queue = FakeBlobQueue(storage, complete=complete)
+
+    async def run():
+        await storage.start()
+        context.session = aiohttp.ClientSession()
+        try:
+            await create_artifact(context, path, "public/installer.bin", content_type='application/binary',
+                                  content_encoding=None)
+        finally:
+            context.session.close()
+            await storage.stop()
+
+    no_sleep_retry = functools.partial(retry_async, sleeptime_callback=lambda *args, **kwargs: 0)
+    with mock.patch('scriptworker.artifacts.retry_async', new=no_sleep_retry):
+        event_loop.run_until_complete(run())
+    assert b''.join([storage.parts[num] for num in range(10)]) == content
+    # Only the failed part was sent again.
+    assert storage.attempts == {num: 2 if num == 3 else 1 for num in range(10)}
+    (_, create_payload), (complete_name, complete_payload) = context.temp_queue.calls
+    assert create_payload['storageType'] == 'blob'
+    assert create_payload['contentEncoding'] == 'identity'
+    assert create_payload['transferSha256'] == hashlib.sha256(content).hexdigest()
+    assert [part['size'] for part in create_payload['parts']] == [1000] * 9 + [500]
+    assert complete_name == 'completeArtifact'
+    assert complete_payload == {'etags': [hashlib.md5(storage.parts[num]).hexdigest() for num in range(10)]}
+
+
+def test_create_multipart_artifact_put_slot(context, event_loop):
+    context.config['artifact_multipart_upload_threshold'] = 100
+    context.config['artifact_upload_part_size'] = 1000
+    context.config['upload_max_concurrent_puts'] = 1
+    path = os.path.join(context.config['artifact_dir'], "installer.bin")
+    with open(path, "wb") as fh:
+        fh.write(os.urandom(3000))
+    storage = FakeBlobStorage()
+    context.temp_queue = FakeBlobQueue(storage)
+    scheduler = UploadScheduler(context)
+
+    async def upload():
+        await create_artifact(context, path, "public/installer.bin", content_type='application/binary',
+                              content_encoding=None, scheduler=scheduler)
+
+    async def run():
+        await storage.start()
+        context.session = aiohttp.ClientSession()
+        try:
+            await scheduler.stages['put'].acquire(1)
+            # No part starts before the upload gets its put slot...
+            cancelled = asyncio.ensure_future(upload())
+            await asyncio.sleep(.1)
+            assert storage.attempts == {}
+            # ... or after it's cancelled while it waits.
+            cancelled.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await cancelled
+            future = asyncio.ensure_future(upload())
+            await asyncio.sleep(.1)
+            assert storage.attempts == {}
+            scheduler.stages['put'].release()
+            await future
+        finally:
+            context.session.close()
+            await storage.stop()
+
+    event_loop.run_until_complete(run())
+    assert storage.attempts == {0: 1, 1: 1, 2: 1}
+
+
+# _FilePayload {{{1
+@pytest.mark.parametrize("use_sendfile,sendfile_error,expected", (
+    (True, None, 'sendfile'),
+    (True, OSError(errno.EINVAL, "Invalid argument"), 'buffered'),
+    (False, None, 'buffered'),
+))
+def test_file_payload(tmpdir, event_loop, use_sendfile, sendfile_error, expected):
+    path = os.path.join(tmpdir, "installer.bin")
+    content = os.urandom(512 * 1024)
+    with open(path, "wb") as fh:
+        fh.write(content)
+    storage = FakeBlobStorage()
+    payloads = [_FilePayload(path, use_sendfile=use_sendfile),
+                _FilePayload(path, offset=1000, size=2000, use_sendfile=use_sendfile)]
+
+    async def run():
+        await storage.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                for num, payload in enumerate(payloads):
+                    async with session.put("{}/parts/{}".format(storage.url, num), data=payload,
+                                           skip_auto_headers=[aiohttp.hdrs.CONTENT_TYPE]) as resp:
+                        assert resp.status == 200
+        finally:
+            await storage.stop()
+
+    with mock.patch('os.sendfile', side_effect=sendfile_error, wraps=os.sendfile):
+        event_loop.run_until_complete(run())
+    assert storage.parts == {0: content, 1: content[1000:3000]}
+    assert [payload.sent_with for payload in payloads] == [expected, expected]
+
+
+def test_get_blob_artifact_info(tmpdir):
+    path = os.path.join(tmpdir, "file.log")
+    content = b'0123456789' * 300
+    with gzip.open(path, "wb") as fh:
+        fh.write(content)
+    with open(path, "rb") as fh:
+        compressed = fh.read()
+    info = get_blob_artifact_info(path, 10, content_encoding='gzip')
+    assert info['contentSha256'] == hashlib.sha256(content).hexdigest()
+    assert info['contentLength'] == len(content)
+    assert info['transferSha256'] == hashlib.sha256(compressed).hexdigest()
+    assert info['transferLength'] == len(compressed)
+    assert info['parts'][0] == {'sha256': hashlib.sha256(compressed[:10]).hexdigest(), 'size': 10}
+    assert sum([part['size'] for part in info['parts']]) == len(compressed)
+
+
 def test_craft_artifact_put_headers():
     assert _craft_artifact_put_headers('text/plain') == {'Content-Type': 'text/plain'}
     assert _craft_artifact_put_headers('text/plain', encoding=None) == {'Content-Type': 'text/plain'}
@@ -209,6 +522,71 @@ def test_download_artifacts(context, event_loop):
     assert sorted(urls) == sorted(expected_urls)
 
 
+def test_download_artifacts_expected_digests(context, event_loop):
+    url = "https://queue.taskcluster.net/v1/task/dependency1/artifacts/foo/bar"
+    calls = []
+
+    async def foo(_, url, path, expected_digests=None, **kwargs):
+        calls.append(expected_digests)
+        raise CoTError("BAD HASH")
+
+    # A bad digest isn't retried.
+    with pytest.raises(CoTError):
+        event_loop.run_until_complete(
+            download_artifacts(context, [url], download_func=foo, expected_digests={url: {'sha256': 'sha'}})
+        )
+    assert calls == [{'sha256': 'sha'}]
+
+
+def test_download_artifacts_fail_fast(context, event_loop):
+    urls = [
+        "https://queue.taskcluster.net/v1/task/dependency1/artifacts/slow",
+        "https://queue.taskcluster.net/v1/task/dependency1/artifacts/bad",
+    ]
+    partial_path = os.path.join(context.config['work_dir'], "slow.part")
+
+    async def foo(_, url, path, **kwargs):
+        if url.endswith('bad'):
+            raise CoTError("BAD HASH")
+        touch(partial_path)
+        await asyncio.sleep(10)
+
+    start = time.time()
+    with pytest.raises(CoTError):
+        event_loop.run_until_complete(download_artifacts(context, urls, download_func=foo))
+    assert time.time() - start < 5
+    assert not os.path.exists(partial_path)
+
+
+def test_download_artifacts_cache(context, event_loop):
+    context.config['artifact_cache_dir'] = os.path.join(context.config['work_dir'], '..', 'cache')
+    url = "https://queue.taskcluster.net/v1/task/dependency1/artifacts/foo/bar"
+    path = os.path.join(context.config['work_dir'], "foo", "bar")
+    calls = []
+
+    async def foo(_, url, path, **kwargs):
+        calls.append(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        touch(path)
+
+    sha256 = hashlib.sha256(path.encode('utf-8')).hexdigest()  # touch() writes the path
+    for expected_digests in (None, {url: {'sha256': sha256}}, {url: {'sha256': sha256}}, {url: {'sha256': '0' * 64}}):
+        event_loop.run_until_complete(download_artifacts(context, [url], download_func=foo,
+                                                         expected_digests=expected_digests))
+        # The artifacts are added to the cache in the background.
+        event_loop.run_until_complete(asyncio.gather(*context.artifact_cache.pending_adds))
+        if expected_digests is None:
+            # We only look artifacts up by sha256, so we don't cache the ones
+            # we don't know the sha256 of.
+            assert not os.path.exists(os.path.join(context.config['artifact_cache_dir'], 'content'))
+        assert os.path.exists(path)
+        os.remove(path)
+    # An unknown sha256 is a cache miss.
+    assert calls == [url, url, url]
+    assert context.artifact_cache.hits == 1
+    assert context.artifact_cache.misses == 3
+
+
 def test_get_upstream_artifacts_full_paths_per_task_id(context):
     context.task['payload'] = {
         'upstreamArtifacts': [{
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Test scriptworker.cache
+"""
+import arrow
+import hashlib
+import mock
+import os
+import pytest
+import stat
+import time
+import scriptworker.cache as cache
+from . import event_loop, rw_context
+
+assert event_loop  # silence flake8
+
+
+# constants helpers and fixtures {{{1
+@pytest.yield_fixture(scope='function')
+def context(rw_context):
+    rw_context.config['artifact_cache_dir'] = os.path.join(rw_context.config['work_dir'], '..', 'cache')
+    yield rw_context
+
+
+def write_file(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.write(contents)
+    return hashlib.sha256(contents).hexdigest()
+
+
+def read_file(path):
+    with open(path, "rb") as fh:
+        return fh.read()
+
+
+# get_artifact_cache {{{1
+def test_get_artifact_cache(context):
+    artifact_cache = cache.get_artifact_cache(context)
+    assert artifact_cache.path == context.config['artifact_cache_dir']
+    assert artifact_cache.max_size == context.config['artifact_cache_max_size']
+    assert cache.get_artifact_cache(context) is artifact_cache
+    context.config['artifact_cache_dir'] = None
+    assert cache.get_artifact_cache(context) is None
+
+
+# ArtifactCache {{{1
+def test_artifact_cache(context):
+    artifact_cache = cache.get_artifact_cache(context)
+    path = os.path.join(context.config['work_dir'], "one")
+    sha256 = write_file(path, b"one")
+    mode = os.stat(path).st_mode
+    assert artifact_cache.add(path) == sha256
+    # The cached artifact is a read-only copy; the original is untouched.
+    content_path = artifact_cache.get_content_path(sha256)
+    assert not os.stat(content_path).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    assert os.stat(path).st_mode == mode
+    assert not os.path.samefile(path, content_path)
+    # Writing to the original doesn't change the cache.
+    write_file(path, b"modified")
+    dest = os.path.join(context.config['work_dir'], "sub", "dir", "dest")
+    assert artifact_cache.materialize(sha256, dest, expected_digests={'sha256': sha256})
+    assert read_file(dest) == b"one"
+    assert not os.path.samefile(dest, content_path)
+    assert artifact_cache.materialize("0" * 64, dest) is False
+    assert os.listdir(os.path.join(artifact_cache.path, 'tmp')) == []
+
+
+def test_artifact_cache_materialize_bad_digest(context):
+    artifact_cache = cache.get_artifact_cache(context)
+    path = os.path.join(context.config['work_dir'], "one")
+    sha256 = write_file(path, b"one")
+    artifact_cache.add(path)
+    content_path = artifact_cache.get_content_path(sha256)
+    os.chmod(content_path, 0o644)
+    write_file(content_path, b"poisoned")
+    dest = os.path.join(context.config['work_dir'], "dest")
+    assert artifact_cache.materialize(sha256, dest, expected_digests={'sha256': sha256}) is False
+    assert not os.path.exists(dest)
+    assert not os.path.exists(content_path)
+
+
+def test_artifact_cache_materialize_evicted(context, mocker):
+    artifact_cache = cache.get_artifact_cache(context)
+    path = os.path.join(context.config['work_dir'], "one")
+    write_file(path, b"one")
+    sha256 = artifact_cache.add(path)
+    dest = os.path.join(context.config['work_dir'], "dest")
+
+    def utime(path, *args, **kwargs):
+        # Another scriptworker evicts the entry after we copy it.
+        os.remove(path)
+        raise FileNotFoundError(path)
+
+    mocker.patch.object(cache.os, 'utime', new=utime)
+    assert artifact_cache.materialize(sha256, dest, expected_digests={'sha256': sha256})
+    assert read_file(dest) == b"one"
+
+
+def test_artifact_cache_add_in_background(context, event_loop):
+    artifact_cache = cache.get_artifact_cache(context)
+    paths = [os.path.join(context.config['work_dir'], name) for name in ("one", "missing")]
+    sha256 = write_file(paths[0], b"one")
+    future = artifact_cache.add_in_background(context, [(path, sha256) for path in paths])
+    assert artifact_cache.pending_adds == {future}
+    event_loop.run_until_complete(future)
+    assert artifact_cache.pending_adds == set()
+    assert os.path.exists(artifact_cache.get_content_path(sha256))
+
+
+def test_artifact_cache_evict(context):
+    artifact_cache = cache.get_artifact_cache(context)
+    shas = []
+    for name in ("one", "two", "three"):
+        path = os.path.join(context.config['work_dir'], name)
+        shas.append(write_file(path, name.encode('utf-8') * 2))
+        artifact_cache.add(path, sha256=shas[-1])
+        # Make sure the mtimes differ.
+        os.utime(artifact_cache.get_content_path(shas[-1]), (time.time() + len(shas), ) * 2)
+    # "oneone" is the least recently used, and "threethree" fills the cache.
+    artifact_cache.max_size = 10
+    assert artifact_cache.evict() == [shas[0], shas[1]]
+    assert not os.path.exists(artifact_cache.get_content_path(shas[0]))
+    assert os.path.exists(artifact_cache.get_content_path(shas[2]))
+
+
+
+def test_artifact_cache_add_records_size(context, mocker):
+    artifact_cache = cache.get_artifact_cache(context)
+    artifact_cache.max_size = 20
+    walk = mocker.spy(artifact_cache, '_evict')
+    shas = []
+    for name in ("one", "two", "three", "four"):
+        path = os.path.join(context.config['work_dir'], name)
+        shas.append(write_file(path, name.encode('utf-8') * 2))
+        artifact_cache.add(path)
+        # Make sure the mtimes differ, and the new artifact is the newest.
+        os.utime(artifact_cache.get_content_path(shas[-1]), (time.time() - 100 + len(shas), ) * 2)
+    # We only walk the cache to get the first size, and when "threethree"
+    # and "fourfour" push it over max_size.
+    assert walk.call_count == 3
+    assert artifact_cache._read_size() == len("threethreefourfour")
+    assert not os.path.exists(artifact_cache.get_content_path(shas[1]))
+    assert os.path.exists(artifact_cache.get_content_path(shas[2]))
+
+# TaskDefinitionCache {{{1
+@pytest.fixture(scope='function')
+def queue_calls(context):
+    calls = []
+
+    async def task(task_id):
+        calls.append(task_id)
+        if task_id == 'expired':
+            expires = arrow.utcnow().shift(days=-1)
+        else:
+            expires = arrow.utcnow().shift(days=1)
+        return {'taskId': task_id, 'expires': expires.isoformat()}
+
+    context.queue = mock.MagicMock()
+    context.queue.task = task
+    return calls
+
+
+@pytest.mark.parametrize("cache_dir", (True, False))
+def test_task_definition_cache(context, queue_calls, event_loop, cache_dir):
+    if cache_dir:
+        context.config['task_definition_cache_dir'] = os.path.join(context.config['work_dir'], 'tasks')
+    task_cache = cache.get_task_definition_cache(context)
+    assert cache.get_task_definition_cache(context) is task_cache
+    for task_id in ('one', 'one', 'expired', 'expired'):
+        task_defn = event_loop.run_until_complete(task_cache.get(task_id))
+        assert task_defn['taskId'] == task_id
+    # Callers can't modify the cached copy.
+    task_defn['taskId'] = 'modified'
+    assert event_loop.run_until_complete(task_cache.get('one'))['taskId'] == 'one'
+    assert queue_calls == ['one', 'expired', 'expired']
+    assert (task_cache.hits, task_cache.misses) == (2, 3)
+    assert task_cache.format_stats() == "Task definition cache: hits=2 misses=3"
+    # A new cache reads the first one's files, if we have a cache_dir.
+    task_cache = cache.TaskDefinitionCache(context)
+    event_loop.run_until_complete(task_cache.get('one'))
+    assert task_cache.hits == int(cache_dir)
+
+
+def test_task_definition_cache_memory_entries(context, queue_calls, event_loop):
+    task_cache = cache.TaskDefinitionCache(context, max_memory_entries=2)
+    for task_id in ('one', 'two', 'one', 'three', 'two'):
+        event_loop.run_until_complete(task_cache.get(task_id))
+    assert queue_calls == ['one', 'two', 'three', 'two']
+    assert list(task_cache._memory.keys()) == ['three', 'two']
+
+
+@pytest.mark.parametrize("task_defn,expected", ((
+    {}, True
+), (
+    {'expires': '2000-01-01T00:00:00.000Z'}, True
+), (
+    {'expires': '3000-01-01T00:00:00.000Z'}, False
+)))
+def test_is_expired(task_defn, expected):
+    assert cache.is_expired(task_defn) is expected
+
+
+# CoTVerificationCache {{{1
+def test_cot_verification_cache(context):
+    assert cache.get_cot_verification_cache(context) is None
+    context.config['cot_verification_cache_dir'] = os.path.join(context.config['work_dir'], 'cot_cache')
+    cot_cache = cache.get_cot_verification_cache(context)
+    assert cache.get_cot_verification_cache(context) is cot_cache
+    key = cot_cache.get_key('signed', 'rev', 'docker-worker', True)
+    assert key == cot_cache.get_key('signed', 'rev', 'docker-worker', True)
+    for args in (('signed2', 'rev', 'docker-worker', True), ('signed', 'rev2', 'docker-worker', True),
+                 ('signed', 'rev', 'generic-worker', True), ('signed', 'rev', 'docker-worker', False)):
+        assert cot_cache.get_key(*args) != key
+    assert cot_cache.get(key) is None
+    cot_cache.add(key, {'taskId': 'one'})
+    assert cot_cache.get(key) == {'taskId': 'one'}
+    assert cot_cache.format_stats() == "Chain of trust verification cache: hits=1 misses=1"
@@ -141,6 +141,12 @@ def test_check_config_good(t_config):
     assert messages == []
 
 
+def test_check_config_sub_second_poll(t_config):
+    t_config = _fill_missing_values(t_config)
+    t_config['min_poll_interval'] = 0.5
+    assert config.check_config(t_config, "test_path") == []
+
+
 # create_config {{{1
 def test_create_config_missing_file():
     with pytest.raises(SystemExit):
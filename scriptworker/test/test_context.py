@@ -2,9 +2,11 @@
 # coding=utf-8
 """Test scriptworker.context
 """
+from frozendict import frozendict
 import json
 import os
 import pytest
+import scriptworker.context as swcontext
 import taskcluster
 from . import tmpdir
 from . import rw_context as context
@@ -90,3 +92,54 @@ def test_temp_queue(context, mocker):
     assert taskcluster.async.Queue.called_once_with({
         'credentials': context.temp_credentials,
     }, session=context.session)
+
+
+@pytest.mark.parametrize("task_log_dir,expected", ((
+    "/artifact/public/logs", "/artifact/3/public/logs"
+), (
+    "/logs", "/logs/3"
+)))
+def test_get_slot_config(task_log_dir, expected):
+    config = frozendict({
+        'work_dir': '/work',
+        'artifact_dir': '/artifact',
+        'task_log_dir': task_log_dir,
+        'other': True,
+    })
+    slot_config = swcontext.get_slot_config(config, 3)
+    assert isinstance(slot_config, frozendict)
+    assert slot_config == {
+        'work_dir': '/work/3',
+        'artifact_dir': '/artifact/3',
+        'task_log_dir': expected,
+        'other': True,
+    }
+
+
+def test_create_task_context(context, claim_task):
+    context.session = {'c': 'd'}
+    context.credentials = {'a': 'b'}
+    task_context = context.create_task_context(1)
+    assert task_context.slot_id == 1
+    assert task_context.session is context.session
+    assert task_context.queue is context.queue
+    assert task_context.credentials == context.credentials
+    assert task_context.config['work_dir'] == os.path.join(context.config['work_dir'], '1')
+    assert task_context.task_definition_cache is context.task_definition_cache is not None
+    assert task_context.task_graph_store is context.task_graph_store is not None
+    task_context.claim_task = claim_task
+    assert context.claim_task is None
+    assert get_json(get_task_file(task_context)) == claim_task['task']
+
+
+@pytest.mark.parametrize("max_threads,expected", ((4, "ThreadPoolExecutor"), (0, None)))
+def test_get_executor(context, max_threads, expected):
+    context.config['executor_max_threads'] = max_threads
+    executor = context.get_executor()
+    assert (executor and executor.__class__.__name__) == expected
+    assert context.get_executor() is executor
+    # task contexts share the pool
+    task_context = context.create_task_context(1)
+    assert task_context.get_executor() is executor
+    context.shutdown_executors()
+    assert context.executors == {}
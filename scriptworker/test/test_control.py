@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Test scriptworker.control
+"""
+import asyncio
+import mock
+import pytest
+import threading
+import time
+import scriptworker.control as control
+import scriptworker.task as task
+import taskcluster.exceptions
+from . import event_loop, rw_context
+
+assert event_loop  # silence flake8
+
+
+# constants helpers and fixtures {{{1
+@pytest.yield_fixture(scope='function')
+def context(rw_context):
+    rw_context.config['reclaim_interval'] = 0.001
+    rw_context.claim_task = {
+        'credentials': {'a': 'b'},
+        'status': {'taskId': 'taskId'},
+        'task': {'task_defn': True},
+        'runId': 'runId',
+    }
+    yield rw_context
+
+
+@pytest.yield_fixture(scope='function')
+def control_plane(context):
+    control_plane = control.get_control_plane(context)
+    yield control_plane
+    control_plane.stop()
+
+
+# get_control_plane {{{1
+def test_get_control_plane(context):
+    context.config['control_plane_thread'] = False
+    assert control.get_control_plane(context) is None
+    context.config['control_plane_thread'] = True
+    control_plane = control.get_control_plane(context)
+    try:
+        assert context.control_plane is control_plane
+        assert control_plane.thread.is_alive()
+        assert control.get_control_plane(context) is control_plane
+    finally:
+        control_plane.stop()
+    assert control_plane.thread is None
+
+
+# ControlPlane {{{1
+def test_control_plane_run(control_plane, event_loop):
+
+    async def in_thread():
+        return threading.current_thread()
+
+    result = event_loop.run_until_complete(control_plane.run(in_thread()))
+    assert result is control_plane.thread
+    assert control_plane.is_current_thread() is False
+    assert control_plane.dispatch_delay.count == 1
+
+
+def test_control_plane_run_exception(control_plane, event_loop):
+
+    async def die():
+        raise taskcluster.exceptions.TaskclusterRestFailure("foo", None, status_code=500)
+
+    with pytest.raises(taskcluster.exceptions.TaskclusterRestFailure):
+        event_loop.run_until_complete(control_plane.run(die()))
+
+
+def test_control_plane_blocked_main_loop(control_plane, event_loop):
+    """Coroutines on the control plane keep running while the main loop blocks."""
+    ran = threading.Event()
+
+    async def heartbeat():
+        await asyncio.sleep(0.01)
+        ran.set()
+
+    control_plane.submit(heartbeat())
+
+    async def block():
+        time.sleep(0.5)
+        return ran.is_set()
+
+    assert event_loop.run_until_complete(block())
+
+
+def test_control_plane_stop_cancels(context):
+    control_plane = control.get_control_plane(context)
+
+    async def forever():
+        await asyncio.sleep(1000)
+
+    future = control_plane.submit(forever())
+    control_plane.stop()
+    assert future.cancelled()
+
+
+# reclaim_task / complete_task {{{1
+def test_control_plane_reclaim_and_complete(context, control_plane, event_loop):
+    reclaims = []
+    reports = []
+
+    async def fake_reclaim(*args, **kwargs):
+        assert control_plane.is_current_thread()
+        reclaims.append(args)
+        if len(reclaims) > 1:
+            raise taskcluster.exceptions.TaskclusterRestFailure("foo", None, status_code=409)
+        return {'credentials': {'c': 'd'}}
+
+    async def fake_report(*args, **kwargs):
+        assert control_plane.is_current_thread()
+        reports.append(args)
+
+    queue = mock.MagicMock()
+    queue.reclaimTask = fake_reclaim
+    queue.reportCompleted = fake_report
+    with mock.patch.object(control_plane, 'create_queue', return_value=queue):
+        event_loop.run_until_complete(control_plane.run(task.reclaim_task(context, context.task)))
+        event_loop.run_until_complete(control_plane.run(task.complete_task(context, 0)))
+    assert reclaims == [('taskId', 'runId'), ('taskId', 'runId')]
+    assert reports == [('taskId', 'runId')]
+    assert context.heartbeat_delay.count == 2
+    # Outside the control plane thread, we use context.temp_queue.
+    assert task.get_temp_queue(context) is context.temp_queue
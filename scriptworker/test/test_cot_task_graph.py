@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Test scriptworker.cot.task_graph
+"""
+import asyncio
+import json
+import os
+import pytest
+import scriptworker.cot.task_graph as task_graph
+from . import event_loop, rw_context
+
+assert event_loop  # silence flake8
+
+TASK_GRAPH = {
+    "one": {"task": {"payload": {"a": [1, 2, {"b": "}"}, "\\\"]"]}}},
+    "two \"quoted\"": {"task": {}},
+    "three": [],
+}
+
+
+# constants helpers and fixtures {{{1
+@pytest.yield_fixture(scope='function')
+def context(rw_context):
+    yield rw_context
+
+
+def write_graph(context, contents, name="task-graph.json"):
+    path = os.path.join(context.config['work_dir'], name)
+    with open(path, "w") as fh:
+        if isinstance(contents, str):
+            fh.write(contents)
+        else:
+            json.dump(contents, fh, indent=2)
+    return path
+
+
+# index_json_object {{{1
+@pytest.mark.parametrize("text", (
+    json.dumps(TASK_GRAPH), json.dumps(TASK_GRAPH, indent=2), "  {} ", "{\n}",
+    '{"a": [], "b": {"c": {}}, "d": "e", "f": [[1], {"g": null}]}',
+))
+def test_index_json_object(text):
+    offsets = task_graph.index_json_object(text)
+    expected = json.loads(text)
+    assert sorted(offsets.keys()) == sorted(expected.keys())
+    for key, (start, end) in offsets.items():
+        assert json.loads(text[start:end]) == expected[key]
+
+
+@pytest.mark.parametrize("text", (
+    "", "[]", "{", '{"a" 1}', '{"a": 1', '{"a": 1 "b": 2}', '{"a": 1} x', "{1: 2}",
+    '{"a": {"b": "}"}', '{"a": [1, 2}',
+))
+def test_index_json_object_exception(text):
+    with pytest.raises(ValueError):
+        task_graph.index_json_object(text)
+
+
+def test_index_json_object_doesnt_decode_values():
+    text = '{"good": {"a": 1}, "bad": {"a": nope}}'
+    offsets = task_graph.index_json_object(text)
+    graph = task_graph.TaskGraph(text)
+    assert graph["good"] == {"a": 1}
+    assert text[slice(*offsets["bad"])] == '{"a": nope}'
+    with pytest.raises(ValueError):
+        graph["bad"]
+
+
+# TaskGraph {{{1
+def test_task_graph(context):
+    graph = task_graph.TaskGraph.from_path(write_graph(context, TASK_GRAPH))
+    assert len(graph) == 3
+    assert "one" in graph
+    assert "four" not in graph
+    assert dict(graph) == TASK_GRAPH
+    # Each lookup gets its own copy.
+    graph["one"]["task"]["payload"] = None
+    assert graph["one"] == TASK_GRAPH["one"]
+    with pytest.raises(KeyError):
+        graph["four"]
+    assert graph.decode() == TASK_GRAPH
+
+
+# TaskGraphStore {{{1
+def test_task_graph_store(context, event_loop):
+    store = task_graph.get_task_graph_store(context)
+    assert task_graph.get_task_graph_store(context) is store
+    path = write_graph(context, TASK_GRAPH)
+    other_path = write_graph(context, {"other": {}}, name="other.json")
+
+    async def get_graphs():
+        return await asyncio.gather(
+            store.get("decision", path), store.get("decision", path),
+            store.get("other_decision", path), store.get("decision", other_path),
+        )
+
+    graphs = event_loop.run_until_complete(get_graphs())
+    assert graphs[0] is graphs[1]
+    assert graphs[2] is not graphs[0]
+    assert list(graphs[3]) == ["other"]
+    assert (store.hits, store.misses) == (1, 3)
+    assert store.format_stats() == "Task graph store: hits=1 misses=3"
+
+
+def test_task_graph_store_sha256(context, event_loop, mocker):
+    store = task_graph.TaskGraphStore(context)
+    path = write_graph(context, TASK_GRAPH)
+    get_hash = mocker.patch.object(task_graph, 'get_hash')
+    graph = event_loop.run_until_complete(store.get("decision", path, sha256="sha"))
+    assert event_loop.run_until_complete(store.get("decision", path, sha256="sha")) is graph
+    get_hash.assert_not_called()
+    assert (store.hits, store.misses) == (1, 1)
+
+
+def test_task_graph_store_evict(context, event_loop):
+    store = task_graph.TaskGraphStore(context, max_entries=1)
+    path = write_graph(context, TASK_GRAPH)
+    first = event_loop.run_until_complete(store.get("decision", path))
+    event_loop.run_until_complete(store.get("other_decision", path))
+    assert event_loop.run_until_complete(store.get("decision", path)) is not first
+    assert store.misses == 3
+
+
+def test_task_graph_store_exception(context, event_loop):
+    store = task_graph.TaskGraphStore(context)
+    path = write_graph(context, "{")
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            event_loop.run_until_complete(store.get("decision", path))
+    # Failed loads aren't kept.
+    assert store.misses == 2
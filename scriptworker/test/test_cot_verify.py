@@ -5,16 +5,20 @@
 import asyncio
 from copy import deepcopy
 from frozendict import frozendict
+import hashlib
 import json
 import logging
 import mock
 import os
 import pytest
 import tempfile
+import threading
+import time
 from taskcluster.exceptions import TaskclusterFailure
 import scriptworker.cot.verify as cotverify
+import scriptworker.cot.task_graph as cot_task_graph
 from scriptworker.exceptions import CoTError, ScriptWorkerGPGException
-from scriptworker.utils import makedirs
+from scriptworker.utils import get_hash, makedirs
 from . import noop_async, noop_sync, rw_context, tmpdir, touch
 
 assert rw_context, tmpdir  # silence pyflakes
@@ -34,6 +38,10 @@ async def die_async(*args, **kwargs):
     raise CoTError("x")
 
 
+def die_sync(*args, **kwargs):
+    raise CoTError("x")
+
+
 @pytest.yield_fixture(scope='function')
 def chain(rw_context):
     rw_context.config['scriptworker_provisioners'] = [rw_context.config['provisioner_id']]
@@ -174,17 +182,45 @@ def test_dependent_task_ids(chain):
     ids = ["one", "TWO", "thr33", "vier"]
     for i in ids:
         l = cotverify.LinkOfTrust(chain.context, 'build', i)
-        chain.links.append(l)
+        chain.add_link(l)
     assert sorted(chain.dependent_task_ids()) == sorted(ids)
 
 
+# chain indexes {{{1
+def test_chain_indexes(chain, build_link, decision_link, docker_image_link):
+    docker_image_link.decision_task_id = 'other'
+    chain.links = [decision_link, build_link]
+    chain.add_link(docker_image_link)
+    assert chain.links == (decision_link, build_link, docker_image_link)
+    # The links can't be modified behind the indexes' backs.
+    with pytest.raises(AttributeError):
+        chain.links.append(decision_link)
+    assert chain.has_link('build_task_id')
+    assert not chain.has_link('task_id')
+    assert chain.get_link('docker_image_task_id') is docker_image_link
+    assert chain.get_links_by_task_type('decision') == [decision_link]
+    assert chain.get_links_by_task_type('signing') == []
+    assert chain.get_links_by_decision_task_id('decision_task_id') == [decision_link, build_link]
+    chain.links = [build_link]
+    assert not chain.has_link('decision_task_id')
+    assert chain.get_links_by_task_type('decision') == []
+
+
+def test_link_slots(chain):
+    link = cotverify.LinkOfTrust(chain.context, 'build', 'task_id')
+    assert link.task is None
+    assert link.worker_impl is None
+    with pytest.raises(AttributeError):
+        link.unknown_attribute = True
+
+
 # is_try {{{1
 @pytest.mark.parametrize("bools,expected", (([False, False], False), ([False, True], True)))
 def test_chain_is_try(chain, bools, expected):
     for b in bools:
         m = mock.MagicMock()
         m.is_try = b
-        chain.links.append(m)
+        chain.add_link(m)
     assert chain.is_try() == expected
 
 
@@ -209,7 +245,7 @@ def test_is_try(task):
 def test_get_link(chain, ids, req, raises):
     for i in ids:
         l = cotverify.LinkOfTrust(chain.context, 'build', i)
-        chain.links.append(l)
+        chain.add_link(l)
     if raises:
         with pytest.raises(CoTError):
             chain.get_link(req)
@@ -463,6 +499,59 @@ async def test_build_task_dependencies(chain, mocker, event_loop):
         await cotverify.build_task_dependencies(chain, {}, 'build', 'task_id')
 
 
+@pytest.mark.parametrize("max_fetches,expected_max_in_flight", ((10, 3), (2, 2)))
+def test_build_task_dependencies_concurrent(chain, event_loop, max_fetches, expected_max_in_flight):
+    """Fetch each level concurrently, but keep the depth-first link names and order."""
+    def task_defn(upstream=None, inputs=None):
+        return {
+            'taskGroupId': 'decision_task_id',
+            'provisionerId': '',
+            'schedulerId': '',
+            'workerType': '',
+            'scopes': [],
+            'payload': {
+                'image': 'x',
+                'upstreamArtifacts': [{'taskId': task_id, 'taskType': task_type} for task_type, task_id in upstream or []],
+            },
+            'extra': {'chainOfTrust': {'inputs': inputs or {}}},
+            'metadata': {},
+        }
+
+    graph = {
+        'decision_task_id': task_defn(),
+        'build_task_id': task_defn(inputs={'docker-image': 'docker_image_task_id'}),
+        'l10n_task_id': task_defn(upstream=[('build', 'build_task_id')]),
+        'docker_image_task_id': task_defn(),
+    }
+    calls = []
+    in_flight = []
+    max_in_flight = []
+
+    async def fake_task(task_id):
+        calls.append(task_id)
+        in_flight.append(task_id)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(.01)
+        in_flight.remove(task_id)
+        return graph[task_id]
+
+    chain.context.config['cot_max_concurrent_task_fetches'] = max_fetches
+    chain.context.queue = mock.MagicMock()
+    chain.context.queue.task = fake_task
+    top = task_defn(upstream=[('l10n', 'l10n_task_id'), ('build', 'build_task_id')])
+    event_loop.run_until_complete(cotverify.build_task_dependencies(chain, top, 'signing', 'task_id'))
+    assert [(link.name, link.task_id) for link in chain.links] == [
+        ('signing:decision', 'decision_task_id'),
+        ('signing:build', 'build_task_id'),
+        ('signing:build:docker-image', 'docker_image_task_id'),
+        ('signing:l10n', 'l10n_task_id'),
+    ]
+    assert sorted(calls) == sorted(graph.keys())
+    assert max(max_in_flight) == expected_max_in_flight
+    for link in chain.links:
+        assert os.path.exists(link.get_artifact_full_path('task.json'))
+
+
 # download_cot {{{1
 @pytest.mark.parametrize("raises", (True, False))
 @pytest.mark.asyncio
@@ -501,8 +590,10 @@ async def test_download_cot(chain, mocker, raises, event_loop):
 @pytest.mark.asyncio
 async def test_download_cot_artifact(chain, path, sha, raises, mocker, event_loop):
 
-    def fake_get_hash(*args, **kwargs):
-        return sha
+    async def fake_download(*args, expected_digests=None, **kwargs):
+        for url, digests in expected_digests.items():
+            if digests['sha256'] != sha:
+                raise CoTError("BAD HASH")
 
     link = mock.MagicMock()
     link.task_id = 'task_id'
@@ -520,8 +611,7 @@ async def test_download_cot_artifact(chain, path, sha, raises, mocker, event_loo
     }
     chain.links = [link]
     mocker.patch.object(cotverify, 'get_artifact_url', new=noop_sync)
-    mocker.patch.object(cotverify, 'download_artifacts', new=noop_async)
-    mocker.patch.object(cotverify, 'get_hash', new=fake_get_hash)
+    mocker.patch.object(cotverify, 'download_artifacts', new=fake_download)
     if raises:
         with pytest.raises(CoTError):
             await cotverify.download_cot_artifact(chain, 'task_id', path)
@@ -581,14 +671,14 @@ async def test_download_firefox_cot_artifacts(chain, decision_link, build_link,
 
 
 # verify_cot_signatures {{{1
-def test_verify_cot_signatures_no_file(chain, build_link, mocker):
+def test_verify_cot_signatures_no_file(chain, build_link, mocker, event_loop):
     chain.links = [build_link]
     mocker.patch.object(cotverify, 'GPG', new=noop_sync)
     with pytest.raises(CoTError):
-        cotverify.verify_cot_signatures(chain)
+        event_loop.run_until_complete(cotverify.verify_cot_signatures(chain))
 
 
-def test_verify_cot_signatures_bad_sig(chain, build_link, mocker):
+def test_verify_cot_signatures_bad_sig(chain, build_link, mocker, event_loop):
 
     def die(*args, **kwargs):
         raise ScriptWorkerGPGException("x")
@@ -600,10 +690,10 @@ def test_verify_cot_signatures_bad_sig(chain, build_link, mocker):
     mocker.patch.object(cotverify, 'GPG', new=noop_sync)
     mocker.patch.object(cotverify, 'get_body', new=die)
     with pytest.raises(CoTError):
-        cotverify.verify_cot_signatures(chain)
+        event_loop.run_until_complete(cotverify.verify_cot_signatures(chain))
 
 
-def test_verify_cot_signatures(chain, build_link, mocker):
+def test_verify_cot_signatures(chain, build_link, mocker, event_loop):
 
     def fake_body(*args, **kwargs):
         return '{}'
@@ -616,11 +706,100 @@ def test_verify_cot_signatures(chain, build_link, mocker):
     chain.links = [build_link]
     mocker.patch.object(cotverify, 'GPG', new=noop_sync)
     mocker.patch.object(cotverify, 'get_body', new=fake_body)
-    cotverify.verify_cot_signatures(chain)
+    event_loop.run_until_complete(cotverify.verify_cot_signatures(chain))
     assert os.path.exists(path)
     with open(path, "r") as fh:
         assert json.load(fh) == {}
 
+
+def test_verify_cot_signatures_concurrent(chain, build_link, decision_link, docker_image_link, mocker, event_loop):
+    """Verify the links concurrently, with one GPG instance per gpg home, and raise per-link errors."""
+    gpg_homes = []
+    barrier = threading.Barrier(3, timeout=5)
+
+    def fake_gpg(context, gpg_home=None):
+        gpg_homes.append(gpg_home)
+        return gpg_home
+
+    def fake_body(gpg, contents, **kwargs):
+        # All three links have to be verifying at once to get past this.
+        barrier.wait()
+        if contents == 'bad':
+            raise ScriptWorkerGPGException("bad signature")
+        return '{}'
+
+    links = [build_link, decision_link, docker_image_link]
+    for link in links:
+        link._cot = None
+        path = os.path.join(link.cot_dir, 'public/chainOfTrust.json.asc')
+        makedirs(os.path.dirname(path))
+        with open(path, "w") as fh:
+            fh.write('bad' if link is decision_link else 'good')
+    chain.links = links
+    chain.context.config['executor_max_threads'] = 3
+    mocker.patch.object(cotverify, 'GPG', new=fake_gpg)
+    mocker.patch.object(cotverify, 'get_body', new=fake_body)
+    with pytest.raises(CoTError) as excinfo:
+        event_loop.run_until_complete(cotverify.verify_cot_signatures(chain))
+    assert decision_link.task_id in str(excinfo.value)
+    assert sorted(gpg_homes) == sorted(set(gpg_homes))
+    assert build_link.cot == docker_image_link.cot == {}
+
+
+def test_verify_cot_signatures_cache(chain, build_link, decision_link, mocker, event_loop):
+    """Verified chain of trust bodies are cached, and cache hits skip gpg."""
+    calls = []
+
+    def fake_gpg(context, gpg_home=None):
+        calls.append(gpg_home)
+        return gpg_home
+
+    def fake_body(gpg, contents, **kwargs):
+        calls.append(contents)
+        return json.dumps({'contents': contents})
+
+    chain.context.config['cot_verification_cache_dir'] = os.path.join(chain.context.config['work_dir'], 'cot_cache')
+    mocker.patch.object(cotverify, 'GPG', new=fake_gpg)
+    mocker.patch.object(cotverify, 'get_body', new=fake_body)
+    mocker.patch.object(cotverify, 'get_gpg_homedir_revision', return_value='rev')
+    for link in (build_link, decision_link):
+        link._cot = None
+        path = os.path.join(link.cot_dir, 'public/chainOfTrust.json.asc')
+        makedirs(os.path.dirname(path))
+        with open(path, "w") as fh:
+            fh.write(link.task_id)
+    chain.links = [build_link]
+    event_loop.run_until_complete(cotverify.verify_cot_signatures(chain))
+    assert len(calls) == 2
+    del calls[:]
+    os.remove(os.path.join(build_link.cot_dir, 'chainOfTrust.json'))
+    build_link._cot = None
+    chain.links = [build_link, decision_link]
+    event_loop.run_until_complete(cotverify.verify_cot_signatures(chain))
+    # Only the decision link needed gpg.
+    assert calls[-1] == decision_link.task_id
+    assert build_link.task_id not in calls
+    assert build_link.cot == {'contents': build_link.task_id}
+    with open(os.path.join(build_link.cot_dir, 'chainOfTrust.json'), "r") as fh:
+        assert json.load(fh) == build_link.cot
+    cot_cache = chain.context.cot_verification_cache
+    assert (cot_cache.hits, cot_cache.misses) == (1, 2)
+    # A new gpg homedir revision misses the cache.
+    del calls[:]
+    build_link._cot = decision_link._cot = None
+    mocker.patch.object(cotverify, 'get_gpg_homedir_revision', return_value='new_rev')
+    event_loop.run_until_complete(cotverify.verify_cot_signatures(chain))
+    assert sorted([c for c in calls if c in (build_link.task_id, decision_link.task_id)]) == \
+        sorted([build_link.task_id, decision_link.task_id])
+    # Without a recorded gpg homedir revision, the cache isn't used.
+    del calls[:]
+    build_link._cot = decision_link._cot = None
+    mocker.patch.object(cotverify, 'get_gpg_homedir_revision', return_value=None)
+    event_loop.run_until_complete(cotverify.verify_cot_signatures(chain))
+    assert sorted([c for c in calls if c in (build_link.task_id, decision_link.task_id)]) == \
+        sorted([build_link.task_id, decision_link.task_id])
+    assert (cot_cache.hits, cot_cache.misses) == (1, 4)
+
 @pytest.mark.parametrize('payload, expected', (
     ({}, {}),
     (
@@ -703,6 +882,51 @@ def test_verify_link_in_task_graph_fuzzy_match(chain, decision_link, build_link,
     cotverify.verify_link_in_task_graph(chain, decision_link, build_link)
 
 
+def test_verify_link_in_task_graph_fuzzy_match_index(chain, decision_link, build_link, mocker):
+    chain.links = [decision_link, build_link]
+    decision_link.task_graph = {}
+    for i in range(100):
+        task_defn = deepcopy(build_link.task)
+        task_defn['metadata'] = {'name': str(i)}
+        decision_link.task_graph['task{}'.format(i)] = {'task': task_defn}
+    match = deepcopy(build_link.task)
+    match['expires'] = 'some other time'
+    match['payload']['artifacts'] = {'foo': {'path': 'foo', 'expires': 'some other time'}}
+    build_link.task['payload']['artifacts'] = {'foo': {'path': 'foo', 'expires': 'now'}}
+    decision_link.task_graph['match'] = {'task': match}
+    compare = mocker.patch.object(
+        cotverify, '_compare_task_to_graph_defn', wraps=cotverify._compare_task_to_graph_defn
+    )
+    cotverify.verify_link_in_task_graph(chain, decision_link, build_link)
+    assert compare.call_count == 1
+    assert cotverify.find_task_graph_candidates(decision_link.task_graph_index, build_link.task) == ['match']
+
+
+def test_verify_link_in_task_graph_fuzzy_match_index_miss(chain, decision_link, build_link, mocker):
+    chain.links = [decision_link, build_link]
+    decision_link.task_graph = {}
+    for i in range(3):
+        task_defn = deepcopy(build_link.task)
+        task_defn['metadata'] = {'name': str(i)}
+        decision_link.task_graph['task{}'.format(i)] = {'task': task_defn}
+    decision_link.task_graph['match'] = {'task': deepcopy(build_link.task)}
+    mocker.patch.object(cotverify, 'find_task_graph_candidates', return_value=['task1'])
+    compared = []
+
+    def compare(task_link, graph_defn):
+        compared.append(graph_defn['task']['metadata'].get('name'))
+        return _compare_task_to_graph_defn(task_link, graph_defn)
+
+    _compare_task_to_graph_defn = cotverify._compare_task_to_graph_defn
+    mocker.patch.object(cotverify, '_compare_task_to_graph_defn', new=compare)
+    warning = mocker.patch.object(cotverify.log, 'warning')
+    cotverify.verify_link_in_task_graph(chain, decision_link, build_link)
+    # The candidate isn't compared again in the fallback.
+    assert compared.count('1') == 1
+    assert len(compared) == len(set(compared))
+    assert "doesn't match its fingerprint candidates" in warning.call_args[0][0]
+
+
 def test_verify_link_in_task_graph_exception(chain, decision_link, build_link):
     chain.links = [decision_link, build_link]
     bad_task = deepcopy(build_link.task)
@@ -790,50 +1014,67 @@ def test_verify_firefox_decision_command(decision_link, command, raises):
 @pytest.mark.asyncio
 async def test_verify_decision_task(chain, decision_link, build_link, mocker):
 
-    def task_graph(*args, **kwargs):
-        return {
-            build_link.task_id: {
-                'task': deepcopy(build_link.task)
-            },
-            chain.task_id: {
-                'task': deepcopy(chain.task)
-            },
-        }
-
+    task_graph = {
+        build_link.task_id: {
+            'task': deepcopy(build_link.task)
+        },
+        chain.task_id: {
+            'task': deepcopy(chain.task)
+        },
+    }
     path = os.path.join(decision_link.cot_dir, "public", "task-graph.json")
     makedirs(os.path.dirname(path))
-    touch(path)
+    with open(path, "w") as fh:
+        json.dump(task_graph, fh)
     chain.links = [decision_link, build_link]
+    decision_link.cot['artifacts'] = {'public/task-graph.json': {'sha256': get_hash(path)}}
     decision_link.task['workerType'] = chain.context.config['valid_decision_worker_types'][0]
-    mocker.patch.object(cotverify, 'load_json', new=task_graph)
     mocker.patch.object(cotverify, 'verify_firefox_decision_command', new=noop_sync)
+    # The task graph store uses the sha256 the chain of trust verified.
+    mocker.patch.object(cot_task_graph, 'get_hash', new=die_sync)
     await cotverify.verify_decision_task(chain, decision_link)
 
 
 @pytest.mark.asyncio
 async def test_verify_decision_task_worker_type(chain, decision_link, build_link, mocker):
 
-    def task_graph(*args, **kwargs):
-        return {
-            build_link.task_id: {
-                'task': deepcopy(build_link.task)
-            },
-            chain.task_id: {
-                'task': deepcopy(chain.task)
-            },
-        }
-
+    task_graph = {
+        build_link.task_id: {
+            'task': deepcopy(build_link.task)
+        },
+        chain.task_id: {
+            'task': deepcopy(chain.task)
+        },
+    }
     path = os.path.join(decision_link.cot_dir, "public", "task-graph.json")
     makedirs(os.path.dirname(path))
-    touch(path)
+    with open(path, "w") as fh:
+        json.dump(task_graph, fh)
     chain.links = [decision_link, build_link]
+    decision_link.cot['artifacts'] = {'public/task-graph.json': {'sha256': get_hash(path)}}
     decision_link.task['workerType'] = 'bad-worker-type'
-    mocker.patch.object(cotverify, 'load_json', new=task_graph)
     mocker.patch.object(cotverify, 'verify_firefox_decision_command', new=noop_sync)
     with pytest.raises(CoTError):
         await cotverify.verify_decision_task(chain, decision_link)
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("contents", (None, '{"build_task_id": {"task": nope}}'))
+async def test_verify_decision_task_bad_graph(chain, decision_link, build_link, contents):
+    path = os.path.join(decision_link.cot_dir, "public", "task-graph.json")
+    makedirs(os.path.dirname(path))
+    if contents is None:
+        touch(path)
+    else:
+        with open(path, "w") as fh:
+            fh.write(contents)
+    chain.links = [decision_link, build_link]
+    decision_link.cot['artifacts'] = {'public/task-graph.json': {'sha256': get_hash(path)}}
+    decision_link.task['workerType'] = chain.context.config['valid_decision_worker_types'][0]
+    with pytest.raises(CoTError):
+        await cotverify.verify_decision_task(chain, decision_link)
+
+
 @pytest.mark.asyncio
 async def test_verify_decision_task_missing_graph(chain, decision_link, build_link, mocker):
     chain.links = [decision_link, build_link]
@@ -1028,6 +1269,122 @@ async def test_trace_back_to_firefox_tree_diff_repo(chain, decision_link,
     await cotverify.trace_back_to_firefox_tree(chain)
 
 
+# _ChainOfTrustPipeline {{{1
+def fake_artifact_url(context, task_id, path):
+    return "https://queue/v1/task/{}/artifacts/{}".format(task_id, path)
+
+
+def test_chain_of_trust_pipeline(chain, build_link, decision_link, docker_image_link, mocker, event_loop):
+    """Each link runs on its own, the task graph downloads early, and the audit log stays in chain order."""
+    events = []
+    checked = []
+    records = []
+    task_graph = '{}'
+    delays = {'build_task_id': .03, 'decision_task_id': .02, 'docker_image_task_id': 0}
+    cots = {
+        'build_task_id': {'artifacts': {'public/build.zip': {'sha256': 'x'}}},
+        'decision_task_id': {'artifacts': {
+            'public/task-graph.json': {'sha256': hashlib.sha256(task_graph.encode('utf-8')).hexdigest()},
+        }},
+        'docker_image_task_id': {'artifacts': {}},
+    }
+
+    async def fake_download(context, urls, parent_dir=None, valid_artifact_task_ids=None, **kwargs):
+        task_id = valid_artifact_task_ids[0]
+        path = urls[0].split('/artifacts/')[-1]
+        events.append(('download', task_id, path))
+        await asyncio.sleep(delays[task_id])
+        full_path = os.path.join(parent_dir, path)
+        makedirs(os.path.dirname(full_path))
+        with open(full_path, "w") as fh:
+            fh.write(task_graph if path.endswith('task-graph.json') else task_id)
+        return [full_path]
+
+    def fake_body(gpg, contents, **kwargs):
+        events.append(('verify', contents))
+        return json.dumps(cots[contents])
+
+    async def fake_check(chain, obj, _):
+        checked.append((obj.task_id, obj.task_id == chain.task_id or obj.cot is not None))
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    chain.task['payload']['upstreamArtifacts'] = [{'taskId': 'build_task_id', 'paths': ['public/build.zip']}]
+    links = [build_link, decision_link, docker_image_link]
+    for link in links:
+        link._cot = None
+    mocker.patch.object(cotverify, 'download_artifacts', new=fake_download)
+    mocker.patch.object(cotverify, 'get_artifact_url', new=fake_artifact_url)
+    mocker.patch.object(cotverify, 'GPG', new=noop_sync)
+    mocker.patch.object(cotverify, 'get_body', new=fake_body)
+    mocker.patch.object(cotverify, '_verify_task_type', new=fake_check)
+    mocker.patch.object(cotverify, '_verify_worker_impl', new=noop_async)
+    mocker.patch.object(cotverify, 'check_num_tasks', new=noop_sync)
+    handler = Handler()
+    cotverify.log.addHandler(handler)
+    cotverify.log.setLevel(logging.DEBUG)
+
+    async def run():
+        pipeline = cotverify._ChainOfTrustPipeline(chain)
+        try:
+            for link in links:
+                chain.add_link(link)
+                pipeline.start(link)
+            await pipeline.verify()
+        finally:
+            await pipeline.close()
+
+    try:
+        event_loop.run_until_complete(run())
+    finally:
+        cotverify.log.removeHandler(handler)
+    # The task graph download starts with the signed chain of trust download.
+    assert events.index(('download', 'decision_task_id', 'public/task-graph.json')) < \
+        events.index(('verify', 'decision_task_id'))
+    assert ('download', 'build_task_id', 'public/build.zip') in events
+    # The build link waits for its docker-image input.
+    assert checked == [('my_task_id', True), ('build_task_id', True),
+                       ('decision_task_id', True), ('docker_image_task_id', True)]
+    # The links finished in reverse order, but they're logged in chain order.
+    signature_records = [r for r in records if r.startswith("Verifying the ")]
+    assert [r.split()[3] for r in signature_records] == ['build_task_id', 'decision_task_id', 'docker_image_task_id']
+
+
+def test_chain_of_trust_pipeline_failure(chain, build_link, decision_link, mocker, event_loop):
+    """A failed link fails verification straight away, even if an earlier link is still downloading."""
+    cancelled = []
+
+    async def fake_download(context, urls, parent_dir=None, valid_artifact_task_ids=None, **kwargs):
+        if valid_artifact_task_ids[0] == 'build_task_id':
+            raise CoTError("bad download")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(urls[0])
+            raise
+
+    mocker.patch.object(cotverify, 'download_artifacts', new=fake_download)
+    mocker.patch.object(cotverify, 'get_artifact_url', new=fake_artifact_url)
+
+    async def run():
+        pipeline = cotverify._ChainOfTrustPipeline(chain)
+        try:
+            for link in (decision_link, build_link):
+                chain.add_link(link)
+                pipeline.start(link)
+            await pipeline.verify()
+        finally:
+            await pipeline.close()
+
+    start = time.time()
+    with pytest.raises(CoTError):
+        event_loop.run_until_complete(run())
+    assert time.time() - start < 5
+    assert len(cancelled) == 2
+
+
 # verify_chain_of_trust {{{1
 @pytest.mark.parametrize("exc", (None, KeyError, CoTError))
 @pytest.mark.asyncio
@@ -1037,11 +1394,8 @@ async def test_verify_chain_of_trust(chain, exc, mocker):
         if exc is not None:
             raise exc("blah")
 
-    for func in ('build_task_dependencies', 'download_cot', 'download_firefox_cot_artifacts',
-                 'verify_task_types', 'verify_worker_impls'):
-        mocker.patch.object(cotverify, func, new=noop_async)
-    for func in ('verify_cot_signatures', 'check_num_tasks'):
-        mocker.patch.object(cotverify, func, new=noop_sync)
+    mocker.patch.object(cotverify, 'build_task_dependencies', new=noop_async)
+    mocker.patch.object(cotverify._ChainOfTrustPipeline, 'verify', new=noop_async)
     mocker.patch.object(cotverify, 'trace_back_to_firefox_tree', new=maybe_die)
     if exc:
         with pytest.raises(CoTError):
@@ -1055,7 +1409,11 @@ async def test_verify_chain_of_trust(chain, exc, mocker):
 def test_verify_cot_cmdln(chain, args, tmpdir, mocker, event_loop):
     context = mock.MagicMock()
     context.queue = mock.MagicMock()
-    context.queue.task = noop_async
+
+    async def task(task_id):
+        return {}
+
+    context.queue.task = task
     path = os.path.join(tmpdir, 'x')
     makedirs(path)
 
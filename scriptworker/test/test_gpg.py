@@ -251,6 +251,17 @@ def test_get_body(base_context, text, params, verify_sig):
     assert sgpg.get_body(gpg, data, verify_sig=verify_sig) == text
 
 
+@pytest.mark.parametrize("params", BAD_GPG_KEYS.items())
+def test_get_body_bad_signature(base_context, params, mocker):
+    gpg = sgpg.GPG(base_context)
+    data = sgpg.sign(gpg, "foo", keyid=params[1]["fingerprint"])
+    # get_body only runs gpg once.
+    mocker.patch.object(gpg, 'verify', side_effect=AssertionError("ran gpg --verify"))
+    with pytest.raises(ScriptWorkerGPGException):
+        sgpg.get_body(gpg, data)
+    assert sgpg.get_body(gpg, data, verify_sig=False) == "foo\n"
+
+
 # create_gpg_conf {{{1
 @pytest.mark.parametrize("keyserver,fingerprint,expected", GPG_CONF_PARAMS)
 def test_create_gpg_conf(keyserver, fingerprint, expected, tmpdir):
@@ -716,6 +727,25 @@ def test_build_gpg_homedirs_from_repo(context, mocker, event_loop):
     assert homedirs == expected
 
 
+def test_build_gpg_homedirs_from_repo_keeps_cot_cache(context, event_loop):
+    """The cache is cleared when the homedirs are swapped in, not when they're built."""
+    cache_dir = os.path.join(context.config['work_dir'], 'cot_cache')
+    context.config['cot_verification_cache_dir'] = cache_dir
+    os.makedirs(os.path.join(cache_dir, 'ab'))
+    touch(os.path.join(cache_dir, 'ab', 'abcd.json'))
+    sgpg.build_gpg_homedirs_from_repo(
+        context, "tag", verify_function=noop_async, flat_function=noop_sync, signed_function=noop_sync
+    )
+    assert os.path.exists(os.path.join(cache_dir, 'ab', 'abcd.json'))
+
+
+# gpg homedir revision {{{1
+def test_gpg_homedir_revision(tmpdir):
+    assert sgpg.get_gpg_homedir_revision(tmpdir) is None
+    sgpg.write_gpg_homedir_revision(tmpdir, "foo")
+    assert sgpg.get_gpg_homedir_revision(tmpdir) == "foo"
+
+
 # rebuild_gpg_homedirs {{{1
 @pytest.mark.parametrize("new_rev_found", [True, False])
 def test_rebuild_gpg_homedirs(context, mocker, event_loop, new_rev_found):
@@ -738,9 +768,16 @@ def test_rebuild_gpg_homedirs(context, mocker, event_loop, new_rev_found):
     mocker.patch.object(sgpg, "overwrite_gpg_home", new=noop_sync)
     mocker.patch.object(sgpg, "get_last_good_git_revision", new=noop_sync)
     mocker.patch.object(sgpg, "build_gpg_homedirs_from_repo", new=noop_sync)
+    write_revision = mocker.patch.object(sgpg, "write_gpg_homedir_revision")
     mocker.patch.object(sgpg, "write_last_good_git_revision", new=noop_sync)
 
     sgpg.rebuild_gpg_homedirs()
+    if new_rev_found:
+        write_revision.assert_called_once_with(
+            sgpg.get_tmp_base_gpg_home_dir(context), "NEW REVISION!!!"
+        )
+    else:
+        write_revision.assert_not_called()
 
 
 @pytest.mark.parametrize("nuke_dir", (True, False))
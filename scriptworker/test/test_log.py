@@ -90,3 +90,31 @@ def test_contextual_log_handler(context, mocker):
         contents = fh.read().splitlines()
     assert len(contents) == 1
     assert contents[0].endswith("foo")
+
+
+def test_contextual_log_handler_current_task_only(context, event_loop):
+    swlog.log.setLevel(logging.DEBUG)
+
+    async def log_task(name, other_started, started):
+        path = os.path.join(context.config['artifact_dir'], "{}.log".format(name))
+        with swlog.contextual_log_handler(context, path=path, current_task_only=True):
+            started.set()
+            await other_started.wait()
+            swlog.log.info(name)
+            await asyncio.ensure_future(asyncio.sleep(0))
+            await asyncio.ensure_future(log_child(name))
+        with open(path, "r") as fh:
+            return fh.read().splitlines()
+
+    async def log_child(name):
+        swlog.log.info("{} child".format(name))
+
+    started = [asyncio.Event(), asyncio.Event()]
+    results = event_loop.run_until_complete(asyncio.gather(
+        log_task("one", started[1], started[0]),
+        log_task("two", started[0], started[1]),
+    ))
+    for name, contents in zip(("one", "two"), results):
+        assert len(contents) == 2
+        assert contents[0].endswith(name)
+        assert contents[1].endswith("{} child".format(name))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Test scriptworker.monitor
+"""
+import asyncio
+import os
+import pytest
+import time
+import scriptworker.monitor as monitor
+from . import event_loop, rw_context
+
+assert event_loop  # silence flake8
+
+
+# constants helpers and fixtures {{{1
+@pytest.yield_fixture(scope='function')
+def context(rw_context):
+    rw_context.config['loop_lag_threshold'] = 0.1
+    rw_context.config['loop_lag_sample_interval'] = 0.01
+    yield rw_context
+
+
+def block_the_loop(seconds):
+    time.sleep(seconds)
+
+
+# LoopLagMonitor {{{1
+def test_loop_lag_monitor(context, event_loop):
+    lag_monitor = monitor.LoopLagMonitor(context)
+
+    async def run():
+        lag_monitor.start()
+        await asyncio.sleep(0.05)
+        block_the_loop(0.3)
+        await asyncio.sleep(0.05)
+        lag_monitor.stop()
+
+    event_loop.run_until_complete(run())
+    assert lag_monitor.lag.count > 2
+    assert len(lag_monitor.stalls) == 1
+    stall = lag_monitor.stalls[0]
+    assert 0.2 < stall['duration'] < 1
+    assert 'block_the_loop' in stall['stack']
+    path = lag_monitor.write_report()
+    assert path == os.path.join(context.config['task_log_dir'], 'loop_lag.log')
+    with open(path, "r") as fh:
+        contents = fh.read()
+    assert "Stalls over 0.100 seconds: 1" in contents
+    assert 'block_the_loop' in contents
+
+
+def test_loop_lag_monitor_no_stalls(context, event_loop):
+    lag_monitor = monitor.LoopLagMonitor(context)
+
+    async def run():
+        lag_monitor.start()
+        await asyncio.sleep(0.05)
+        lag_monitor.stop()
+
+    event_loop.run_until_complete(run())
+    assert lag_monitor.stalls == []
+    assert "Stalls over 0.100 seconds: 0, 0.000 seconds total\n" in lag_monitor.format_report()
+
+
+def test_loop_lag_monitor_stop_doesnt_block(context, event_loop):
+    context.config['loop_lag_threshold'] = 60
+    lag_monitor = monitor.LoopLagMonitor(context)
+
+    async def run():
+        lag_monitor.start()
+        thread = lag_monitor._thread
+        await asyncio.sleep(0.01)
+        start = time.monotonic()
+        lag_monitor.stop()
+        assert time.monotonic() - start < 1
+        # A restart gets a fresh watchdog; the old one still exits.
+        lag_monitor.start()
+        lag_monitor.stop()
+        thread.join(5)
+        assert not thread.is_alive()
+
+    event_loop.run_until_complete(run())
+
+
+def test_get_stack_summary(context):
+    lag_monitor = monitor.LoopLagMonitor(context)
+    lag_monitor.stalls = [
+        {'start': 0, 'duration': 0.5, 'stack': 'a'},
+        {'start': 1, 'duration': 0.2, 'stack': 'b'},
+        {'start': 2, 'duration': 0.4, 'stack': 'b'},
+        {'start': 3, 'duration': 0.3, 'stack': None},
+    ]
+    summary = [(stack, count, round(total, 3), max_duration)
+               for stack, count, total, max_duration in lag_monitor.get_stack_summary()]
+    assert summary == [('b', 2, 0.6, 0.4), ('a', 1, 0.5, 0.5), (None, 1, 0.3, 0.3)]
+    assert "(stack not captured)" in lag_monitor.format_report()
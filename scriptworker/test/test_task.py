@@ -3,6 +3,7 @@
 """Test scriptworker.task
 """
 import aiohttp
+import arrow
 import asyncio
 import glob
 import mock
@@ -59,6 +60,15 @@ def test_get_worker_type(defn, result):
     assert task.get_worker_type(defn) == result
 
 
+# get_task_script_cmd {{{1
+def test_get_task_script_cmd(context):
+    context.config['task_script'] = ('script', '--work-dir', '%(work_dir)s', '%(artifact_dir)s/foo', 'bar')
+    assert task.get_task_script_cmd(context) == [
+        'script', '--work-dir', context.config['work_dir'],
+        '{}/foo'.format(context.config['artifact_dir']), 'bar',
+    ]
+
+
 # run_task {{{1
 def test_run_task(context, event_loop):
     status = event_loop.run_until_complete(
@@ -150,6 +160,64 @@ async def test_reclaim_task_mock(context, mocker, event_loop):
     await task.reclaim_task(context, context.task)
 
 
+@pytest.mark.parametrize("claim_until,reclaim_until,expected", ((
+    None, None, None
+), (
+    '2017-06-01T00:00:00.000Z', None, 1496275200
+), (
+    '2017-06-01T00:00:00.000Z', '2017-06-01T00:20:00.000Z', 1496276400
+)))
+def test_get_taken_until(context, claim_until, reclaim_until, expected):
+    claim_task = dict(context.claim_task)
+    if claim_until:
+        claim_task['takenUntil'] = claim_until
+    context.claim_task = claim_task
+    if reclaim_until:
+        context.reclaim_task = {'credentials': {}, 'takenUntil': reclaim_until}
+    assert task.get_taken_until(context) == expected
+
+
+@pytest.mark.parametrize("remaining,expected", ((
+    None, 300
+), (
+    1200, 1020
+), (
+    100, 0
+)))
+def test_get_reclaim_sleep_time(context, mocker, remaining, expected):
+    context.config['reclaim_interval'] = 300
+    context.config['reclaim_margin'] = 180
+    mocker.patch.object(task, 'get_claim_time_remaining', return_value=remaining)
+    assert task.get_reclaim_sleep_time(context) == expected
+
+
+@pytest.mark.asyncio
+async def test_reclaim_task_taken_until(context, event_loop, mocker):
+    context.config['reclaim_margin'] = 60
+    claim_task = dict(context.claim_task)
+    claim_task['takenUntil'] = arrow.utcnow().replace(seconds=60.05).isoformat()
+    context.claim_task = claim_task
+    reclaims = []
+
+    async def fake_reclaim(*args, **kwargs):
+        reclaims.append(args)
+        if len(reclaims) > 1:
+            raise taskcluster.exceptions.TaskclusterRestFailure("foo", None, status_code=409)
+        return {
+            'credentials': {'c': 'd'},
+            'takenUntil': arrow.utcnow().replace(seconds=60.05).isoformat(),
+        }
+
+    temp_queue = mock.MagicMock()
+    temp_queue.reclaimTask = fake_reclaim
+    mocker.patch.object(context, 'create_queue', return_value=temp_queue)
+    context.temp_queue = temp_queue
+    await task.reclaim_task(context, context.task)
+    assert reclaims == [('taskId', 'runId'), ('taskId', 'runId')]
+    assert context.heartbeat_slack.count == 2
+    assert 55 < context.heartbeat_slack.min <= 60.05
+
+
 # max_timeout {{{1
 def test_max_timeout_noop(context):
     with mock.patch.object(task.log, 'debug') as p:
@@ -191,3 +259,11 @@ async def test_claim_work(event_loop, raises, context):
     else:
         context.queue.claimWork = noop_async
     assert await task.claim_work(context) is None
+
+
+@pytest.mark.asyncio
+async def test_claim_work_num_tasks(event_loop, context, successful_queue):
+    context.queue = successful_queue
+    await task.claim_work(context, num_tasks=3)
+    assert successful_queue.info[2] == {}
+    assert successful_queue.info[1][2]['tasks'] == 3
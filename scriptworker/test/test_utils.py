@@ -2,14 +2,20 @@
 # coding=utf-8
 """Test scriptworker.utils
 """
+import aiohttp
+from aiohttp import web
 import asyncio
+import gzip
+import hashlib
 import mock
 import os
 import pytest
+import re
 import tempfile
-from scriptworker.exceptions import DownloadError, ScriptWorkerException, ScriptWorkerRetryException
+import threading
+from scriptworker.exceptions import CoTError, DownloadError, ScriptWorkerException, ScriptWorkerRetryException
 import scriptworker.utils as utils
-from . import event_loop, fake_session, fake_session_500, FakeResponse, tmpdir, \
+from . import event_loop, fake_session, fake_session_500, FakeResponse, noop_async, tmpdir, \
     touch
 from . import rw_context as context
 
@@ -154,6 +160,24 @@ def test_retry_request(context, fake_session, event_loop):
     context.session.close()
 
 
+# RunningStats {{{1
+def test_running_stats():
+    stats = utils.RunningStats()
+    assert stats.mean is None
+    assert str(stats) == "count=0"
+    for value in (2, 4, 0):
+        stats.add(value)
+    assert stats.to_dict() == {
+        'count': 3,
+        'last': 0,
+        'max': 4,
+        'mean': 2,
+        'min': 0,
+        'total': 6,
+    }
+    assert str(stats) == "count=3 mean=2.000 min=0.000 max=4.000 last=0.000"
+
+
 # calculate_sleep_time {{{1
 @pytest.mark.parametrize("attempt", (-1, 0))
 def test_calculate_no_sleep_time(attempt):
@@ -238,6 +262,52 @@ def test_raise_future_exceptions_noop(event_loop):
     )
 
 
+# gather_fail_fast {{{1
+@pytest.mark.parametrize("fail_fast", (True, False))
+def test_gather_fail_fast(tmpdir, event_loop, fail_fast):
+    finished = []
+    partial_path = os.path.join(tmpdir, "file.part")
+    touch(partial_path)
+
+    async def fail(exc):
+        await asyncio.sleep(.01)
+        raise exc
+
+    async def slow():
+        await asyncio.sleep(.5)
+        finished.append('slow')
+
+    tasks = [asyncio.ensure_future(slow()), asyncio.ensure_future(fail(IOError("one"))),
+             asyncio.ensure_future(fail(SyntaxError("two")))]
+    with pytest.raises(IOError):
+        event_loop.run_until_complete(
+            utils.gather_fail_fast(tasks, cleanup_paths=[partial_path], fail_fast=fail_fast)
+        )
+    assert not os.path.exists(partial_path)
+    assert tasks[0].cancelled() is fail_fast
+    assert finished == ([] if fail_fast else ['slow'])
+
+
+def test_gather_fail_fast_results(event_loop):
+
+    async def one(value):
+        return value
+
+    assert event_loop.run_until_complete(utils.gather_fail_fast([])) == []
+    tasks = [asyncio.ensure_future(one(1)), asyncio.ensure_future(one(2))]
+    assert event_loop.run_until_complete(utils.gather_fail_fast(tasks)) == [1, 2]
+
+
+def test_gather_fail_fast_cancelled(event_loop):
+    """Cancelling the gather cancels the futures."""
+    tasks = [asyncio.ensure_future(asyncio.sleep(10))]
+    gather = asyncio.ensure_future(utils.gather_fail_fast(tasks))
+    event_loop.call_later(.01, gather.cancel)
+    with pytest.raises(asyncio.CancelledError):
+        event_loop.run_until_complete(gather)
+    assert tasks[0].cancelled()
+
+
 # filepaths_in_dir {{{1
 def test_filepaths_in_dir(tmpdir):
     filepaths = sorted([
@@ -253,6 +323,60 @@ def test_filepaths_in_dir(tmpdir):
     assert sorted(utils.filepaths_in_dir(tmpdir)) == filepaths
 
 
+# task_owner {{{1
+def test_task_owner(context, event_loop):
+    owner = object()
+    owners = []
+
+    async def child():
+        owners.append(utils.get_task_owner())
+        owners.append(await utils.run_in_executor(context, utils.get_task_owner))
+
+    async def parent():
+        with utils.task_owner(owner):
+            await asyncio.ensure_future(child())
+        owners.append(utils.get_task_owner())
+        await asyncio.ensure_future(child())
+
+    event_loop.run_until_complete(parent())
+    assert owners == [owner, owner, None, None, None]
+
+
+def test_task_owner_nested(event_loop):
+    owners = []
+
+    async def parent():
+        with utils.task_owner('outer'):
+            with utils.task_owner('inner'):
+                owners.append(utils.get_task_owner())
+            owners.append(utils.get_task_owner())
+
+    event_loop.run_until_complete(parent())
+    assert owners == ['inner', 'outer']
+
+
+# run_in_executor {{{1
+@pytest.mark.parametrize("max_threads,same_thread", ((2, False), (0, True)))
+def test_run_in_executor(context, event_loop, max_threads, same_thread):
+    context.config['executor_max_threads'] = max_threads
+    path = os.path.join(os.path.dirname(__file__), "data", "azure.xml")
+    sha = event_loop.run_until_complete(
+        utils.run_in_executor(context, utils.get_hash, path, hash_alg="sha256")
+    )
+    assert sha == utils.get_hash(path)
+    thread = event_loop.run_until_complete(
+        utils.run_in_executor(context, threading.current_thread)
+    )
+    assert (thread is threading.current_thread()) is same_thread
+
+
+def test_run_in_executor_exception(context, event_loop):
+    with pytest.raises(ScriptWorkerException):
+        event_loop.run_until_complete(
+            utils.run_in_executor(context, utils.makedirs, __file__)
+        )
+
+
 # get_hash {{{1
 def test_get_hash():
     path = os.path.join(os.path.dirname(__file__), "data", "azure.xml")
@@ -304,6 +428,274 @@ def test_download_file(context, fake_session, tmpdir, event_loop):
     with open(path, "r") as fh:
         contents = fh.read()
     assert contents == "asdfasdf"
+    assert not os.path.exists("{}.part".format(path))
+
+
+def get_range_session(contents, requests, status=None, truncate=None, content_range=None):
+    """A fake session that answers Range requests for ``contents``."""
+    @asyncio.coroutine
+    def _fake_request(method, url, *args, headers=None, **kwargs):
+        headers = headers or {}
+        requests.append(headers)
+        match = re.match(r'bytes=(\d+)-(\d*)', headers.get('Range', ''))
+        offset, end = 0, len(contents)
+        if match and status in (None, 206):
+            offset = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else end
+        data = contents[offset:end]
+        resp = FakeResponse(method, url, status=status or (206 if match else 200))
+        resp.headers = {'Content-Length': str(len(data))}
+        data = data[:truncate]
+        if resp.status == 206:
+            resp.headers['Content-Range'] = content_range or "bytes {}-{}/{}".format(
+                offset, end - 1, len(contents)
+            )
+        resp.resp = [data[i:i + 3] for i in range(0, len(data), 3)]
+        return resp
+
+    session = aiohttp.ClientSession()
+    session._request = _fake_request
+    return session
+
+
+@pytest.mark.parametrize("status,content_range,expected_status", ((
+    None, None, "resumed",
+), (
+    200, None, "restarted",
+), (
+    None, "bytes 3-13/14", "restarted",
+)))
+def test_download_file_resume(context, tmpdir, event_loop, status, content_range, expected_status):
+    contents = b"0123456789abcd"
+    requests = []
+    path = os.path.join(tmpdir, "foo")
+    with open("{}.part".format(path), "wb") as fh:
+        fh.write(b"0123X")
+    session = get_range_session(contents, requests, status=status, content_range=content_range)
+    if expected_status == "resumed":
+        event_loop.run_until_complete(utils.download_file(context, "url", path, session=session))
+        with open(path, "rb") as fh:
+            assert fh.read() == b"0123X56789abcd"
+    elif content_range is None:
+        event_loop.run_until_complete(utils.download_file(context, "url", path, session=session))
+        with open(path, "rb") as fh:
+            assert fh.read() == contents
+    else:
+        with pytest.raises(DownloadError):
+            event_loop.run_until_complete(utils.download_file(context, "url", path, session=session))
+        assert not os.path.exists("{}.part".format(path))
+    assert requests[0] == {'Range': 'bytes=5-'}
+
+
+def test_download_file_incomplete(context, tmpdir, event_loop):
+    contents = b"0123456789abcd"
+    requests = []
+    path = os.path.join(tmpdir, "foo")
+    # The first attempt is cut short; the retry picks up where it left off.
+    session = get_range_session(contents, requests, truncate=7)
+    with pytest.raises(DownloadError):
+        event_loop.run_until_complete(utils.download_file(context, "url", path, session=session))
+    assert os.path.getsize("{}.part".format(path)) == 7
+    session = get_range_session(contents, requests)
+    event_loop.run_until_complete(utils.download_file(context, "url", path, session=session))
+    assert requests[-1] == {'Range': 'bytes=7-'}
+    with open(path, "rb") as fh:
+        assert fh.read() == contents
+    assert not os.path.exists("{}.part".format(path))
+
+
+@pytest.mark.parametrize("status,size,threshold,num_requests", ((
+    None, 100, 10, 4,
+), (
+    200, 100, 10, 1,
+), (
+    None, 9, 10, 1,
+)))
+def test_download_file_segments(context, tmpdir, event_loop, status, size, threshold, num_requests):
+    context.config['download_segments'] = 4
+    context.config['download_segment_threshold'] = threshold
+    contents = bytes(range(size))
+    requests = []
+    path = os.path.join(tmpdir, "foo")
+    session = get_range_session(contents, requests, status=status)
+    event_loop.run_until_complete(utils.download_file(context, "url", path, session=session))
+    with open(path, "rb") as fh:
+        assert fh.read() == contents
+    assert requests[0] == {'Range': 'bytes=0-'}
+    assert len(requests) == num_requests
+    if num_requests > 1:
+        assert requests[1:] == [
+            {'Range': 'bytes=25-49'}, {'Range': 'bytes=50-74'}, {'Range': 'bytes=75-99'}
+        ]
+
+
+def test_download_file_segment_retry(context, tmpdir, event_loop, mocker):
+    context.config['download_segments'] = 2
+    context.config['download_segment_threshold'] = 10
+    contents = bytes(range(20))
+    requests = []
+    path = os.path.join(tmpdir, "foo")
+    session = get_range_session(contents, requests)
+    good_request = session._request
+    bad_session = get_range_session(contents, [], truncate=3)
+    attempts = []
+
+    def _request(method, url, *args, headers=None, **kwargs):
+        # Cut the second segment short on the first attempt.
+        if headers.get('Range') == 'bytes=10-19' and not attempts:
+            attempts.append(headers)
+            return bad_session._request(method, url, *args, headers=headers, **kwargs)
+        return good_request(method, url, *args, headers=headers, **kwargs)
+
+    session._request = _request
+    mocker.patch.object(asyncio, "sleep", new=noop_async)
+    event_loop.run_until_complete(utils.download_file(context, "url", path, session=session))
+    with open(path, "rb") as fh:
+        assert fh.read() == contents
+    assert attempts == [{'Range': 'bytes=10-19'}]
+
+
+def test_download_file_segment_failure(context, tmpdir, event_loop, mocker):
+    context.config['download_segments'] = 4
+    context.config['download_segment_threshold'] = 10
+    contents = bytes(range(100))
+    path = os.path.join(tmpdir, "foo")
+    session = get_range_session(contents, [])
+    cancelled = []
+
+    async def _download_segment(context, session, url, fd, segment, chunk_size):
+        if segment[0] == 25:
+            raise ValueError("bad segment")
+        try:
+            await asyncio.Future()
+        except asyncio.CancelledError:
+            cancelled.append(segment)
+            raise
+
+    mocker.patch.object(utils, "_download_segment", new=_download_segment)
+    # Without cancelling the other segments, this would never return.
+    with pytest.raises(ValueError):
+        event_loop.run_until_complete(asyncio.wait_for(
+            utils.download_file(context, "url", path, session=session), timeout=5
+        ))
+    assert sorted(cancelled) == [(50, 75), (75, 100)]
+    assert not os.path.exists("{}.part".format(path))
+
+
+@pytest.mark.parametrize("part,segments,good", ((
+    None, 1, True,
+), (
+    bytes(range(4)), 1, True,
+), (
+    None, 2, True,
+), (
+    None, 1, False,
+), (
+    None, 2, False,
+)))
+def test_download_file_expected_digests(context, tmpdir, event_loop, part, segments, good):
+    context.config['download_segments'] = segments
+    context.config['download_segment_threshold'] = 10
+    contents = bytes(range(100))
+    expected_digests = {
+        'sha256': hashlib.sha256(contents).hexdigest(),
+        'sha512': hashlib.sha512(contents).hexdigest(),
+    }
+    if not good:
+        expected_digests['sha512'] = 'bad'
+    path = os.path.join(tmpdir, "foo")
+    if part:
+        with open("{}.part".format(path), "wb") as fh:
+            fh.write(part)
+    session = get_range_session(contents, [])
+    download = utils.download_file(context, "url", path, session=session, expected_digests=expected_digests)
+    if good:
+        event_loop.run_until_complete(download)
+        with open(path, "rb") as fh:
+            assert fh.read() == contents
+    else:
+        with pytest.raises(CoTError):
+            event_loop.run_until_complete(download)
+        assert not os.path.exists(path)
+        assert not os.path.exists("{}.part".format(path))
+
+
+class GzipServer(object):
+    """A local server that sends ``contents`` gzipped, with ``Content-Encoding: gzip``, like S3 does."""
+
+    def __init__(self, contents):
+        self.body = gzip.compress(contents)
+        self.requests = []
+        self.url = None
+        self._app = web.Application()
+        self._app.router.add_get('/file', self.get)
+        self._handler = None
+        self._server = None
+
+    async def get(self, request):
+        self.requests.append(request.headers.get('Range'))
+        headers = {'Content-Encoding': 'gzip'}
+        match = re.match(r'bytes=(\d+)-(\d*)$', request.headers.get('Range', ''))
+        if not match:
+            return web.Response(body=self.body, headers=headers)
+        start = int(match.group(1))
+        end = int(match.group(2)) + 1 if match.group(2) else len(self.body)
+        headers['Content-Range'] = "bytes {}-{}/{}".format(start, end - 1, len(self.body))
+        return web.Response(status=206, body=self.body[start:end], headers=headers)
+
+    async def start(self):
+        self._handler = self._app.make_handler(access_log=None)
+        self._server = await asyncio.get_event_loop().create_server(self._handler, '127.0.0.1', 0)
+        self.url = "http://127.0.0.1:{}/file".format(self._server.sockets[0].getsockname()[1])
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self._handler.shutdown()
+
+
+@pytest.mark.parametrize("segments,part", ((1, None), (4, None), (1, b"0123")))
+def test_download_file_gzip(context, tmpdir, event_loop, segments, part):
+    context.config['download_segments'] = segments
+    context.config['download_segment_threshold'] = 0
+    contents = b"0123456789abcdef" * 1000
+    path = os.path.join(tmpdir, "chainOfTrust.json.asc")
+    if part is not None:
+        with open("{}.part".format(path), "wb") as fh:
+            fh.write(part)
+    server = GzipServer(contents)
+
+    async def run():
+        await server.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                if part is not None:
+                    # The decoded partial file can't be resumed; the retry starts over.
+                    with pytest.raises(DownloadError):
+                        await utils.download_file(context, server.url, path, session=session)
+                    assert not os.path.exists("{}.part".format(path))
+                await utils.download_file(
+                    context, server.url, path, session=session,
+                    expected_digests={'sha256': hashlib.sha256(contents).hexdigest()},
+                )
+        finally:
+            await server.stop()
+
+    event_loop.run_until_complete(run())
+    with open(path, "rb") as fh:
+        assert fh.read() == contents
+    assert not os.path.exists("{}.part".format(path))
+    assert len(server.requests) == (2 if part else 1)
+
+
+def test_download_file_416(context, tmpdir, event_loop):
+    path = os.path.join(tmpdir, "foo")
+    with open("{}.part".format(path), "wb") as fh:
+        fh.write(b"0123")
+    session = get_range_session(b"0123", [], status=416)
+    with pytest.raises(DownloadError):
+        event_loop.run_until_complete(utils.download_file(context, "url", path, session=session))
+    assert not os.path.exists("{}.part".format(path))
 
 
 def test_download_file_exception(context, fake_session_500, tmpdir, event_loop):
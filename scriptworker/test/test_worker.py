@@ -13,8 +13,11 @@ import pytest
 import tempfile
 import shutil
 import sys
+import threading
+import time
 from scriptworker.constants import STATUSES
 from scriptworker.exceptions import ScriptWorkerException
+from scriptworker.control import get_control_plane
 import scriptworker.worker as worker
 from . import event_loop, noop_async, noop_sync, rw_context, successful_queue, tmpdir
 
@@ -92,6 +95,53 @@ def test_async_main(context, event_loop, mocker, tmpdir):
             shutil.rmtree(path)
 
 
+def test_async_main_clears_cot_cache(context, event_loop, mocker):
+    base_gpg_home = context.config['base_gpg_home_dir']
+    cache_dir = os.path.join(context.config['work_dir'], 'cot_cache')
+    context.config['cot_verification_cache_dir'] = cache_dir
+    os.makedirs(cache_dir)
+    with open(os.path.join(cache_dir, 'abcd.json'), "w") as fh:
+        fh.write("{}")
+    os.makedirs("{}.tmp".format(base_gpg_home))
+    with open(os.path.join("{}.tmp".format(base_gpg_home), '.git_revision'), "w") as fh:
+        fh.write("new_rev")
+    with open(context.config['gpg_lockfile'], "w") as fh:
+        print("ready:", file=fh)
+    mocker.patch.object(worker, 'run_loop', new=noop_async)
+    event_loop.run_until_complete(worker.async_main(context))
+    with open(os.path.join(base_gpg_home, '.git_revision'), "r") as fh:
+        assert fh.read() == "new_rev"
+    assert not os.path.exists(cache_dir)
+    assert not os.path.exists(context.config['gpg_lockfile'])
+
+
+def test_async_main_drains_before_gpg_swap(context, event_loop, mocker):
+    base_gpg_home = context.config['base_gpg_home_dir']
+    os.makedirs("{}.tmp".format(base_gpg_home))
+    with open(context.config['gpg_lockfile'], "w") as fh:
+        print("ready:", file=fh)
+    task_future = event_loop.create_future()
+    context.task_contexts = [context]
+    context.task_future = task_future
+    run_loop_calls = []
+
+    async def fake_run_loop(_, claim_tasks=True):
+        run_loop_calls.append(claim_tasks)
+
+    mocker.patch.object(worker, 'run_loop', new=fake_run_loop)
+    # A task is running, so don't claim any more; don't swap yet.
+    event_loop.run_until_complete(worker.async_main(context))
+    assert run_loop_calls == [False]
+    assert os.path.exists("{}.tmp".format(base_gpg_home))
+    # Once it's done, swap, and claim again.
+    task_future.set_result(None)
+    context.task_future = None
+    event_loop.run_until_complete(worker.async_main(context))
+    assert run_loop_calls == [False, True]
+    assert not os.path.exists("{}.tmp".format(base_gpg_home))
+    assert not os.path.exists(context.config['gpg_lockfile'])
+
+
 # run_loop {{{1
 @pytest.mark.parametrize("verify_cot", (True, False))
 def test_mocker_run_loop(context, successful_queue, event_loop, verify_cot, mocker):
@@ -134,6 +184,19 @@ def test_mocker_run_loop_noop(context, successful_queue, event_loop, mocker):
     assert status is None
 
 
+def test_run_loop_no_claim_tasks(context, event_loop, mocker):
+    context.config['max_concurrent_tasks'] = 2
+    task_contexts = worker.get_task_contexts(context)
+    task_future = event_loop.create_future()
+    task_future.set_result(0)
+    task_contexts[0].task_future = task_future
+    claim_work = mocker.patch.object(worker.ClaimWorkPoller, 'claim_work')
+    status = event_loop.run_until_complete(worker.run_loop(context, claim_tasks=False))
+    claim_work.assert_not_called()
+    assert status == 0
+    assert worker.get_running_tasks(context) == []
+
+
 @pytest.mark.parametrize("func_to_raise,exc,expected", ((
     'run_task', ScriptWorkerException, ScriptWorkerException.exit_code
 ), (
@@ -172,3 +235,232 @@ def test_mocker_run_loop_exception(context, successful_queue, event_loop,
     mocker.patch.object(worker, "complete_task", new=noop_async)
     status = event_loop.run_until_complete(worker.run_loop(context))
     assert status == expected
+
+
+def test_mocker_run_loop_concurrent(context, successful_queue, event_loop, mocker):
+    context.config['max_concurrent_tasks'] = 3
+    context.config['poll_interval'] = 0
+    claim_args = []
+
+    def get_task(num):
+        return {"credentials": {"a": "b"}, "task": {'task_defn': num}}
+
+    async def claim_work(_, num_tasks=1):
+        claim_args.append(num_tasks)
+        if len(claim_args) == 1:
+            return {'tasks': [get_task(1), get_task(2)]}
+
+    async def run_task(task_context):
+        assert task_context.config['work_dir'] == os.path.join(
+            context.config['work_dir'], str(task_context.slot_id)
+        )
+        if task_context.task['task_defn'] == 2:
+            await asyncio.sleep(.1)
+        return task_context.task['task_defn']
+
+    context.queue = successful_queue
+    mocker.patch.object(worker, "claim_work", new=claim_work)
+    mocker.patch.object(worker, "reclaim_task", new=noop_async)
+    mocker.patch.object(worker, "run_task", new=run_task)
+    mocker.patch.object(worker, "generate_cot", new=noop_sync)
+    mocker.patch.object(worker, "upload_artifacts", new=noop_async)
+    mocker.patch.object(worker, "complete_task", new=noop_async)
+    mocker.patch.object(worker, "cleanup", new=noop_sync)
+    status = event_loop.run_until_complete(worker.run_loop(context))
+    assert claim_args == [3]
+    task_contexts = worker.get_task_contexts(context)
+    assert [c.slot_id for c in task_contexts] == [0, 1, 2]
+    running = worker.get_running_tasks(context)
+    if status is None:
+        assert len(running) == 2
+    else:
+        assert status == 1
+        assert len(running) == 1
+    # Only claim for the free slots.
+    while worker.get_running_tasks(context):
+        status = event_loop.run_until_complete(worker.run_loop(context)) or status
+    assert status == 2
+    assert claim_args[1] == 3 - len(running)
+
+
+def test_mocker_run_loop_pipeline(context, successful_queue, event_loop, mocker):
+    context.config['pipeline_tasks'] = True
+    context.config['poll_interval'] = 0
+    claimed = []
+    uploaded = []
+
+    async def claim_work(_, num_tasks=1):
+        assert num_tasks == 1
+        claimed.append(len(claimed) + 1)
+        if len(claimed) <= 2:
+            return {'tasks': [{"credentials": {"a": "b"}, "task": {'task_defn': len(claimed)}}]}
+
+    async def run_task(task_context):
+        return task_context.task['task_defn']
+
+    async def upload_artifacts(task_context):
+        # Don't let both uploads finish in the same run_loop iteration.
+        await asyncio.sleep(.1 * task_context.task['task_defn'])
+        uploaded.append(task_context.task['task_defn'])
+
+    context.queue = successful_queue
+    mocker.patch.object(worker, "claim_work", new=claim_work)
+    mocker.patch.object(worker, "reclaim_task", new=noop_async)
+    mocker.patch.object(worker, "run_task", new=run_task)
+    mocker.patch.object(worker, "generate_cot", new=noop_sync)
+    mocker.patch.object(worker, "upload_artifacts", new=upload_artifacts)
+    mocker.patch.object(worker, "complete_task", new=noop_async)
+    mocker.patch.object(worker, "cleanup", new=noop_sync)
+    # task 1 runs; its script exits, and it starts uploading in the background
+    assert event_loop.run_until_complete(worker.run_loop(context)) is None
+    assert len(worker.get_task_contexts(context)) == 2
+    assert len(worker.get_finishing_tasks(context)) == 1
+    # task 2 is claimed while task 1 is still uploading
+    event_loop.run_until_complete(worker.run_loop(context))
+    assert claimed == [1, 2]
+    assert uploaded == []
+    statuses = []
+    while worker.get_running_tasks(context) or worker.get_finishing_tasks(context):
+        statuses.append(event_loop.run_until_complete(worker.run_loop(context)))
+    assert [s for s in statuses if s is not None] == [1, 2]
+    assert uploaded == [1, 2]
+
+
+def test_mocker_run_loop_control_plane(context, successful_queue, event_loop, mocker):
+    threads = {}
+
+    async def claim_work(*args, **kwargs):
+        return {'tasks': [{"credentials": {"a": "b"}, "task": {'task_defn': True}}]}
+
+    async def record_thread(name, *args, **kwargs):
+        threads[name] = threading.current_thread()
+
+    async def reclaim_task(*args, **kwargs):
+        await record_thread('reclaim_task')
+
+    async def complete_task(*args, **kwargs):
+        await record_thread('complete_task')
+
+    async def run_task(*args, **kwargs):
+        await asyncio.sleep(.1)
+        return 0
+
+    context.queue = successful_queue
+    mocker.patch.object(worker, "claim_work", new=claim_work)
+    mocker.patch.object(worker, "reclaim_task", new=reclaim_task)
+    mocker.patch.object(worker, "run_task", new=run_task)
+    mocker.patch.object(worker, "generate_cot", new=noop_sync)
+    mocker.patch.object(worker, "upload_artifacts", new=noop_async)
+    mocker.patch.object(worker, "complete_task", new=complete_task)
+    control_plane = get_control_plane(context)
+    try:
+        status = event_loop.run_until_complete(worker.run_loop(context))
+    finally:
+        control_plane.stop()
+    assert status == 0
+    assert threads['reclaim_task'] is threads['complete_task']
+    assert threads['complete_task'] is not threading.current_thread()
+
+
+def test_mocker_run_loop_loop_lag_monitor(context, successful_queue, event_loop, mocker):
+    context.config['loop_lag_monitor'] = True
+    context.config['loop_lag_threshold'] = 0.05
+    context.config['loop_lag_sample_interval'] = 0.01
+    reports = []
+
+    async def claim_work(*args, **kwargs):
+        return {'tasks': [{"credentials": {"a": "b"}, "task": {'task_defn': True}}]}
+
+    async def run_task(*args, **kwargs):
+        await asyncio.sleep(.05)
+        time.sleep(.2)
+        return 0
+
+    async def upload_artifacts(task_context):
+        with open(os.path.join(task_context.config['task_log_dir'], 'loop_lag.log')) as fh:
+            reports.append(fh.read())
+
+    context.queue = successful_queue
+    mocker.patch.object(worker, "claim_work", new=claim_work)
+    mocker.patch.object(worker, "reclaim_task", new=noop_async)
+    mocker.patch.object(worker, "run_task", new=run_task)
+    mocker.patch.object(worker, "generate_cot", new=noop_sync)
+    mocker.patch.object(worker, "upload_artifacts", new=upload_artifacts)
+    mocker.patch.object(worker, "complete_task", new=noop_async)
+    assert event_loop.run_until_complete(worker.run_loop(context)) == 0
+    assert context.loop_lag_monitor is None
+    assert len(reports) == 1
+    assert 'in run_task' in reports[0]
+
+
+def test_do_run_task_stops_loop_lag_monitor(context, event_loop, mocker):
+    context.config['loop_lag_monitor'] = True
+    context.config['verify_chain_of_trust'] = False
+
+    async def run_task(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    mocker.patch.object(worker, "reclaim_task", new=noop_async)
+    mocker.patch.object(worker, "run_task", new=run_task)
+    with pytest.raises(RuntimeError):
+        event_loop.run_until_complete(worker.do_run_task(context))
+    assert context.loop_lag_monitor is None
+
+
+# ClaimWorkPoller {{{1
+@pytest.mark.asyncio
+async def test_claim_work_poller(context, event_loop, mocker):
+    context.config['min_poll_interval'] = 1
+    context.config['poll_interval'] = 10
+    scheduled = arrow.utcnow().replace(seconds=-30).isoformat()
+    results = [None, {'tasks': []}, {'tasks': [{
+        'runId': 0,
+        'status': {'runs': [{'scheduled': scheduled}]},
+    }, {
+        'task': {},
+    }]}, None]
+
+    async def claim_work(_, num_tasks=1):
+        assert num_tasks == 2
+        return results.pop(0)
+
+    mocker.patch.object(worker, "claim_work", new=claim_work)
+    poller = worker.ClaimWorkPoller(context)
+    assert poller.get_sleep_time() == 0
+    assert await poller.claim_work(2) == []
+    assert 1 <= poller.get_sleep_time() <= 1.5
+    assert await poller.claim_work(2) == []
+    assert 2 <= poller.get_sleep_time() <= 3
+    assert len(await poller.claim_work(2)) == 2
+    # claim again right away after claiming tasks
+    assert poller.get_sleep_time() == 0
+    assert await poller.claim_work(2) == []
+    stats = poller.get_stats()
+    assert stats['num_claims'] == 4
+    assert stats['num_tasks'] == 2
+    assert stats['empty_claims'] == 1
+    assert stats['claim_latency']['count'] == 4
+    assert stats['pending_latency']['count'] == 1
+    assert 29 <= stats['pending_latency']['last'] <= 60
+    assert "claims=4 tasks=2" in poller.format_stats()
+
+
+def test_claim_work_poller_max_delay(context):
+    context.config['min_poll_interval'] = 1
+    context.config['poll_interval'] = 5
+    poller = worker.ClaimWorkPoller(context)
+    poller.empty_claims = 2000
+    assert poller.get_sleep_time() == 5
+
+
+@pytest.mark.parametrize("claim_task,expected", ((
+    {'runId': 1, 'status': {'runs': [{}, {'scheduled': '2017-06-01T00:00:00.000Z'}]}}, 1496275200
+), (
+    {'runId': 1, 'status': {'runs': [{}]}}, None
+), (
+    {'runId': 0, 'status': {'runs': [{'scheduled': 'bad date'}]}}, None
+), (
+    {}, None
+)))
+def test_get_scheduled_timestamp(claim_task, expected):
+    assert worker.get_scheduled_timestamp(claim_task) == expected
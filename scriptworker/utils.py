@@ -16,12 +16,21 @@ import os
 import random
 import re
 import shutil
+import threading
+import time
+import weakref
+from contextlib import contextmanager
 from urllib.parse import unquote, urlparse
 from taskcluster.client import createTemporaryCredentials
-from scriptworker.exceptions import DownloadError, ScriptWorkerException, ScriptWorkerRetryException, ScriptWorkerTaskException
+from scriptworker.exceptions import CoTError, DownloadError, ScriptWorkerException, ScriptWorkerRetryException, ScriptWorkerTaskException
 
 log = logging.getLogger(__name__)
 
+# The owner of each asyncio task that has one; see ``task_owner``.
+_TASK_OWNERS = weakref.WeakKeyDictionary()
+# The owner of the task that submitted the current executor call.
+_EXECUTOR_OWNER = threading.local()
+
 
 # request {{{1
 async def request(context, url, timeout=60, method='get', good=(200, ),
@@ -327,6 +336,67 @@ async def raise_future_exceptions(tasks):
     return result
 
 
+# gather_fail_fast {{{1
+async def gather_fail_fast(tasks, cleanup_paths=None, fail_fast=True):
+    """Await a list of futures, cancelling the rest as soon as one fails.
+
+    ``raise_future_exceptions`` waits for every future before it raises, so
+    one failed transfer leaves its siblings transferring and retrying until
+    they're done.  Here, the first exception cancels the futures that are
+    still running, and is raised once they've stopped.  If we're cancelled
+    ourselves, we cancel the futures too.
+
+    Args:
+        tasks (list): the list of futures to await.
+        cleanup_paths (list, optional): the partial files to remove on
+            failure or cancellation.  Defaults to None.
+        fail_fast (bool, optional): if False, wait for every future, log
+            each exception, and raise the first one.  Defaults to True.
+
+    Returns:
+        list: the list of result()s from the futures.
+
+    Raises:
+        Exception: the first exception the futures raised.
+
+    """
+    if not tasks:
+        return []
+    try:
+        if fail_fast:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        else:
+            await asyncio.wait(tasks)
+    except asyncio.CancelledError:
+        await _cancel_futures(tasks, cleanup_paths)
+        raise
+    errors = [task.exception() for task in tasks if task.done() and not task.cancelled() and task.exception()]
+    if errors:
+        if fail_fast:
+            await _cancel_futures(tasks, cleanup_paths)
+        else:
+            for exc in errors:
+                log.error("{}: {}".format(type(exc).__name__, exc))
+            _rm_paths(cleanup_paths)
+        raise errors[0]
+    return [task.result() for task in tasks]
+
+
+async def _cancel_futures(tasks, cleanup_paths):
+    pending = [task for task in tasks if not task.done()]
+    if pending:
+        log.warning("Cancelling {} unfinished task(s)...".format(len(pending)))
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending)
+    _rm_paths(cleanup_paths)
+
+
+def _rm_paths(paths):
+    for path in paths or []:
+        rm(path)
+
+
 # filepaths_in_dir {{{1
 def filepaths_in_dir(path):
     """Find all files in a directory, and return the relative paths to those files.
@@ -348,6 +418,120 @@ def filepaths_in_dir(path):
     return filepaths
 
 
+# task owners {{{1
+def get_current_task():
+    """Get the asyncio task running in this thread.
+
+    Returns:
+        asyncio.Task: the current task, or None outside of a task, e.g. in
+            executor threads.
+
+    """
+    try:
+        return (getattr(asyncio, 'current_task', None) or asyncio.Task.current_task)()
+    except RuntimeError:
+        # There's no event loop in executor threads.
+        return None
+
+
+def get_task_owner():
+    """Get the owner of the current asyncio task.
+
+    In ``run_in_executor`` calls, this is the owner of the task that made the
+    call.
+
+    Returns:
+        object: the owner set by ``task_owner``, or None.
+
+    """
+    task = get_current_task()
+    if task is None:
+        return getattr(_EXECUTOR_OWNER, 'owner', None)
+    return _TASK_OWNERS.get(task)
+
+
+def _owner_task_factory(loop, coro, factory=None):
+    owner = get_task_owner()
+    if factory is None:
+        task = asyncio.Task(coro, loop=loop)
+    else:
+        task = factory(loop, coro)
+    if owner is not None:
+        _TASK_OWNERS[task] = owner
+    return task
+
+
+@contextmanager
+def task_owner(owner):
+    """Set the owner of the current asyncio task, and of the tasks it starts.
+
+    This has to be called from inside an asyncio task.  asyncio tasks don't know which task started them, so this sets a task
+    factory on the event loop that passes the owner on to each new task.
+    ``run_in_executor`` passes it on to the executor call.
+
+    Args:
+        owner (object): the owner, e.g. a token that a ``logging.Filter``
+            checks with ``get_task_owner``.
+
+    Yields:
+        None: but restores the previous owner afterwards.
+
+    """
+    task = get_current_task()
+    loop = asyncio.get_event_loop()
+    factory = loop.get_task_factory()
+    if not getattr(factory, 'sets_task_owner', False):
+        factory = functools.partial(_owner_task_factory, factory=factory)
+        factory.sets_task_owner = True
+        loop.set_task_factory(factory)
+    previous_owner = _TASK_OWNERS.get(task)
+    _TASK_OWNERS[task] = owner
+    try:
+        yield
+    finally:
+        if previous_owner is None:
+            del _TASK_OWNERS[task]
+        else:
+            _TASK_OWNERS[task] = previous_owner
+
+
+def _call_with_task_owner(owner, func, *args, **kwargs):
+    _EXECUTOR_OWNER.owner = owner
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _EXECUTOR_OWNER.owner = None
+
+
+# run_in_executor {{{1
+async def run_in_executor(context, func, *args, **kwargs):
+    """Run the blocking ``func(*args, **kwargs)`` in the context's thread pool.
+
+    The event loop keeps running while ``func`` runs.  ``func`` sees the
+    current task's owner from ``get_task_owner``.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+        func (function): the blocking function to call.
+        *args: the args to pass to ``func``.
+        **kwargs: the kwargs to pass to ``func``.
+
+    Returns:
+        the result of ``func``.
+
+    Raises:
+        Exception: any exception ``func`` raises.
+
+    """
+    executor = context.get_executor()
+    if executor is None:
+        return func(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(_call_with_task_owner, get_task_owner(), func, *args, **kwargs)
+    )
+
+
 # get_hash {{{1
 def get_hash(path, hash_alg="sha256"):
     """Get the hash of the file at ``path``.
@@ -364,7 +548,9 @@ def get_hash(path, hash_alg="sha256"):
     """
     h = hashlib.new(hash_alg)
     with open(path, "rb") as f:
-        for chunk in iter(functools.partial(f.read, 4096), b''):
+        # hashlib releases the GIL while it hashes large chunks, so this
+        # runs in parallel with the event loop in the thread pool.
+        for chunk in iter(functools.partial(f.read, 1024 * 1024), b''):
             h.update(chunk)
     return h.hexdigest()
 
@@ -417,33 +603,317 @@ def load_json(string, is_path=False, exception=ScriptWorkerTaskException,
 
 
 # download_file {{{1
-async def download_file(context, url, abs_filename, session=None, chunk_size=128):
+async def download_file(context, url, abs_filename, session=None, chunk_size=64 * 1024,
+                        expected_digests=None):
     """Download a file, async.
 
+    The file downloads to ``abs_filename.part``, which is renamed to
+    ``abs_filename`` once it's complete.  If ``abs_filename.part`` already
+    exists, e.g. when ``retry_async`` retries a failed download, we ask for
+    the rest of the file with an HTTP Range request, and start over if the
+    server sends the whole file instead.  Artifacts are immutable, so the
+    partial file is still good.
+
+    When we know the size of the file, we preallocate it.  The reads start
+    at ``chunk_size`` bytes, and grow up to ``download_max_chunk_size``
+    bytes while the response keeps filling them.
+
+    If ``download_segments`` is more than 1, we ask for the file with an
+    open-ended Range request.  If the server supports ranges and the file
+    is at least ``download_segment_threshold`` bytes, we download it in
+    ``download_segments`` byte ranges in parallel; otherwise we download
+    it in a single stream, as usual.
+
+    If we have ``expected_digests``, we hash the file as it downloads, and
+    don't move it into place unless all of the digests match.
+
+    aiohttp decodes responses with a ``Content-Encoding``, e.g. the gzipped
+    logs and chain of trust artifacts we upload.  Their ``Content-Length``
+    and byte ranges count the encoded bytes, not the decoded bytes we write,
+    so we don't check their length, preallocate, split them into segments,
+    or keep their partial files to resume from.
+
     Args:
         context (scriptworker.context.Context): the scriptworker context.
         url (str): the url to download
         abs_filename (str): the path to download to
         session (aiohttp.ClientSession, optional): the session to use.  If
             None, use context.session.  Defaults to None.
-        chunk_size (int, optional): the chunk size to read from the response
-            at a time.  Default is 128.
+        chunk_size (int, optional): the initial chunk size to read from the
+            response at a time.  Default is 64 KiB.
+        expected_digests (dict, optional): maps hash algorithms to the
+            expected hexdigests of the file.  Defaults to None.
+
+    Raises:
+        DownloadError: on a bad status, or if we didn't get the whole file.
+        CoTError: if the file doesn't match ``expected_digests``.  We don't
+            keep the file.
 
     """
     session = session or context.session
     log.info("Downloading %s", url)
-    parent_dir = os.path.dirname(abs_filename)
-    async with session.get(url) as resp:
-        if resp.status != 200:
+    makedirs(os.path.dirname(abs_filename))
+    part_path = "{}.part".format(abs_filename)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    segmented = not offset and context.config['download_segments'] > 1 and hasattr(os, 'pwrite')
+    headers = {}
+    if offset or segmented:
+        headers[aiohttp.hdrs.RANGE] = "bytes={}-".format(offset)
+    hashes = None
+    if expected_digests:
+        hashes = [hashlib.new(alg) for alg in sorted(expected_digests)]
+    start = time.time()
+    async with session.get(url, headers=headers) as resp:
+        if resp.status == 206 and get_content_range_start(resp) == offset:
+            if offset:
+                log.info("Resuming %s at byte %d", url, offset)
+        elif resp.status == 200:
+            offset = 0
+        else:
+            if resp.status in (206, 416):
+                # The range doesn't match our partial file; start over next time.
+                rm(part_path)
             raise DownloadError("{} status {} is not 200!".format(url, resp.status))
-        makedirs(parent_dir)
-        with open(abs_filename, 'wb') as fd:
+        encoded = resp.headers.get(aiohttp.hdrs.CONTENT_ENCODING, 'identity').lower() not in ('', 'identity')
+        if encoded and offset:
+            # The range is of the encoded bytes, but the partial file holds
+            # decoded bytes; start over next time.
+            rm(part_path)
+            raise DownloadError("{}: can't resume a {} encoded download!".format(
+                url, resp.headers[aiohttp.hdrs.CONTENT_ENCODING]
+            ))
+        content_length = resp.headers.get(aiohttp.hdrs.CONTENT_LENGTH)
+        expected_size = None
+        if content_length is not None and not encoded:
+            expected_size = offset + int(content_length)
+        if segmented and resp.status == 206 and expected_size is not None and \
+                expected_size >= context.config['download_segment_threshold']:
+            size = await _download_segments(context, session, url, resp, part_path, expected_size, chunk_size)
+            if hashes:
+                # The segments arrive out of order, so hash the file afterwards.
+                await run_in_executor(context, _update_hashes_from_file, hashes, part_path, size)
+        else:
+            if hashes and offset:
+                await run_in_executor(context, _update_hashes_from_file, hashes, part_path, offset)
+            try:
+                size = await _write_response_to_file(
+                    context, resp, part_path, offset, expected_size, chunk_size, hashes=hashes,
+                )
+            except BaseException:
+                if encoded:
+                    rm(part_path)
+                raise
+    if expected_size is not None and size != expected_size:
+        raise DownloadError("{}: got {} of {} bytes!".format(url, size, expected_size))
+    if hashes:
+        for h in hashes:
+            if h.hexdigest() != expected_digests[h.name]:
+                rm(part_path)
+                raise CoTError("BAD HASH: {}: Expected {} {}; got {}!".format(
+                    url, h.name, expected_digests[h.name], h.hexdigest()
+                ))
+    os.replace(part_path, abs_filename)
+    elapsed = time.time() - start
+    log.info("Done: downloaded {} bytes in {:.3f} seconds ({:.3f} MiB/s)".format(
+        size - offset, elapsed, (size - offset) / max(elapsed, 0.001) / 1024 / 1024
+    ))
+
+
+async def _write_response_to_file(context, resp, path, offset, expected_size, chunk_size, hashes=None):
+    max_chunk_size = context.config['download_max_chunk_size']
+    with open(path, 'r+b' if offset else 'wb') as fh:
+        fh.seek(offset)
+        if expected_size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fh.fileno(), 0, expected_size)
+            except OSError:
+                pass
+        size = offset
+        try:
             while True:
                 chunk = await resp.content.read(chunk_size)
                 if not chunk:
                     break
-                fd.write(chunk)
-    log.info("Done")
+                fh.write(chunk)
+                size += len(chunk)
+                if hashes:
+                    await run_in_executor(context, _update_hashes, hashes, chunk)
+                if len(chunk) >= chunk_size:
+                    chunk_size = min(chunk_size * 2, max_chunk_size)
+        finally:
+            # Drop the preallocated space we didn't write to, so a retry
+            # resumes from the right offset.
+            fh.truncate(size)
+    return size
+
+
+def _update_hashes(hashes, data):
+    for h in hashes:
+        h.update(data)
+
+
+def _update_hashes_from_file(hashes, path, size):
+    with open(path, "rb") as fh:
+        while size > 0:
+            chunk = fh.read(min(size, 1024 * 1024))
+            if not chunk:
+                break
+            _update_hashes(hashes, chunk)
+            size -= len(chunk)
+
+
+async def _download_segments(context, session, url, resp, path, size, chunk_size):
+    num_segments = context.config['download_segments']
+    segment_size = -(-size // num_segments)
+    segments = [(start, min(start + segment_size, size)) for start in range(0, size, segment_size)]
+    log.info("Downloading %s in %d segments of %d bytes", url, len(segments), segment_size)
+    with open(path, 'wb') as fh:
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fh.fileno(), 0, size)
+            except OSError:
+                fh.truncate(size)
+        else:
+            fh.truncate(size)
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        # The first segment comes from the response we already have.
+        tasks = [asyncio.ensure_future(
+            _write_first_segment(context, session, url, resp, fd, segments[0], chunk_size)
+        )]
+        for segment in segments[1:]:
+            tasks.append(asyncio.ensure_future(retry_async(
+                _download_segment, args=(context, session, url, fd, segment, chunk_size),
+                retry_exceptions=(DownloadError, aiohttp.ClientError),
+            )))
+        # One failed segment means the whole download fails, so stop the
+        # others rather than letting them finish.
+        await gather_fail_fast(tasks)
+    except Exception:
+        # We can't resume from a file with holes in it.
+        os.close(fd)
+        rm(path)
+        raise
+    os.close(fd)
+    return size
+
+
+async def _write_first_segment(context, session, url, resp, fd, segment, chunk_size):
+    try:
+        await _write_segment(context, resp, fd, segment, chunk_size)
+    except (DownloadError, aiohttp.ClientError) as exc:
+        log.warning("Retrying the first segment of %s: %s", url, exc)
+        await retry_async(
+            _download_segment, args=(context, session, url, fd, segment, chunk_size),
+            retry_exceptions=(DownloadError, aiohttp.ClientError),
+        )
+    finally:
+        # We only read part of the response; don't reuse the connection.
+        resp.close()
+
+
+async def _download_segment(context, session, url, fd, segment, chunk_size):
+    start, end = segment
+    headers = {aiohttp.hdrs.RANGE: "bytes={}-{}".format(start, end - 1)}
+    async with session.get(url, headers=headers) as resp:
+        if resp.status != 206 or get_content_range_start(resp) != start:
+            raise DownloadError("{} bytes {}-{}: status {} is not 206!".format(url, start, end - 1, resp.status))
+        await _write_segment(context, resp, fd, segment, chunk_size)
+
+
+async def _write_segment(context, resp, fd, segment, chunk_size):
+    start, end = segment
+    max_chunk_size = context.config['download_max_chunk_size']
+    position = start
+    while position < end:
+        chunk = await resp.content.read(min(chunk_size, end - position))
+        if not chunk:
+            raise DownloadError("Segment {}-{}: got {} bytes!".format(start, end - 1, position - start))
+        os.pwrite(fd, chunk, position)
+        position += len(chunk)
+        if len(chunk) >= chunk_size:
+            chunk_size = min(chunk_size * 2, max_chunk_size)
+
+
+# get_content_range_start {{{1
+def get_content_range_start(resp):
+    """Get the first byte position of a 206 response's ``Content-Range``.
+
+    Args:
+        resp (aiohttp.ClientResponse): the response.
+
+    Returns:
+        int: the first byte position, or None if we can't parse it.
+
+    """
+    match = re.match(r'^bytes (\d+)-\d+/(\d+|\*)$', resp.headers.get(aiohttp.hdrs.CONTENT_RANGE, ''))
+    if match:
+        return int(match.group(1))
+
+
+# RunningStats {{{1
+class RunningStats(object):
+    """Keep summary statistics for a series of samples, without keeping the samples.
+
+    Attributes:
+        count (int): the number of samples.
+        last (float): the most recent sample, or None.
+        max (float): the largest sample, or None.
+        min (float): the smallest sample, or None.
+        total (float): the sum of the samples.
+
+    """
+
+    def __init__(self):
+        """Initialize RunningStats."""
+        self.count = 0
+        self.total = 0
+        self.last = None
+        self.min = None
+        self.max = None
+
+    @property
+    def mean(self):
+        """float: the mean of the samples, or None if there are no samples."""
+        if self.count:
+            return self.total / self.count
+
+    def add(self, value):
+        """Add a sample.
+
+        Args:
+            value (float): the sample to add.
+
+        """
+        self.count += 1
+        self.total += value
+        self.last = value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self):
+        """Get the summary statistics as a dict.
+
+        Returns:
+            dict: the ``count``, ``last``, ``max``, ``mean``, ``min``, and ``total``.
+
+        """
+        return {
+            'count': self.count,
+            'last': self.last,
+            'max': self.max,
+            'mean': self.mean,
+            'min': self.min,
+            'total': self.total,
+        }
+
+    def __str__(self):
+        """Format the summary statistics for the log."""
+        if not self.count:
+            return "count=0"
+        return "count={} mean={:.3f} min={:.3f} max={:.3f} last={:.3f}".format(
+            self.count, self.mean, self.min, self.max, self.last
+        )
 
 
 # match_url_regex {{{1
@@ -11,70 +11,432 @@ import asyncio
 import logging
 import os
 import sys
+import time
 
 from scriptworker.artifacts import upload_artifacts
 from scriptworker.config import get_context_from_cmdln
+from scriptworker.control import get_control_plane
 from scriptworker.constants import STATUSES
 from scriptworker.cot.generate import generate_cot
 from scriptworker.cot.verify import ChainOfTrust, verify_chain_of_trust
 from scriptworker.gpg import get_tmp_base_gpg_home_dir, is_lockfile_present, rm_lockfile
 from scriptworker.exceptions import ScriptWorkerException
-from scriptworker.task import claim_work, complete_task, reclaim_task, run_task, worst_level
-from scriptworker.utils import cleanup, rm
+from scriptworker.monitor import LoopLagMonitor
+from scriptworker.task import claim_work, complete_task, get_run_id, reclaim_task, run_task, worst_level
+from scriptworker.utils import RunningStats, calculate_sleep_time, cleanup, rm, run_in_executor
 
 log = logging.getLogger(__name__)
 
 
-async def run_loop(context, creds_key="credentials"):
+# ClaimWorkPoller {{{1
+class ClaimWorkPoller(object):
+    """Call claimWork, backing off while the queue doesn't have any tasks for us.
+
+    After claimWork returns tasks, or after a task finishes, we claim again
+    right away.  Each consecutive claimWork call that returns no tasks
+    increases the delay before the next call, with jitter, up to
+    ``poll_interval``.
+
+    Attributes:
+        claim_latency (RunningStats): how long claimWork calls take, in seconds.
+        context (scriptworker.context.Context): the scriptworker context.
+        empty_claims (int): the number of consecutive claimWork calls that
+            returned no tasks.
+        num_claims (int): the total number of claimWork calls.
+        num_tasks (int): the total number of tasks claimed.
+        pending_latency (RunningStats): how long claimed tasks were pending
+            in the queue before we claimed them, in seconds.
+
+    """
+
+    def __init__(self, context):
+        """Initialize ClaimWorkPoller.
+
+        Args:
+            context (scriptworker.context.Context): the scriptworker context.
+
+        """
+        self.context = context
+        self.empty_claims = 0
+        self.num_claims = 0
+        self.num_tasks = 0
+        self.claim_latency = RunningStats()
+        self.pending_latency = RunningStats()
+
+    async def claim_work(self, num_tasks):
+        """Call claimWork, and record the claim statistics.
+
+        Args:
+            num_tasks (int): the maximum number of tasks to claim.
+
+        Returns:
+            list: the list of claimed task definitions.
+
+        """
+        start = time.time()
+        tasks = await claim_work(self.context, num_tasks=num_tasks)
+        now = time.time()
+        self.num_claims += 1
+        self.claim_latency.add(now - start)
+        tasks = (tasks or {}).get('tasks', [])
+        if tasks:
+            self.empty_claims = 0
+            self.num_tasks += len(tasks)
+            for claim_task in tasks:
+                scheduled = get_scheduled_timestamp(claim_task)
+                if scheduled is not None:
+                    self.pending_latency.add(max(now - scheduled, 0))
+            log.info("Claimed {} task(s). {}".format(len(tasks), self.format_stats()))
+        else:
+            self.empty_claims += 1
+        return tasks
+
+    def get_sleep_time(self):
+        """Get the time to sleep before the next claimWork call.
+
+        Returns:
+            float: the time to sleep, in seconds.
+
+        """
+        # Cap the attempt number; we hit max_delay long before this, and
+        # 2 ** attempt will overflow a float eventually.
+        return calculate_sleep_time(
+            min(self.empty_claims, 32), delay_factor=self.context.config['min_poll_interval'],
+            max_delay=self.context.config['poll_interval'],
+        )
+
+    def get_stats(self):
+        """Get the claim statistics.
+
+        Returns:
+            dict: the claim statistics.
+
+        """
+        return {
+            'claim_latency': self.claim_latency.to_dict(),
+            'empty_claims': self.empty_claims,
+            'num_claims': self.num_claims,
+            'num_tasks': self.num_tasks,
+            'pending_latency': self.pending_latency.to_dict(),
+        }
+
+    def format_stats(self):
+        """Format the claim statistics for the log.
+
+        Returns:
+            str: the formatted claim statistics.
+
+        """
+        return "claims={} tasks={} claimWork latency: {}; pending latency: {}".format(
+            self.num_claims, self.num_tasks, self.claim_latency, self.pending_latency
+        )
+
+
+# get_scheduled_timestamp {{{1
+def get_scheduled_timestamp(claim_task):
+    """Get the time the claimed task run was scheduled.
+
+    Args:
+        claim_task (dict): the claimTask definition from claimWork.
+
+    Returns:
+        float: the timestamp the run was scheduled, or None if unknown.
+
+    """
+    try:
+        run = claim_task['status']['runs'][get_run_id(claim_task)]
+        return arrow.get(run['scheduled']).float_timestamp
+    except (KeyError, IndexError, TypeError, arrow.parser.ParserError):
+        return None
+
+
+# get_task_contexts {{{1
+def get_task_contexts(context):
+    """Get the per-task contexts.
+
+    There is one task context per task slot.  In ``pipeline_tasks`` mode,
+    there are two task contexts per task slot, so one task can upload its
+    artifacts and report its status while the next task runs.
+
+    With a single task context, the worker ``context`` runs the task itself,
+    and the task uses the configured directories directly.  Otherwise, each
+    task context comes from ``context.create_task_context``, with its own
+    directories.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        list: the list of task ``Context``s.
+
+    """
+    if context.task_contexts is None:
+        num_contexts = context.config['max_concurrent_tasks']
+        if context.config['pipeline_tasks']:
+            num_contexts *= 2
+        if num_contexts == 1:
+            context.task_contexts = [context]
+        else:
+            context.task_contexts = []
+            for slot_id in range(num_contexts):
+                task_context = context.create_task_context(slot_id)
+                cleanup(task_context)
+                context.task_contexts.append(task_context)
+    return context.task_contexts
+
+
+# get_running_tasks {{{1
+def get_running_tasks(context):
+    """Get the futures of the tasks currently running in our task slots.
+
+    In ``pipeline_tasks`` mode, this doesn't include the tasks that are
+    uploading their artifacts and reporting their status.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        list: the list of running task futures.
+
+    """
+    return [c.task_future for c in context.task_contexts or [] if c.task_future is not None]
+
+
+# get_finishing_tasks {{{1
+def get_finishing_tasks(context):
+    """Get the futures of the tasks uploading their artifacts and reporting their status.
+
+    These are only split out from the running tasks in ``pipeline_tasks`` mode.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        list: the list of finishing task futures.
+
+    """
+    return [c.finish_future for c in context.task_contexts or [] if c.finish_future is not None]
+
+
+# get_free_task_contexts {{{1
+def get_free_task_contexts(context):
+    """Get the task contexts we can claim new tasks into.
+
+    This is limited by ``max_concurrent_tasks``.  In ``pipeline_tasks`` mode,
+    finishing tasks don't count against ``max_concurrent_tasks``, but they
+    still keep their task context busy.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        list: the list of free task ``Context``s.
+
+    """
+    free_contexts = [
+        c for c in get_task_contexts(context) if c.task_future is None and c.finish_future is None
+    ]
+    num_free_slots = context.config['max_concurrent_tasks'] - len(get_running_tasks(context))
+    return free_contexts[:max(num_free_slots, 0)]
+
+
+# do_run_task {{{1
+async def do_run_task(context):
+    """Verify the chain of trust, run the task, and generate the chain of trust artifact.
+
+    The reclaimTask heartbeats run on the control plane, if we have one.
+    If ``loop_lag_monitor`` is on, start monitoring the event loop lag.
+
+    Args:
+        context (scriptworker.context.Context): the task context, with
+            ``claim_task`` set.
+
+    Returns:
+        int: status
+
+    """
+    loop = asyncio.get_event_loop()
+    log.info("Going to run task!")
+    status = 0
+    if context.config['loop_lag_monitor']:
+        context.loop_lag_monitor = LoopLagMonitor(context)
+        context.loop_lag_monitor.start()
+    if context.control_plane is not None:
+        context.control_plane.submit(reclaim_task(context, context.task))
+    else:
+        loop.create_task(reclaim_task(context, context.task))
+    try:
+        if context.config['verify_chain_of_trust']:
+            chain = ChainOfTrust(context, context.config['cot_job_type'])
+            await verify_chain_of_trust(chain)
+        status = await run_task(context)
+        await run_in_executor(context, generate_cot, context)
+    except ScriptWorkerException as e:
+        status = worst_level(status, e.exit_code)
+        log.error("Hit ScriptWorkerException: {}".format(e))
+    except BaseException:
+        # do_finish_task won't run, so it can't stop the monitor.
+        stop_loop_lag_monitor(context)
+        raise
+    return status
+
+
+# do_finish_task {{{1
+async def do_finish_task(context, status):
+    """Upload the artifacts, report the task status, and clean up.
+
+    The status report runs on the control plane, if we have one.  If we're
+    monitoring the event loop lag, the loop lag report is written to
+    ``task_log_dir`` before the upload, and the final stats are logged at
+    the end.
+
+    Args:
+        context (scriptworker.context.Context): the task context, with
+            ``claim_task`` set.
+        status (int): the status from ``do_run_task``.
+
+    Returns:
+        int: status
+
+    """
+    try:
+        if context.loop_lag_monitor is not None:
+            context.loop_lag_monitor.write_report()
+        try:
+            await upload_artifacts(context)
+        except ScriptWorkerException as e:
+            status = worst_level(status, e.exit_code)
+            log.error("Hit ScriptWorkerException: {}".format(e))
+        except aiohttp.ClientError as e:
+            status = worst_level(status, STATUSES['intermittent-task'])
+            log.error("Hit aiohttp error: {}".format(e))
+        if context.control_plane is not None:
+            await context.control_plane.run(complete_task(context, status))
+            log.debug(context.control_plane.format_stats())
+        else:
+            await complete_task(context, status)
+    finally:
+        stop_loop_lag_monitor(context)
+    await run_in_executor(context, cleanup, context)
+    return status
+
+
+# stop_loop_lag_monitor {{{1
+def stop_loop_lag_monitor(context):
+    """Stop the task's event loop lag monitor, if it has one, and log its stats.
+
+    Args:
+        context (scriptworker.context.Context): the task context.
+
+    """
+    monitor = context.loop_lag_monitor
+    if monitor is not None:
+        context.loop_lag_monitor = None
+        monitor.stop()
+        log.info(monitor.format_report())
+
+
+# run_claimed_task {{{1
+async def run_claimed_task(context):
+    """Run a claimed task through to completion, then clean up.
+
+    Args:
+        context (scriptworker.context.Context): the task context, with
+            ``claim_task`` set.
+
+    Returns:
+        int: status
+
+    """
+    status = await do_run_task(context)
+    return await do_finish_task(context, status)
+
+
+# get_claim_work_poller {{{1
+def get_claim_work_poller(context):
+    """Get the ``ClaimWorkPoller`` for the worker context, creating it if needed.
+
+    Args:
+        context (scriptworker.context.Context): the scriptworker context.
+
+    Returns:
+        ClaimWorkPoller: the poller.
+
+    """
+    if context.claim_work_poller is None:
+        context.claim_work_poller = ClaimWorkPoller(context)
+    return context.claim_work_poller
+
+
+# run_loop {{{1
+async def run_loop(context, creds_key="credentials", claim_tasks=True):
     """Split this out of the async_main while loop for easier testing.
 
+    Claim as many tasks as we have free task slots, and start them.  If all
+    of the task slots are busy, wait for one of the tasks to finish.  If we
+    have free task slots, wait until it's time to poll again; the poll
+    interval backs off while the queue keeps returning no tasks.
+
+    In ``pipeline_tasks`` mode, a task frees up its slot as soon as the task
+    script exits; the artifact upload, status report, and cleanup happen in
+    the background while we claim and start the next task.
+
+    With ``claim_tasks`` False, don't claim any new tasks; just wait for one
+    of the tasks in flight to make progress.
+
     args:
         context (scriptworker.context.Context): the scriptworker context.
         creds_key (str, optional): when reading the creds file, this dict key
             corresponds to the credentials value we want to use.  Defaults to
             "credentials".
+        claim_tasks (bool, optional): whether to claim new tasks into the free
+            task slots.  Defaults to True.
 
     Returns:
-        int: status
-        None: if no task run.
+        int: status of the most recently finished task.
+        None: if no task finished.
 
     """
-    loop = asyncio.get_event_loop()
-    tasks = await claim_work(context)
+    pipeline = context.config['pipeline_tasks']
+    poller = get_claim_work_poller(context)
+    task_contexts = get_task_contexts(context)
+    free_contexts = get_free_task_contexts(context)
     status = None
-    if tasks:
-        # Assume only a single task, but should more than one fall through,
-        # run them sequentially.  A side effect is our return status will
-        # be the status of the final task run.
-        for task_defn in tasks.get('tasks', []):
-            context.claim_task = task_defn
-            log.info("Going to run task!")
-            status = 0
-            loop.create_task(reclaim_task(context, context.task))
-            try:
-                if context.config['verify_chain_of_trust']:
-                    chain = ChainOfTrust(context, context.config['cot_job_type'])
-                    await verify_chain_of_trust(chain)
-                status = await run_task(context)
-                generate_cot(context)
-            except ScriptWorkerException as e:
-                status = worst_level(status, e.exit_code)
-                log.error("Hit ScriptWorkerException: {}".format(e))
-            try:
-                await upload_artifacts(context)
-            except ScriptWorkerException as e:
-                status = worst_level(status, e.exit_code)
-                log.error("Hit ScriptWorkerException: {}".format(e))
-            except aiohttp.ClientError as e:
-                status = worst_level(status, STATUSES['intermittent-task'])
-                log.error("Hit aiohttp error: {}".format(e))
-            await complete_task(context, status)
-            cleanup(context)
-            await asyncio.sleep(1)
-    await asyncio.sleep(context.config['poll_interval'])
+    if free_contexts and claim_tasks:
+        tasks = await poller.claim_work(len(free_contexts))
+        for task_context, task_defn in zip(free_contexts, tasks):
+            task_context.claim_task = task_defn
+            if pipeline:
+                task_context.task_future = asyncio.ensure_future(do_run_task(task_context))
+            else:
+                task_context.task_future = asyncio.ensure_future(run_claimed_task(task_context))
+    futures = get_running_tasks(context) + get_finishing_tasks(context)
+    # If all of the task slots are busy, wait for one to free up, then claim
+    # again right away.  Otherwise, only wait until it's time to poll again.
+    sleep_time = poller.get_sleep_time() if claim_tasks and get_free_task_contexts(context) else None
+    if futures:
+        await asyncio.wait(futures, timeout=sleep_time, return_when=asyncio.FIRST_COMPLETED)
+    elif sleep_time:
+        log.debug("No tasks claimed; sleeping {:.2f} seconds before polling again...".format(sleep_time))
+        await asyncio.sleep(sleep_time)
+    for task_context in task_contexts:
+        if task_context.task_future is not None and task_context.task_future.done():
+            future = task_context.task_future
+            task_context.task_future = None
+            if pipeline:
+                task_context.finish_future = asyncio.ensure_future(
+                    do_finish_task(task_context, future.result())
+                )
+            else:
+                status = future.result()
+        if task_context.finish_future is not None and task_context.finish_future.done():
+            future = task_context.finish_future
+            task_context.finish_future = None
+            status = future.result()
     return status
 
 
+# async_main {{{1
 async def async_main(context):
     """Run the main async loop.
 
@@ -88,15 +450,26 @@ async def async_main(context):
     tmp_gpg_home = get_tmp_base_gpg_home_dir(context)
     state = is_lockfile_present(context, "scriptworker", logging.DEBUG)
     if os.path.exists(tmp_gpg_home) and state == "ready":
+        # Don't swap out the gpg homedirs while a task may be verifying its
+        # chain of trust.  Stop claiming new tasks until the running tasks
+        # drain, so a busy worker still picks up the rebuilt homedirs.
+        if get_running_tasks(context):
+            log.info("Waiting for the running tasks to finish before swapping in the new gpg homedirs...")
+            await run_loop(context, claim_tasks=False)
+            return
         try:
-            rm(context.config['base_gpg_home_dir'])
+            await run_in_executor(context, rm, context.config['base_gpg_home_dir'])
             os.rename(tmp_gpg_home, context.config['base_gpg_home_dir'])
+            # Cached chain of trust verifications were made against the old homedirs.
+            if context.config['cot_verification_cache_dir']:
+                log.info("Clearing the chain of trust verification cache...")
+                await run_in_executor(context, rm, context.config['cot_verification_cache_dir'])
         finally:
             rm_lockfile(context)
     await run_loop(context)
-    await asyncio.sleep(context.config['poll_interval'])
 
 
+# main {{{1
 def main():
     """Scriptworker entry point: get everything set up, then enter the main loop."""
     context, credentials = get_context_from_cmdln(sys.argv[1:])
@@ -107,9 +480,15 @@ def main():
     with aiohttp.ClientSession(connector=conn) as session:
         context.session = session
         context.credentials = credentials
-        while True:
-            try:
-                loop.run_until_complete(async_main(context))
-            except Exception:
-                log.critical("Fatal exception", exc_info=1)
-                raise
+        control_plane = get_control_plane(context)
+        try:
+            while True:
+                try:
+                    loop.run_until_complete(async_main(context))
+                except Exception:
+                    log.critical("Fatal exception", exc_info=1)
+                    raise
+        finally:
+            if control_plane is not None:
+                control_plane.stop()
+            context.shutdown_executors()